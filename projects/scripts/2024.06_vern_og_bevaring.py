@@ -24,35 +24,37 @@ catalog = load_catalog()
 params = load_parameters()
 
 
-def inject_db(dict_gpkg_lyr, convert_geom=False):
+def inject_db(dict_gpkg_lyr, convert_geom=False, mode="parquet"):
     """Load geopackage layers into DuckDB database.
     Args:
         dict_gpkg_lyr (Dict): dict with geopackage path and layer name.
         convert_geom (bool, optional): Convert BLOB to geom. Defaults to False.
+            Not needed for the direct modes, which load the geometry as geom.
+        mode (str, optional): Ingestion mode of load_gpkg_layers ("parquet",
+            "st_read" or "arrow"). Defaults to "parquet".
     """
     # load into DuckDB
     for gpkg, layer in tqdm(dict_gpkg_lyr.items(), desc="Loading GPKG Layers"):
         logging.info(f"Loading {layer} from {gpkg}")
-        load_gpkg_layers(db_path, gpkg, layer)
+        load_gpkg_layers(db_path, gpkg, layer, mode=mode)
 
     if convert_geom:
     # cast BLOB (Binary Large Object) to geometry for spatial operations
-        con = duckdb.connect(db_path)
-        con.install_extension('spatial')
-        con.load_extension('spatial')
-
-    # duckdb tables names to list
-        tables = con.execute("SHOW TABLES;").fetchdf()
-        tables = tables["name"].to_list()
-        logging.info(tables)
-
-        for table in tables:
-            blob_to_geom(
-            db_path=db_path,
-            tbl_name=table,
-            blob_field="geometry",
-            geom_field="geom",   
-        )
+        with DuckSession(db_path) as session:
+
+        # duckdb tables names to list
+            tables = session.sql("SHOW TABLES;").fetchdf()
+            tables = tables["name"].to_list()
+            tables = [table for table in tables if table != STAGING_TABLE]
+            logging.info(tables)
+
+            for table in tables:
+                blob_to_geom(
+                db_path=session,
+                tbl_name=table,
+                blob_field="geometry",
+                geom_field="geom",   
+            )
 
 
 def view_duckdb():
@@ -84,41 +86,40 @@ def create_id(tbl_study_area):
     con.close()
 
 def calculate_ar50_overlap(db_path, tbl_study_area, tbl_ar50="ar50_flate", id_field="identifikasjon_lokalId", ar50_field="ar50_bonitet"):
-    # Calculate area overlap for each Bonitet class
-    for area_class in range(1, 19):  # 1-18
-        logging.info(f"Calculating Bonitet class {area_class}")
-        new_field = f"ar50_bon{area_class}_m2"
-        remove_field(db_path, tbl_study_area, new_field)
-        ar50_area_class(db_path, tbl_study_area, id_field, tbl_ar50, ar50_field, area_class, new_field)
-
-    # Set null ar50_bonx fields to 0
-    with duckdb.connect(db_path) as con:
-        con.install_extension('spatial')
-        con.load_extension('spatial')
-        for area_class in range(1, 19):  # 1-18
-            new_field = f"ar50_bon{area_class}_m2"
-            con.execute(f"UPDATE {tbl_study_area} SET {new_field} = 0 WHERE {new_field} IS NULL")
+    # Calculate area overlap for all Bonitet classes (1-18) in a single pass
+    logging.info("Calculating Bonitet classes 1-18")
+    area_class_overlay(
+        db_path,
+        tbl_study_area,
+        id_field,
+        tbl_ar50,
+        ar50_field,
+        area_classes=list(range(1, 19)),
+        field_template="ar50_bon{}_m2",
+    )
 
 
 def display_ar50_stats(db_path, tbl_study_area, id_field):
     
+    # one connection for all helper calls
+    session = DuckSession(db_path)
+
     # print as dataframe
-    con = duckdb.connect(db_path)
-    df = con.execute(f"SELECT * FROM {tbl_study_area}").fetchdf()
+    df = session.sql(f"SELECT * FROM {tbl_study_area}").fetchdf()
     # Display initial data
     cols_ar50 = [col for col in df.columns if "ar50_bon" in col and col != "sum_ar50_bon_m2"]
     cols = [id_field] + cols_ar50
     logging.info(df[cols].head(5))
     
     # remove fields
-    remove_field(db_path, tbl_study_area, "sum_ar50_bon_m2")
-    remove_field(db_path, tbl_study_area, "areal_m2")
-    remove_field(db_path, tbl_study_area, "area_diff_m2")
+    remove_field(session, tbl_study_area, "sum_ar50_bon_m2")
+    remove_field(session, tbl_study_area, "areal_m2")
+    remove_field(session, tbl_study_area, "area_diff_m2")
     
     # Sum of all bonitet classes and other calculations
-    sum_area_cols(db_path, tbl_study_area, id_field, cols_ar50, "sum_ar50_bon_m2")
-    geom_area(db_path, tbl_study_area, "geom", "areal_m2")
-    area_difference(db_path, tbl_study_area, "sum_ar50_bon_m2", "areal_m2", "area_diff_m2")
+    sum_area_cols(session, tbl_study_area, id_field, cols_ar50, "sum_ar50_bon_m2")
+    geom_area(session, tbl_study_area, "geom", "areal_m2")
+    area_difference(session, tbl_study_area, "sum_ar50_bon_m2", "areal_m2", "area_diff_m2")
 
     # Final display of data
     cols = [id_field] + ["sum_ar50_bon_m2", "areal_m2", "area_diff_m2"]
@@ -128,7 +129,7 @@ def display_ar50_stats(db_path, tbl_study_area, id_field):
     logging.info(f"Number of unique ids: {df_ar50[id_field].nunique()}")
     
     # close
-    con.close()
+    session.close()
 
 
 def export(db_path, db_table, gpkg_path, csv_path, crs = "EPSG:25833"):
@@ -141,19 +142,8 @@ def export(db_path, db_table, gpkg_path, csv_path, crs = "EPSG:25833"):
         csv_path (_type_): path to csv file
         crs (string): EPSG code. Defaults to "EPSG:25833".
     """
-    from shapely import wkt
-    con = duckdb.connect(db_path)
-    con.install_extension('spatial')
-    con.load_extension('spatial')
-
-    # to dataframe  
-    df = con.execute(f"SELECT ST_AsText(geom) as geometry, * FROM {db_table}").fetchdf()
-    df = df.drop(columns=["geom"])
-
-    # Convert the geom column to gpd GeoDataFrame
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = gpd.GeoDataFrame(df, geometry='geometry')
-    gdf.crs = crs
+    # geometries as WKB through Arrow (see my_duckdb.area_vars.export_toGDF)
+    gdf = export_toGDF(db_path, db_table, crs=crs)
     df_csv = gdf.drop(columns=["geometry"]) 
     
     # Export GDF to file 
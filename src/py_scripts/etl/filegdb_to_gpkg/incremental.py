@@ -0,0 +1,377 @@
+"""Incremental re-import of FileGDB layers into a GeoPackage.
+
+Every source layer is fingerprinted by feature count, extent, schema and a hash
+of (a sample of) its rows. The fingerprints are kept in a JSON state file next
+to the GeoPackage, and only layers whose fingerprint changed are imported again.
+
+Layers with a stable id field (e.g. identifikasjon_lokalId) are not re-imported
+as a whole: the row hash per id is kept in a Parquet file next to the state
+file, and only inserted, updated and deleted features are applied.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from py_scripts.etl.filegdb_to_gpkg.nodes import (
+    convert_layer,
+    merge_gpkg,
+    write_batches,
+)
+
+
+def _state_paths(gpkg_path):
+    """State file and folder with the row hashes of a GeoPackage."""
+    base = os.path.splitext(gpkg_path)[0]
+    return f"{base}.state.json", f"{base}.state"
+
+
+def _load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def _save_state(state_path, state):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def row_hashes(table):
+    """Hash every row (attributes and geometry WKB) of an Arrow table.
+
+    Args:
+      table: pyarrow Table or RecordBatch.
+
+    Returns:
+      np.ndarray: uint64 hash per row.
+    """
+    import pandas as pd
+
+    df = table.to_pandas()
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def layer_fingerprint(src_path, layer, row_hash="sample", sample_size=1000):
+    """Fingerprint a layer by feature count, extent, schema and row hash.
+
+    Args:
+      src_path: The path to the FileGDB.
+      layer: The name of the layer.
+      row_hash: "sample" hashes sample_size rows at 4 offsets in the layer,
+        "full" hashes all rows.
+      sample_size: Rows per sample.
+
+    Returns:
+      dict: fingerprint.
+    """
+    from pyogrio import read_info
+    from pyogrio.raw import open_arrow, read_arrow
+
+    info = read_info(src_path, layer=layer, force_feature_count=True)
+    n_features = int(info["features"])
+    digest = hashlib.sha256()
+
+    if row_hash == "full":
+        with open_arrow(src_path, layer=layer, use_pyarrow=True) as (meta, reader):
+            for batch in reader:
+                digest.update(row_hashes(batch).tobytes())
+    elif row_hash == "sample":
+        offsets = sorted({int(n_features * i / 4) for i in range(4)})
+        for offset in offsets:
+            if offset >= n_features:
+                continue
+            _, table = read_arrow(
+                src_path, layer=layer, skip_features=offset, max_features=sample_size
+            )
+            digest.update(row_hashes(table).tobytes())
+    else:
+        raise ValueError(f"Unknown row_hash {row_hash!r}, use 'sample' or 'full'.")
+
+    return {
+        "features": n_features,
+        "extent": [float(v) for v in info["total_bounds"]],
+        "fields": [str(field) for field in info["fields"]],
+        "dtypes": [str(dtype) for dtype in info["dtypes"]],
+        "geometry_type": info["geometry_type"],
+        "crs": info["crs"],
+        "row_hash": row_hash,
+        "hash": digest.hexdigest(),
+    }
+
+
+def _batch_hashes(batch, id_field):
+    """Row hashes of an Arrow record batch as a pd.Series by id."""
+    import pandas as pd
+
+    ids = batch.column(id_field).to_pandas()
+    return pd.Series(row_hashes(batch), index=ids.values)
+
+
+def _concat_hashes(hashes, id_field, layer):
+    import pandas as pd
+
+    new_hashes = pd.concat(hashes) if hashes else pd.Series(dtype="uint64")
+    if new_hashes.index.has_duplicates:
+        raise ValueError(f"Id field {id_field} of {layer} is not unique.")
+    return new_hashes
+
+
+def _source_changes(src_path, layer, id_field, old_hashes, batch_size):
+    """Stream the source and compare the row hash per id with the previous import.
+
+    The ids to delete include the inserted ids, so applying the changes again
+    after a crash before the state was saved does not duplicate rows.
+
+    Returns:
+      tuple: new hashes (pd.Series by id), ids to delete (deleted, updated and
+        inserted), inserted/updated rows (list of Arrow tables), geometry column
+        and counts per change type.
+    """
+    import pyarrow as pa
+    from pyogrio.raw import open_arrow
+
+    hashes, changed, changed_ids = [], [], []
+    n_inserted = n_updated = 0
+    source = open_arrow(src_path, layer=layer, batch_size=batch_size, use_pyarrow=True)
+    with source as (meta, reader):
+        geom_col = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            new = _batch_hashes(batch, id_field)
+            hashes.append(new)
+
+            old = old_hashes.reindex(new.index)
+            inserted = old.isna().to_numpy()
+            updated = ~inserted & (old.to_numpy() != new.to_numpy())
+            if inserted.any() or updated.any():
+                changed.append(
+                    pa.Table.from_batches([batch]).filter(inserted | updated)
+                )
+            n_inserted += int(inserted.sum())
+            n_updated += int(updated.sum())
+            changed_ids.extend(new.index[inserted | updated].tolist())
+
+    new_hashes = _concat_hashes(hashes, id_field, layer)
+    deleted_ids = old_hashes.index.difference(new_hashes.index).tolist()
+    counts = {
+        "inserted": n_inserted,
+        "updated": n_updated,
+        "deleted": len(deleted_ids),
+    }
+    return new_hashes, deleted_ids + changed_ids, changed, geom_col, counts
+
+
+def _apply_changes(
+    gpkg_path, layer, id_field, delete_ids, changed, geom_col, crs, to_crs
+):
+    """Delete the deleted/changed ids from the GeoPackage layer and append the
+    inserted/updated rows."""
+    # deleting rows does not need the GPKG SQL functions, plain sqlite3 works
+    conn = sqlite3.connect(gpkg_path)
+    try:
+        with conn:
+            conn.execute("CREATE TEMP TABLE _delete_ids (id)")
+            conn.executemany(
+                "INSERT INTO temp._delete_ids VALUES (?)", [(i,) for i in delete_ids]
+            )
+            conn.execute(
+                f'DELETE FROM "{layer}" WHERE "{id_field}" IN '
+                "(SELECT id FROM temp._delete_ids)"
+            )
+            conn.execute("DROP TABLE temp._delete_ids")
+    finally:
+        conn.close()
+
+    if not changed:
+        return
+    from pyogrio import read_info
+
+    # Arrow write path of convert_layer, so the field types of the layer are kept
+    schema = changed[0].schema
+    write_batches(
+        (batch for table in changed for batch in table.to_batches()),
+        schema,
+        gpkg_path,
+        layer,
+        geom_col=geom_col if geom_col in schema.names else None,
+        geometry_type=read_info(gpkg_path, layer=layer)["geometry_type"],
+        crs=crs,
+        to_crs=to_crs,
+        append=True,
+    )
+
+
+def _full_import(src_path, layer, gpkg_path, to_crs, batch_size, id_field=None):
+    """(Re-)import a whole layer through a temporary GeoPackage.
+
+    With id_field the row hashes per id are computed in the same read.
+
+    Returns:
+      tuple: number of features and the row hashes (pd.Series by id, or None).
+    """
+    hashes = []
+    on_batch = None
+    if id_field is not None:
+
+        def on_batch(batch):
+            hashes.append(_batch_hashes(batch, id_field))
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(gpkg_path)))
+    try:
+        tmp_gpkg = os.path.join(tmp_dir, "layer.gpkg")
+        _, n_features = convert_layer(
+            src_path, layer, tmp_gpkg, to_crs, batch_size, on_batch=on_batch
+        )
+        new_hashes = None
+        if id_field is not None:
+            new_hashes = _concat_hashes(hashes, id_field, layer)
+        merge_gpkg(tmp_gpkg, gpkg_path, layer)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return n_features, new_hashes
+
+
+def _layer_exists(gpkg_path, layer):
+    from pyogrio import list_layers
+
+    if not os.path.exists(gpkg_path):
+        return False
+    return layer in [str(name) for name, _ in list_layers(gpkg_path)]
+
+
+def incremental_import(
+    src_path,
+    layer,
+    gpkg_path,
+    id_field=None,
+    row_hash="sample",
+    to_crs=None,
+    batch_size=65536,
+):
+    """Import a FileGDB layer into a GeoPackage only if it changed.
+
+    Args:
+      src_path: The path to the FileGDB.
+      layer: The name of the layer, also the name in the GeoPackage.
+      gpkg_path: The path to the GeoPackage.
+      id_field: Optional stable id field, e.g. "identifikasjon_lokalId". Only
+        inserted, updated and deleted features are applied.
+      row_hash: "sample" or "full" row hash in the fingerprint. A sample is
+        cheaper, but can miss edits that keep count, extent and schema.
+      to_crs: Optional CRS to reproject to, e.g. "EPSG:25833".
+      batch_size: Features per batch.
+
+    Returns:
+      dict: status ("unchanged", "imported" or "applied") and counts.
+    """
+    import pandas as pd
+
+    state_path, hash_dir = _state_paths(gpkg_path)
+    state = _load_state(state_path)
+    key = f"{os.path.abspath(src_path)}::{layer}"
+    fingerprint = layer_fingerprint(src_path, layer, row_hash)
+    fingerprint["to_crs"] = to_crs
+
+    exists = _layer_exists(gpkg_path, layer)
+    previous = state.get(key, {})
+    if exists and previous.get("fingerprint") == fingerprint:
+        print(f"Layer {layer} unchanged. Skipping.")
+        return {"status": "unchanged"}
+
+    hash_path = os.path.join(hash_dir, f"{layer}.parquet")
+    incremental = (
+        id_field is not None
+        and exists
+        and os.path.exists(hash_path)
+        and previous.get("id_field") == id_field
+        and previous.get("fingerprint", {}).get("fields") == fingerprint["fields"]
+        and previous.get("fingerprint", {}).get("to_crs") == to_crs
+    )
+
+    if incremental:
+        old_hashes = pd.read_parquet(hash_path)["hash"]
+        new_hashes, delete_ids, changed, geom_col, counts = _source_changes(
+            src_path, layer, id_field, old_hashes, batch_size
+        )
+        _apply_changes(
+            gpkg_path,
+            layer,
+            id_field,
+            delete_ids,
+            changed,
+            geom_col,
+            fingerprint["crs"],
+            to_crs,
+        )
+        result = dict(status="applied", **counts)
+        print(
+            f"Layer {layer}: {counts['inserted']} inserted, "
+            f"{counts['updated']} updated, {counts['deleted']} deleted."
+        )
+    else:
+        n_features, new_hashes = _full_import(
+            src_path, layer, gpkg_path, to_crs, batch_size, id_field
+        )
+        result = {"status": "imported", "features": n_features}
+        print(f"Layer {layer} imported ({n_features} features).")
+
+    if id_field is not None:
+        os.makedirs(hash_dir, exist_ok=True)
+        new_hashes.rename("hash").rename_axis("id").to_frame().to_parquet(hash_path)
+
+    state[key] = {
+        "fingerprint": fingerprint,
+        "id_field": id_field,
+        "imported_at": time.time(),
+    }
+    _save_state(state_path, state)
+    return result
+
+
+def incremental_catalog(catalog, gpkg_path, keys=None, row_hash="sample", to_crs=None):
+    """Incrementally import the FileGDB layers of the data catalog.
+
+    Catalog entries of type filegdb need a filepath and a layer. An optional
+    id_field enables applying only the changed features.
+
+    Args:
+      catalog: The loaded catalog (see py_scripts.config.load_catalog).
+      gpkg_path: The path to the GeoPackage.
+      keys: Optional catalog keys, defaults to all filegdb entries.
+      row_hash: "sample" or "full" row hash in the fingerprint.
+      to_crs: Optional CRS to reproject to, e.g. "EPSG:25833".
+
+    Returns:
+      dict: result per catalog key.
+    """
+    keys = keys or [
+        key
+        for key, entry in catalog.items()
+        if isinstance(entry, dict) and entry.get("type") == "filegdb"
+    ]
+    results = {}
+    for key in keys:
+        entry = catalog[key]
+        results[key] = incremental_import(
+            entry["filepath"],
+            entry["layer"],
+            gpkg_path,
+            id_field=entry.get("id_field"),
+            row_hash=row_hash,
+            to_crs=to_crs,
+        )
+    return results
+
+
+if __name__ == "__main__":
+    from py_scripts.config import load_catalog
+
+    gpkg_path = input("path/to/gpkg:")
+    incremental_catalog(load_catalog(), gpkg_path)
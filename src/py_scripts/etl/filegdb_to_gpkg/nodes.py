@@ -1,52 +1,233 @@
-import os
+"""Nodes for converting the layers of a FileGDB to a GeoPackage.
 
-import fiona
-import geopandas as gpd
+Layers are converted concurrently by a bounded pool of worker processes. Each
+worker streams its layer in Arrow batches (optionally reprojected) into its own
+temporary GeoPackage, because SQLite allows only one writer. The temporary
+GeoPackages are merged into the output GeoPackage by the main process.
+"""
 
-# TODO add optional multithreading
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def fc_to_gdf(filegdb_path):
-    """Copies data from a FileGDB to a Geopackage.
+def list_layers(filegdb_path):
+    """List the layers of a FileGDB.
 
     Args:
       filegdb_path: The path to the FileGDB.
-      gpkg_path: The path to the Geopackage.
+
+    Returns:
+      list: layer names
     """
+    from pyogrio import list_layers as pyogrio_list_layers
 
-    # check if file exits
-    print(f"Path exists {os.path.exists(filegdb_path)}")
-    gdb_name = os.path.basename(filegdb_path)
+    if not os.path.exists(filegdb_path):
+        raise FileNotFoundError(f"FileGDB not found: {filegdb_path}")
 
-    # Open the FileGDB and Geopackage.
-    layers = fiona.listlayers(filegdb_path)
+    layers = [str(name) for name, _ in pyogrio_list_layers(filegdb_path)]
+    gdb_name = os.path.basename(filegdb_path)
     print(f"FileGDB <{gdb_name}> contains n={len(layers)} layers.")
-    dict_gdf = {}
-    for layer in layers:
-        print(f"Adding {layer} to dict.")
-        gdf = gpd.read_file(filegdb_path, layer=layer)[:5]
-        dict_gdf[layer] = gdf
-        # dict_gdf[layer] = gdf[["TREE_ID"]]
-        break
+    return layers
+
+
+def _reproject_batch(batch, geom_col, crs, to_crs):
+    """Reproject the WKB geometry column of an Arrow record batch."""
+    import geopandas as gpd
+    import pyarrow as pa
+    import shapely
+
+    i = batch.schema.get_field_index(geom_col)
+    wkb = batch.column(i).to_numpy(zero_copy_only=False)
+    geoms = gpd.GeoSeries.from_wkb(wkb, crs=crs).to_crs(to_crs)
+    columns = batch.columns
+    columns[i] = pa.array(shapely.to_wkb(geoms.values), type=batch.schema.field(i).type)
+    return pa.RecordBatch.from_arrays(columns, schema=batch.schema)
+
+
+def write_batches(
+    batches,
+    schema,
+    gpkg_path,
+    layer,
+    geom_col=None,
+    geometry_type=None,
+    crs=None,
+    to_crs=None,
+    append=False,
+):
+    """Stream Arrow record batches into a GeoPackage layer.
+
+    The layer is created from the Arrow schema, so the field types of the
+    source are kept (e.g. int64 fields with nulls), instead of being inferred
+    from the first batch of a DataFrame.
+
+    Args:
+      batches: Iterable of pyarrow RecordBatches with the schema.
+      schema: pyarrow Schema of the batches.
+      gpkg_path: The path to the GeoPackage.
+      layer: The name of the layer.
+      geom_col: Name of the WKB geometry column, None for attribute tables.
+      geometry_type: Geometry type of the layer, e.g. "MultiPolygon".
+      crs: CRS of the geometries.
+      to_crs: Optional CRS to reproject to, e.g. "EPSG:25833".
+      append: Append to an existing layer.
+
+    Returns:
+      int: number of written features.
+    """
+    import pyarrow as pa
+    from pyogrio.raw import write_arrow
+
+    n_features = 0
+
+    def stream():
+        nonlocal n_features
+        for batch in batches:
+            if to_crs is not None and geom_col is not None and crs is not None:
+                batch = _reproject_batch(batch, geom_col, crs, to_crs)
+            n_features += batch.num_rows
+            yield batch
+
+    write_arrow(
+        pa.RecordBatchReader.from_batches(schema, stream()),
+        gpkg_path,
+        layer=layer,
+        driver="GPKG",
+        geometry_name=geom_col,
+        geometry_type=geometry_type if geom_col is not None else None,
+        crs=(to_crs or crs) if geom_col is not None else None,
+        append=append,
+    )
+    return n_features
+
+
+def _tap(batches, on_batch):
+    for batch in batches:
+        on_batch(batch)
+        yield batch
 
-    return dict_gdf
 
+def convert_layer(
+    filegdb_path, layer, gpkg_path, to_crs=None, batch_size=65536, on_batch=None
+):
+    """Stream one layer of a FileGDB into a GeoPackage in Arrow batches.
 
-def gdf_to_gpkg(dict_gdf, gpkg_path, spatial_reference="EPSG"):
-    if not os.path.exists(gpkg_path):
-        from pygeopkg.core.geopkg import GeoPackage
+    Args:
+      filegdb_path: The path to the FileGDB.
+      layer: The name of the layer.
+      gpkg_path: The path to the (temporary) GeoPackage.
+      to_crs: Optional CRS to reproject to, e.g. "EPSG:25833".
+      batch_size: Features per batch.
+      on_batch: Optional callable, called with every source batch before it is
+        written, e.g. to hash the rows in the same read.
+
+    Returns:
+      tuple: layer name and number of features.
+    """
+    from pyogrio import read_info
+    from pyogrio.raw import open_arrow
+
+    # geometry type of the source, instead of inferring it per batch
+    geometry_type = read_info(filegdb_path, layer=layer)["geometry_type"]
+    with open_arrow(
+        filegdb_path, layer=layer, batch_size=batch_size, use_pyarrow=True
+    ) as (meta, reader):
+        geom_col = meta["geometry_name"] or "wkb_geometry"
+        if geom_col not in reader.schema.names:
+            # attribute table without geometry
+            geom_col = None
+        n_features = write_batches(
+            reader if on_batch is None else _tap(reader, on_batch),
+            reader.schema,
+            gpkg_path,
+            layer,
+            geom_col=geom_col,
+            geometry_type=geometry_type,
+            crs=meta["crs"],
+            to_crs=to_crs,
+        )
+
+    return layer, n_features
+
+
+def merge_gpkg(src_gpkg, gpkg_path, layer):
+    """Copy a layer of a (temporary) GeoPackage into the output GeoPackage.
+
+    Args:
+      src_gpkg: The path to the GeoPackage with the layer.
+      gpkg_path: The path to the output GeoPackage.
+      layer: The name of the layer.
+    """
+    from osgeo import gdal
+
+    gdal.UseExceptions()
+    # overwrite the layer if the output GeoPackage exists
+    access_mode = "overwrite" if os.path.exists(gpkg_path) else None
+    gdal.VectorTranslate(
+        gpkg_path,
+        src_gpkg,
+        format="GPKG",
+        accessMode=access_mode,
+        layers=[layer],
+        layerName=layer,
+    )
+
+
+def filegdb_to_gpkg(
+    filegdb_path,
+    gpkg_path,
+    layers=None,
+    to_crs=None,
+    workers=4,
+    batch_size=65536,
+):
+    """Convert the layers of a FileGDB to a GeoPackage with a pool of workers.
+
+    Args:
+      filegdb_path: The path to the FileGDB.
+      gpkg_path: The path to the output GeoPackage.
+      layers: Optional list of layers, defaults to all layers.
+      to_crs: Optional CRS to reproject to, e.g. "EPSG:25833".
+      workers: Number of worker processes.
+      batch_size: Features per batch.
+
+    Returns:
+      dict: number of features per layer.
+    """
+    layers = layers or list_layers(filegdb_path)
+    out_dir = os.path.dirname(os.path.abspath(gpkg_path))
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
 
-        GeoPackage.create(gpkg_path, flavor=spatial_reference)
-        gpkg_name = os.path.basename(gpkg_path)
-        print(f"Created GPKG: {gpkg_name}")
+    n_features = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    convert_layer,
+                    filegdb_path,
+                    layer,
+                    os.path.join(tmp_dir, f"{i}.gpkg"),
+                    to_crs,
+                    batch_size,
+                ): os.path.join(tmp_dir, f"{i}.gpkg")
+                for i, layer in enumerate(layers)
+            }
+            # merge each layer as soon as it is converted (single writer)
+            for n, future in enumerate(as_completed(futures), start=1):
+                layer, count = future.result()
+                merge_gpkg(futures[future], gpkg_path, layer)
+                os.remove(futures[future])
+                n_features[layer] = count
+                print(f"Layer {n}/{len(layers)} converted: {layer} ({count} features)")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    for key, gdf in dict_gdf:
-        gdf.to_file(gpkg_path, layer=gdf, driver="GPKG")
-    return
+    return n_features
 
 
 if __name__ == "__main__":
     filegdb_path = input("path/to/gdb:")
     gpkg_path = input("path/to/gpkg:")
-    dict_gdf = fc_to_gdf(filegdb_path)
-    gdf_to_gpkg(dict_gdf, gpkg_path)
+    filegdb_to_gpkg(filegdb_path, gpkg_path)
@@ -1,11 +1,19 @@
-from src.filegdb_to_gpkg.nodes import fc_to_gdf, gdf_to_gpkg
+from py_scripts.etl.filegdb_to_gpkg.nodes import filegdb_to_gpkg
 
 
-def pipeline(filegdb_path, gpkg_path):
-    dict_gdf = fc_to_gdf(filegdb_path)
-    gdf_to_gpkg(dict_gdf, gpkg_path)
+def pipeline(
+    filegdb_path, gpkg_path, layers=None, to_crs=None, workers=4, batch_size=65536
+):
+    n_features = filegdb_to_gpkg(
+        filegdb_path,
+        gpkg_path,
+        layers=layers,
+        to_crs=to_crs,
+        workers=workers,
+        batch_size=batch_size,
+    )
 
-    return
+    return n_features
 
 
 if __name__ == "__main__":
@@ -4,8 +4,14 @@ Main Script
 This script servers as the entry point
 for the sub-packages and modules of the project.
 """
+import json
 import logging
+import math
 import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Add project root to path
@@ -26,19 +32,30 @@ logger = logging.getLogger(__name__)
 
 
 # GET FEATURE
-def to_geojson(url, layer, output_dir):
+def to_geojson(url, layer, output_dir, stream=True, convert=None, batch_size=10000):
     """request data from geonode and save as geojson
 
     Args:
         url (str): url to geonode endpoint
         layer (str): layer name
+        output_dir (str): output folder
+        stream (bool): write the response to disk in chunks and validate the
+            features with an iterative parser (see stream_geojson), instead of
+            loading and dumping the whole document
+        convert (str): with stream, also convert to "Parquet" or "GPKG"
+        batch_size (int): features per batch of the conversion
 
     Raises:
         Exception: Failed to download WFS data: {response.status_code}
 
     Returns:
-        _type_: _description_
+        str: filename of the geojson file, None if it was not saved
     """
+    if stream:
+        return stream_geojson(
+            url, layer, output_dir, convert=convert, batch_size=batch_size
+        )
+
     import geojson
     import requests
 
@@ -82,6 +99,447 @@ def to_geojson(url, layer, output_dir):
         return output
 
 
+def validate_feature(feature):
+    """check the structure of a GeoJSON feature
+
+    Returns:
+        bool: True for a feature with a geometry (or null) and properties
+    """
+    if not isinstance(feature, dict) or feature.get("type") != "Feature":
+        return False
+    geometry = feature.get("geometry")
+    if geometry is not None and (
+        not isinstance(geometry, dict)
+        or "type" not in geometry
+        or ("coordinates" not in geometry and "geometries" not in geometry)
+    ):
+        return False
+    properties = feature.get("properties")
+    return properties is None or isinstance(properties, dict)
+
+
+def _write_batch(features, crs, output_path, layer_name, fmt, part):
+    import geopandas as gpd
+    from pyogrio import write_dataframe
+
+    gdf = gpd.GeoDataFrame.from_features(features, crs=crs)
+    if fmt == "GPKG":
+        # a "fid" attribute would become the FID column of the GeoPackage
+        layer_options = {"FID": "gpkg_fid"} if "fid" in gdf.columns else None
+        write_dataframe(
+            gdf,
+            output_path,
+            layer=layer_name,
+            driver="GPKG",
+            append=part > 0,
+            promote_to_multi=True,
+            layer_options=layer_options,
+        )
+    else:
+        os.makedirs(output_path, exist_ok=True)
+        gdf.to_parquet(os.path.join(output_path, f"part_{part:06d}.parquet"))
+
+
+def stream_geojson(url, layer, output_dir, convert=None, batch_size=10000):
+    """request data from geonode and stream it to a geojson file
+
+    The response body is written to disk in chunks (iter_content), then the
+    features are read back one by one with ijson to validate them and,
+    optionally, convert them in batches to GeoParquet or GeoPackage. Memory
+    holds one chunk or one batch of features, not the whole layer.
+
+    Args:
+        url (str): url to geonode endpoint
+        layer (str): layer name
+        output_dir (str): output folder
+        convert (str): None, "Parquet" (folder with one part per batch) or "GPKG"
+        batch_size (int): features per batch of the conversion
+
+    Returns:
+        str: filename of the geojson file, None if it was not saved
+    """
+    import ijson
+    import requests
+
+    if convert not in (None, "Parquet", "GPKG"):
+        raise ValueError(f"Unknown format {convert!r}, use 'Parquet' or 'GPKG'.")
+
+    params = {
+        "service": "WFS",
+        "request": "GetFeature",
+        "typeName": layer,
+        "outputFormat": "json",
+    }
+    layer_name = layer.replace(":", "_")
+    filename = f"{layer_name}.geojson"
+    path = os.path.join(output_dir, filename)
+    tmp_path = f"{path}.tmp"
+    tmp_output = None
+
+    try:
+        with requests.get(url, params=params, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(
+                    "Failed to download WFS data: {}".format(response.status_code)
+                )
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+
+        crs = None
+        if convert is not None:
+            from pyogrio import read_info
+
+            crs = read_info(path)["crs"]
+            ext = "gpkg" if convert == "GPKG" else "parquet"
+            output_path = os.path.join(output_dir, f"{layer_name}.{ext}")
+            # convert to a temporary output, swapped in when complete
+            tmp_output = os.path.join(output_dir, f"{layer_name}.tmp.{ext}")
+            _remove_output(tmp_output)
+
+        n_features = n_invalid = part = 0
+        batch = []
+        with open(path, "rb") as f:
+            for feature in ijson.items(f, "features.item", use_float=True):
+                if not validate_feature(feature):
+                    n_invalid += 1
+                    continue
+                n_features += 1
+                if convert is not None:
+                    batch.append(feature)
+                    if len(batch) == batch_size:
+                        _write_batch(batch, crs, tmp_output, layer_name, convert, part)
+                        batch, part = [], part + 1
+        if convert is not None and batch:
+            _write_batch(batch, crs, tmp_output, layer_name, convert, part)
+        if convert is not None and n_features:
+            # no stale parts of an earlier, larger download are kept
+            _remove_output(output_path)
+            os.replace(tmp_output, output_path)
+
+        if n_invalid:
+            logger.warning(f"{layer}: {n_invalid} invalid features")
+        logger.info("Saved geojson file: %s (%s features)", filename, n_features)
+        return filename
+    except Exception as e:
+        logger.error(f"Raised Exception: {e}")
+        logger.error(f"{layer} not saved")
+        output = None
+        logger.info(f"Returned: - End function {output!r}")
+
+        return output
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if tmp_output is not None:
+            _remove_output(tmp_output)
+
+
+# PAGED GET FEATURE (WFS 2.0)
+def wfs_session(pool_size=8, retries=3):
+    """requests session with a connection pool and retries, shared by threads
+
+    Args:
+        pool_size (int): max connections per host
+        retries (int): retries of failed requests (connection errors, 5xx)
+
+    Returns:
+        requests.Session: session
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retry = Retry(
+        total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def feature_count(session, url, layer):
+    """number of features of a layer (WFS 2.0 resultType=hits)
+
+    Returns:
+        int: number of features, or None if the server does not report it
+    """
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "GetFeature",
+        "typeNames": layer,
+        "resultType": "hits",
+    }
+    response = session.get(url, params=params, timeout=60)
+    response.raise_for_status()
+    match = re.search(r'numberMatched="(\d+)"', response.text)
+    return int(match.group(1)) if match else None
+
+
+# attributes used as stable paging order, in order of preference
+ID_FIELDS = ("fid", "id", "ogc_fid", "gid", "objectid")
+
+
+def default_sort_by(session, url, layer):
+    """id attribute of a layer for a stable paging order (WFS DescribeFeatureType)
+
+    WFS 2.0 does not guarantee the same order of features for every request
+    without sortBy, so parallel startIndex paging could skip or repeat features.
+
+    Returns:
+        str: first attribute of ID_FIELDS in the layer, None if there is none
+    """
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "DescribeFeatureType",
+        "typeNames": layer,
+    }
+    response = session.get(url, params=params, timeout=60)
+    response.raise_for_status()
+    names = {
+        name.lower(): name
+        for name in re.findall(r'<(?:\w+:)?element[^>]*\bname="([^"]+)"', response.text)
+    }
+    for field in ID_FIELDS:
+        if field in names:
+            return names[field]
+    return None
+
+
+def _page_path(page_dir, start_index):
+    return os.path.join(page_dir, f"page_{start_index:012d}.geojson")
+
+
+def _prepare_page_dir(page_dir, paging, max_age):
+    """keep the pages of an earlier run only if they were requested the same way
+
+    Pages of a run with other paging parameters (page size, sort order, number
+    of features) or older than max_age seconds are removed.
+    """
+    state_path = os.path.join(page_dir, "paging.json")
+    if os.path.isdir(page_dir):
+        state = None
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        if (
+            state is None
+            or state["paging"] != paging
+            or time.time() - state["created"] > max_age
+        ):
+            shutil.rmtree(page_dir)
+    if not os.path.isdir(page_dir):
+        os.makedirs(page_dir)
+        with open(state_path, "w") as f:
+            json.dump({"paging": paging, "created": time.time()}, f)
+
+
+def fetch_page(session, url, layer, start_index, page_size, page_dir, sort_by=None):
+    """download one page of features to a GeoJSON file in page_dir
+
+    Pages that were downloaded before are not requested again (resume). The
+    response is streamed to a temporary file, which is renamed when complete.
+
+    Returns:
+        str: path to the page file
+    """
+    path = _page_path(page_dir, start_index)
+    if os.path.exists(path):
+        return path
+
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "GetFeature",
+        "typeNames": layer,
+        "outputFormat": "application/json",
+        "count": page_size,
+        "startIndex": start_index,
+    }
+    if sort_by:
+        params["sortBy"] = sort_by
+
+    with session.get(url, params=params, stream=True, timeout=300) as response:
+        if response.status_code != 200:
+            raise Exception(
+                "Failed to download WFS data: {}".format(response.status_code)
+            )
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _page_features(path):
+    from pyogrio import read_info
+
+    return read_info(path)["features"]
+
+
+def _write_pages(pages, output_path, layer_name, fmt):
+    """stream the page files into a GeoPackage layer or a GeoParquet folder"""
+    from pyogrio import read_dataframe, write_dataframe
+
+    n_features = 0
+    for i, page in enumerate(pages):
+        if _page_features(page) == 0:
+            continue
+        gdf = read_dataframe(page)
+        if fmt == "GPKG":
+            # a "fid" attribute would become the FID column of the GeoPackage
+            layer_options = {"FID": "gpkg_fid"} if "fid" in gdf.columns else None
+            write_dataframe(
+                gdf,
+                output_path,
+                layer=layer_name,
+                driver="GPKG",
+                append=n_features > 0,
+                promote_to_multi=True,
+                layer_options=layer_options,
+            )
+        else:
+            os.makedirs(output_path, exist_ok=True)
+            gdf.to_parquet(os.path.join(output_path, f"part_{i:06d}.parquet"))
+        n_features += len(gdf)
+    return n_features
+
+
+def _remove_output(path):
+    """remove a GeoPackage file or a GeoParquet folder if it exists"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def download_layer(
+    url,
+    layer,
+    output_path,
+    fmt="GPKG",
+    page_size=10000,
+    workers=4,
+    sort_by="auto",
+    session=None,
+    resume_max_age=24 * 3600,
+):
+    """download a WFS layer in pages and write it to a GeoPackage or GeoParquet
+
+    Pages are requested with WFS 2.0 count/startIndex by a pool of threads over
+    one pooled session, and kept in <output_path>.pages until the layer is
+    complete, so an interrupted download resumes with the missing pages. The
+    pages are only reused for the same page size, sort order and number of
+    features. The previous output is only replaced by a download with features.
+
+    Args:
+        url (str): url to geonode WFS endpoint
+        layer (str): layer name
+        output_path (str): GeoPackage (fmt="GPKG") or GeoParquet folder
+            (fmt="Parquet", one part file per page)
+        fmt (str): "GPKG" or "Parquet"
+        page_size (int): features per request
+        workers (int): concurrent requests
+        sort_by (str): attribute for a stable paging order, e.g. "fid". "auto"
+            uses the id attribute of the layer (see default_sort_by)
+        session (requests.Session): shared session, see wfs_session
+        resume_max_age (float): max age in seconds of pages to resume from
+
+    Returns:
+        int: number of features
+    """
+    if fmt not in ("GPKG", "Parquet"):
+        raise ValueError(f"Unknown format {fmt!r}, use 'GPKG' or 'Parquet'.")
+    session = session or wfs_session(pool_size=workers)
+    layer_name = layer.replace(":", "_")
+    if sort_by == "auto":
+        sort_by = default_sort_by(session, url, layer)
+    if not sort_by:
+        logger.warning(f"{layer}: no sort_by, the order of the pages is not guaranteed")
+    n_matched = feature_count(session, url, layer)
+    page_dir = f"{output_path}.pages"
+    paging = {
+        "layer": layer,
+        "page_size": page_size,
+        "sort_by": sort_by,
+        "matched": n_matched,
+    }
+    _prepare_page_dir(page_dir, paging, resume_max_age)
+
+    def fetch(start_index):
+        return fetch_page(
+            session, url, layer, start_index, page_size, page_dir, sort_by
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if n_matched is not None:
+            starts = [i * page_size for i in range(math.ceil(n_matched / page_size))]
+            pages = list(executor.map(fetch, starts))
+        else:
+            # unknown count: request pages in waves until a page is not full
+            pages, start = [], 0
+            while True:
+                starts = [start + i * page_size for i in range(workers)]
+                wave = list(executor.map(fetch, starts))
+                pages.extend(wave)
+                start = starts[-1] + page_size
+                if any(_page_features(page) < page_size for page in wave):
+                    break
+    logger.info(f"Downloaded {len(pages)} pages of {layer}")
+
+    # write to a temporary output first, a partial output is never left behind
+    if fmt == "GPKG":
+        tmp_output = f"{os.path.splitext(output_path)[0]}.tmp.gpkg"
+    else:
+        tmp_output = f"{output_path}.tmp"
+    _remove_output(tmp_output)
+    try:
+        n_features = _write_pages(pages, tmp_output, layer_name, fmt)
+        if n_features:
+            if fmt == "Parquet":
+                _remove_output(output_path)
+            os.replace(tmp_output, output_path)
+            logger.info(f"Saved {n_features} features of {layer} to {output_path}")
+        else:
+            logger.warning(f"No features of {layer}, {output_path} not replaced")
+    finally:
+        _remove_output(tmp_output)
+    shutil.rmtree(page_dir, ignore_errors=True)
+    return n_features
+
+
+def download_layers(url, layers, output_dir, fmt="GPKG", layer_workers=2, **kwargs):
+    """download several WFS layers at once, see download_layer
+
+    Returns:
+        dict: number of features per layer (None if the download failed)
+    """
+    ext = "gpkg" if fmt == "GPKG" else "parquet"
+    session = wfs_session(pool_size=layer_workers * kwargs.get("workers", 4))
+
+    def download(layer):
+        output_path = os.path.join(output_dir, f"{layer.replace(':', '_')}.{ext}")
+        try:
+            return download_layer(
+                url, layer, output_path, fmt=fmt, session=session, **kwargs
+            )
+        except Exception as e:
+            logger.error(f"Raised Exception: {e}")
+            logger.error(f"{layer} not saved")
+            return None
+
+    with ThreadPoolExecutor(max_workers=layer_workers) as executor:
+        return dict(zip(layers, executor.map(download, layers)))
+
+
 if __name__ == "__main__":
     catalog = load_catalog()
     layers = catalog["urban-geonode"]["layers"]
@@ -89,6 +547,4 @@ if __name__ == "__main__":
     output_dir = catalog["urban-geonode"]["filepath"]
     wfs = catalog["urban-geonode"]["wfs"]
 
-    for layer in layers:
-        layer_str = str(layer)
-        to_geojson(wfs, layer_str, output_dir)
+    download_layers(wfs, [str(layer) for layer in layers], output_dir)
@@ -8,6 +8,10 @@ Package with helper modules based on DuckDB library.
 from .area_overlay import *
 from .area_vars import *
 from .geom import *
+from .index import *
 from .join import *    
 from .load import *
+from .session import *
+from .staging import *
+from .tiling import *
 from .utils import *
\ No newline at end of file
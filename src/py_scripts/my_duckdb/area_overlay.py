@@ -2,31 +2,36 @@
 Module for calculating the area of overlap between two spatial datasets.
 """
 
-import duckdb
 from typing import Union, List
 
+from .index import bbox_overlap, bbox_source, prefilter_report
+from .session import DuckSession, get_connection
+
 
 def bioklima_area_class(
-    db_path: str,
+    db_path: Union[str, DuckSession],
     tbl_study_area: str,
     id: str,
     tbl_bioklima: str,
     bioklima_field: str,
     area_class: Union[str, List[str]],
     new_field: str,
+    report_prefilter: bool = False,
 ) -> None:
     """Calculate the area of overlap between the study area and
     the Bioklima area class. The area of overlap is calculated for each study area polygon defined
     by the id field and area class. The result is stored in the new field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_study_area (str): Name of the study area table.
         id (str): ID field name.
         tbl_bioklima (str): Name of the Bioklima table.
         bioklima_field (str): Bioklima field name.
         area_class (Union[str, List[str]]): Area class or list of area classes.
         new_field (str): Name of the new field to store the result.
+        report_prefilter (bool, optional): Print the number of pairs removed by the
+            bbox pre-filter. Defaults to False.
     """
     # convert list to string
     area_class_str = (
@@ -36,21 +41,26 @@ def bioklima_area_class(
     )
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
+        with get_connection(db_path) as conn:
+            if report_prefilter:
+                prefilter_report(
+                    conn,
+                    tbl_study_area,
+                    tbl_bioklima,
+                    where_b=f"b.{bioklima_field} IN ({area_class_str})",
+                )
 
             # Create a temp table with the sum of the overlapping areas
             conn.sql(
                 f"""
-                CREATE TEMPORARY TABLE tbl_sum_bioklima AS
+                CREATE OR REPLACE TEMPORARY TABLE tbl_sum_bioklima AS
                 SELECT
                     study_area.{id},
                     SUM( ST_Area( ST_Intersection( study_area.geom, bioklima_overlap.geom ) ) ) as sum
                 FROM
-                    {tbl_study_area} as study_area,
-                    {tbl_bioklima} as bioklima_overlap
+                    {bbox_source(tbl_study_area)} as study_area
+                    JOIN {bbox_source(tbl_bioklima)} as bioklima_overlap
+                        ON {bbox_overlap("study_area", "bioklima_overlap")}
                 WHERE
                     bioklima_overlap.{bioklima_field} IN ({area_class_str}) AND
                     ST_Intersects( study_area.geom, bioklima_overlap.geom )
@@ -81,26 +91,29 @@ def bioklima_area_class(
 
 
 def ar50_area_class(
-    db_path: str,
+    db_path: Union[str, DuckSession],
     tbl_study_area: str,
     id: str,
     tbl_ar50: str,
     ar50_field: str,
     area_class: Union[int, List[int]],
     new_field: str,
+    report_prefilter: bool = False,
 ) -> None:
     """Calculate the area of overlap between the study area (e.g. protected areas) and
     the AR50 area class. The area of overlap is calculated for each study area polygon defined
     by the id field and area class. The result is stored in the new field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_study_area (str): Name of the study area table.
         id (str): ID field name.
         tbl_ar50 (str): Name of the AR50 table.
         ar50_field (str): AR50 field name.
         area_class (Union[int, List[int]]): Area class or list of area classes.
         new_field (str): Name of the new field to store the result.
+        report_prefilter (bool, optional): Print the number of pairs removed by the
+            bbox pre-filter. Defaults to False.
     """
     # convert int to string
     area_class_str = (
@@ -110,21 +123,26 @@ def ar50_area_class(
     )
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
+        with get_connection(db_path) as conn:
+            if report_prefilter:
+                prefilter_report(
+                    conn,
+                    tbl_study_area,
+                    tbl_ar50,
+                    where_b=f"b.{ar50_field} IN ({area_class_str})",
+                )
 
             # Create a temp table with the sum of the overlapping areas
             conn.sql(
                 f"""
-                CREATE TEMPORARY TABLE tbl_sum_ar50 AS
+                CREATE OR REPLACE TEMPORARY TABLE tbl_sum_ar50 AS
                 SELECT
                     study_area.{id},
                     SUM( ST_Area( ST_Intersection( study_area.geom, ar50_overlap.geom ) ) ) as sum
                 FROM
-                    {tbl_study_area} as study_area,
-                    {tbl_ar50} as ar50_overlap
+                    {bbox_source(tbl_study_area)} as study_area
+                    JOIN {bbox_source(tbl_ar50)} as ar50_overlap
+                        ON {bbox_overlap("study_area", "ar50_overlap")}
                 WHERE
                     ar50_overlap.{ar50_field} IN ({area_class_str}) AND
                     ST_Intersects( study_area.geom, ar50_overlap.geom )
@@ -154,15 +172,149 @@ def ar50_area_class(
         print(f"An error occurred: {e}")
 
 
+def _sql_literal(value: Union[int, float, str]) -> str:
+    """Format a class value as a SQL literal."""
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def _write_class_areas(conn, tbl_study_area, id, new_fields, overlap_sql):
+    """Pivot (id, class, area) rows into one field per class and write all class
+    fields to the study area table in one update. Study areas without overlap are 0.
+
+    Args:
+        conn (duckdb.DuckDBPyConnection): Open connection.
+        tbl_study_area (str): Name of the study area table.
+        id (str): ID field name.
+        new_fields (dict): {area class: new field name}.
+        overlap_sql (str): Query returning the fields id, class and area.
+    """
+    pivot_cols = ",\n".join(
+        f"SUM(area) FILTER (WHERE class = {_sql_literal(area_class)}) AS {field}"
+        for area_class, field in new_fields.items()
+    )
+
+    # pivot the classes into columns
+    conn.sql(
+        f"""
+        CREATE OR REPLACE TEMPORARY TABLE tbl_sum_classes AS
+        WITH overlap AS ({overlap_sql})
+        SELECT
+            {id},
+            {pivot_cols}
+        FROM overlap
+        GROUP BY {id}
+    """
+    )
+
+    # (re)create the class fields, study areas without overlap default to 0
+    columns = conn.table(tbl_study_area).columns
+    for field in new_fields.values():
+        if field in columns:
+            conn.sql(f"ALTER TABLE {tbl_study_area} DROP COLUMN {field}")
+        conn.sql(
+            f"""
+            ALTER TABLE {tbl_study_area}
+            ADD COLUMN {field} REAL DEFAULT 0
+        """
+        )
+
+    # Update all class fields in the study area table in one write
+    set_cols = ",\n".join(
+        f"{field} = COALESCE(tmp_classes.{field}, 0)" for field in new_fields.values()
+    )
+    conn.sql(
+        f"""
+        UPDATE {tbl_study_area} as study_area
+        SET {set_cols}
+        FROM tbl_sum_classes as tmp_classes
+        WHERE study_area.{id} = tmp_classes.{id}
+    """
+    )
+
+
+def area_class_overlay(
+    db_path: Union[str, DuckSession],
+    tbl_study_area: str,
+    id: str,
+    tbl_class: str,
+    class_field: str,
+    area_classes: List[Union[int, str]],
+    field_template: str = "area_{}_m2",
+    report_prefilter: bool = False,
+) -> None:
+    """Calculate the area of overlap between the study area and all area classes
+    in a single pass. The study area is intersected with the class table once, the
+    overlapping areas are grouped by (id, class) and pivoted into one column per class.
+    All class columns are written with a single update, areas without overlap are 0.
+
+    Replaces calling ar50_area_class/bioklima_area_class once per area class.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_study_area (str): Name of the study area table.
+        id (str): ID field name.
+        tbl_class (str): Name of the class table (e.g. AR50).
+        class_field (str): Class field name (e.g. ar50_bonitet).
+        area_classes (List[Union[int, str]]): List of area classes.
+        field_template (str, optional): Template for the new field names, formatted
+            with the area class. Defaults to "area_{}_m2".
+        report_prefilter (bool, optional): Print the number of pairs removed by the
+            bbox pre-filter. Defaults to False.
+
+    Example:
+        area_class_overlay(db_path, "plan_verneformal", "identifikasjon_lokalId",
+            "ar50_flate", "ar50_bonitet", list(range(1, 19)), "ar50_bon{}_m2")
+    """
+    new_fields = {
+        area_class: field_template.format(area_class) for area_class in area_classes
+    }
+    area_class_str = ", ".join(_sql_literal(item) for item in area_classes)
+
+    try:
+        with get_connection(db_path) as conn:
+            if report_prefilter:
+                prefilter_report(
+                    conn,
+                    tbl_study_area,
+                    tbl_class,
+                    where_b=f"b.{class_field} IN ({area_class_str})",
+                )
+
+            # Intersect once and sum the overlapping areas per (id, class)
+            overlap_sql = f"""
+                SELECT
+                    study_area.{id},
+                    class_overlap.{class_field} as class,
+                    SUM( ST_Area( ST_Intersection( study_area.geom, class_overlap.geom ) ) ) as area
+                FROM
+                    {bbox_source(tbl_study_area)} as study_area
+                    JOIN {bbox_source(tbl_class)} as class_overlap
+                        ON {bbox_overlap("study_area", "class_overlap")}
+                WHERE
+                    class_overlap.{class_field} IN ({area_class_str}) AND
+                    ST_Intersects( study_area.geom, class_overlap.geom )
+                GROUP BY study_area.{id}, class_overlap.{class_field}
+            """
+            _write_class_areas(conn, tbl_study_area, id, new_fields, overlap_sql)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
 def sum_area_cols(
-    db_path: str, tbl_name: str, id: str, area_fields: List[str], new_field: str
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    id: str,
+    area_fields: List[str],
+    new_field: str,
 ) -> None:
     """
     Calculate the sum of areas for a list of area fields, and store the result in a new field.
     NaN values are set to "0" before calculating the sum.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         id (str): ID field name.
         area_fields (List[str]): List of area fields.
@@ -170,15 +322,11 @@ def sum_area_cols(
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # Create a temp table with the sum of the areas
             conn.sql(
                 f"""
-                CREATE TEMPORARY TABLE tbl_sum_areas AS
+                CREATE OR REPLACE TEMPORARY TABLE tbl_sum_areas AS
                 SELECT
                     {id},
                     {', '.join(area_fields)},
@@ -210,12 +358,20 @@ def sum_area_cols(
 
 
 def extract_overlap_geom(
-    db_path, id, input_a, group_field, group, input_b, output_a, output_b
+    db_path,
+    id,
+    input_a,
+    group_field,
+    group,
+    input_b,
+    output_a,
+    output_b,
+    report_prefilter=False,
 ):
     """_summary_
 
     Args:
-        db_path (str): path to the database
+        db_path (Union[str, DuckSession]): path to the database or an open DuckSession
         id (str): id of table that needs to be split
         input_a (str): split by this table
         group_field (str/int): split by this value
@@ -223,12 +379,13 @@ def extract_overlap_geom(
         input_b (str): table to split
         output_a (str): output split 1 (sea)
         output_b (str): output split 2 (land)
+        report_prefilter (bool, optional): Print the number of pairs removed by the
+            bbox pre-filter. Defaults to False.
     """    
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.execute("INSTALL spatial;")
-            conn.execute("LOAD spatial;")
+        with get_connection(db_path) as conn:
+            if report_prefilter:
+                prefilter_report(conn, input_a, input_b)
 
             # extract the part of the study area that OVERLAPS with the area class X
             conn.execute(
@@ -238,7 +395,8 @@ def extract_overlap_geom(
                     b.{id}, 
                     ST_Intersection(a.geom, b.geom) as geom
                 FROM 
-                    {input_a} a, {input_b} b
+                    {bbox_source(input_a)} a
+                    JOIN {bbox_source(input_b)} b ON {bbox_overlap("a", "b")}
                 WHERE 
                     a.{group_field} = '{group}' AND ST_Intersects(a.geom, b.geom);
             """
@@ -252,7 +410,8 @@ def extract_overlap_geom(
                     b.{id}, 
                     ST_Intersection(a.geom, b.geom) as geom
                 FROM 
-                    {input_a} a, {input_b} b
+                    {bbox_source(input_a)} a
+                    JOIN {bbox_source(input_b)} b ON {bbox_overlap("a", "b")}
                 WHERE 
                     a.{group_field} != '{group}' AND ST_Intersects(a.geom, b.geom);
             """
@@ -2,28 +2,44 @@
 Module for calculating area variables, suca as area, perimeter, and shape index.
 """
 
-import duckdb
+from typing import Union
+
 import geopandas as gpd
 
+from .geom import derive_columns, swap_table
+from .session import DuckSession, get_connection
+
+METRICS = ("area", "perimeter", "shape_index", "centroid", "bbox", "vertex_count")
+
+METRIC_FIELDS = {
+    "area": ("area",),
+    "perimeter": ("perimeter",),
+    "shape_index": ("shape_index",),
+    "centroid": ("centroid_x", "centroid_y"),
+    "bbox": ("minx", "miny", "maxx", "maxy"),
+    "vertex_count": ("vertex_count",),
+}
+
 
 
-def geom_area(db_path: str, tbl_name: str, geom_field: str, area_field: str) -> None:
+def geom_area(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    geom_field: str,
+    area_field: str,
+) -> None:
     """
     Calculate the area of the geometry field and store the result in a new field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         geom_field (str): Name of the geometry field.
         new_field (str): Name of the new field to store the result.
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the area field to the study area table if not exists
             
             # remove col if exists
@@ -56,13 +72,17 @@ def geom_area(db_path: str, tbl_name: str, geom_field: str, area_field: str) ->
 
 
 def geom_area_byID(
-    db_path: str, tbl_name: str, id_field: str, geom_field: str, area_field: str
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    id_field: str,
+    geom_field: str,
+    area_field: str,
 ) -> None:
     """
     Calculate the sum of the areas of the geometries with the same ID and store the result in a new field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         geom_field (str): Name of the geometry field.
         area_field (str): Name of the new field to store the result.
@@ -70,11 +90,7 @@ def geom_area_byID(
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the area field to the table
             conn.sql(
                 f"""
@@ -100,23 +116,24 @@ def geom_area_byID(
         print(f"An error occurred: {e}")
 
 
-def geom_peri(db_path: str, tbl_name: str, geom_field: str, peri_field: str) -> None:
+def geom_peri(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    geom_field: str,
+    peri_field: str,
+) -> None:
     """
     Calculate the perimeter of the geometry field and store the result in a new field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         geom_field (str): Name of the geometry field.
         peri_field (str): Name of the new field to store the result.
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the area field to the study area table
             conn.sql(
                 f"""
@@ -137,13 +154,17 @@ def geom_peri(db_path: str, tbl_name: str, geom_field: str, peri_field: str) ->
 
 
 def geom_peri_byID(
-    db_path: str, tbl_name: str, id_field: str, geom_field: str, peri_field: str
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    id_field: str,
+    geom_field: str,
+    peri_field: str,
 ) -> None:
     """
     Calculate the sum of the perimeters of the geometries with the same ID and store the result in a new field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         geom_field (str): Name of the geometry field.
         peri_field (str): Name of the new field to store the result.
@@ -151,11 +172,7 @@ def geom_peri_byID(
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the perimeter field to the table
             conn.sql(
                 f"""
@@ -181,7 +198,12 @@ def geom_peri_byID(
         print(f"An error occurred: {e}")
 
 
-def geom_index(db_path: str, tbl_name: str, geom_field: str, index_field: str) -> None:
+def geom_index(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    geom_field: str,
+    index_field: str,
+) -> None:
     """Calculate the shape index and store in a new field.
     Shape index = perimeter / (2 * pi * sqrt(area/pi))
 
@@ -189,7 +211,7 @@ def geom_index(db_path: str, tbl_name: str, geom_field: str, index_field: str) -
     The shape index is a value between 0 and 1, where 0 is a perfect circle and 1 is a long and narrow shape.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         geom_field (str): Name of the geometry field.
         index_field (str): Name of the new field to store the result.
@@ -202,11 +224,7 @@ def geom_index(db_path: str, tbl_name: str, geom_field: str, index_field: str) -
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the index field to the study area table
             conn.sql(
                 f"""
@@ -228,7 +246,11 @@ def geom_index(db_path: str, tbl_name: str, geom_field: str, index_field: str) -
 
 
 def geom_index_byID(
-    db_path: str, tbl_name: str, id_field: str, geom_field: str, index_field: str
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    id_field: str,
+    geom_field: str,
+    index_field: str,
 ) -> None:
     """Calculate the shape index and store in a new field.
     Shape index = perimeter / (2 * PI() * sqrt(area/pi))
@@ -237,7 +259,7 @@ def geom_index_byID(
     The shape index is a value between 0 and 1, where 0 is a perfect circle and 1 is a long and narrow shape.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         geom_field (str): Name of the geometry field.
         index_field (str): Name of the new field to store the result.
@@ -251,11 +273,7 @@ def geom_index_byID(
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the index field to the study area table
             conn.sql(
                 f"""
@@ -282,15 +300,149 @@ def geom_index_byID(
         print(f"An error occurred: {e}")
 
 
+def _metric_fields(metrics, fields):
+    """Output field names per metric, with the overrides in fields."""
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics {unknown}, use {list(METRICS)}.")
+    fields = fields or {}
+    out = {}
+    for metric in metrics:
+        names = fields.get(metric, METRIC_FIELDS[metric])
+        out[metric] = (names,) if isinstance(names, str) else tuple(names)
+    return out
+
+
+def _shape_index(peri: str, area: str) -> str:
+    return f"{peri} / NULLIF(2 * PI() * sqrt({area} / PI()), 0)"
+
+
+def geom_metrics(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    metrics=("area", "perimeter", "shape_index"),
+    geom_field: str = "geom",
+    id_field: str = None,
+    fields: dict = None,
+) -> None:
+    """
+    Calculate a set of geometry metrics in one scan of the table and one write.
+
+    ST_Area, ST_Perimeter and ST_Centroid are computed once per geometry and
+    shared between the metrics (the shape index uses the area and perimeter).
+    Existing fields with the same name are replaced.
+
+    Metrics and default fields:
+        - area: area
+        - perimeter: perimeter
+        - shape_index: shape_index, perimeter / (2 * pi * sqrt(area/pi)), see geom_index
+        - centroid: centroid_x, centroid_y
+        - bbox: minx, miny, maxx, maxy (not the bbox_* fields of my_duckdb.index,
+          which stay the bbox of each row for the overlay pre-filter)
+        - vertex_count: vertex_count
+
+    With id_field the metrics are calculated per ID group (window aggregates)
+    and stored in every row of the group: sums of area, perimeter and vertex
+    count, the shape index of the summed area and perimeter, the area weighted
+    centroid and the bbox of the group. Rows without an ID get NULL, as in the
+    geom_*_byID functions.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_name (str): Name of the table.
+        metrics (tuple): Metrics to calculate.
+        geom_field (str): Name of the geometry field.
+        id_field (str, optional): Name of the ID field to group by.
+        fields (dict, optional): Field name(s) per metric, e.g. {"area": "areal_m2"}.
+    """
+    out = _metric_fields(metrics, fields)
+    # geometry-derived values shared between the metrics
+    shared = {
+        "_area": f"ST_Area({geom_field})",
+        "_peri": f"ST_Perimeter({geom_field})",
+        "_centroid": f"ST_Centroid({geom_field})",
+    }
+
+    if id_field is None:
+        exprs = {
+            "area": ["_area"],
+            "perimeter": ["_peri"],
+            "shape_index": [_shape_index("_peri", "_area")],
+            "centroid": ["ST_X(_centroid)", "ST_Y(_centroid)"],
+            "bbox": [
+                f"ST_XMin({geom_field})",
+                f"ST_YMin({geom_field})",
+                f"ST_XMax({geom_field})",
+                f"ST_YMax({geom_field})",
+            ],
+            "vertex_count": [f"ST_NPoints({geom_field})"],
+        }
+        columns = dict(shared)
+        for metric, names in out.items():
+            columns.update(zip(names, exprs[metric]))
+        derive_columns(db_path, tbl_name, columns, drop=list(shared))
+        return
+
+    # per ID group: window aggregates of the shared values, in the same scan
+    weight = "NULLIF(SUM(_area) OVER w, 0)"
+    aggs = {
+        "area": ["SUM(_area) OVER w"],
+        "perimeter": ["SUM(_peri) OVER w"],
+        "shape_index": [_shape_index("SUM(_peri) OVER w", "SUM(_area) OVER w")],
+        "centroid": [
+            f"COALESCE(SUM(ST_X(_centroid) * _area) OVER w / {weight}, "
+            "AVG(ST_X(_centroid)) OVER w)",
+            f"COALESCE(SUM(ST_Y(_centroid) * _area) OVER w / {weight}, "
+            "AVG(ST_Y(_centroid)) OVER w)",
+        ],
+        "bbox": [
+            f"MIN(ST_XMin({geom_field})) OVER w",
+            f"MIN(ST_YMin({geom_field})) OVER w",
+            f"MAX(ST_XMax({geom_field})) OVER w",
+            f"MAX(ST_YMax({geom_field})) OVER w",
+        ],
+        "vertex_count": [f"SUM(ST_NPoints({geom_field})) OVER w"],
+    }
+    # rows without an ID get NULL, as in the geom_*_byID functions
+    select = [
+        f"CASE WHEN {id_field} IS NOT NULL THEN {expr} END AS {name}"
+        for metric, names in out.items()
+        for name, expr in zip(names, aggs[metric])
+    ]
+    new_fields = [name for names in out.values() for name in names]
+
+    try:
+        with get_connection(db_path) as conn:
+            existing = [
+                col for col in conn.table(tbl_name).columns if col in new_fields
+            ]
+            exclude = ", ".join([*shared, *existing])
+            shared_select = ", ".join(
+                f"{expr} AS {name}" for name, expr in shared.items()
+            )
+            query = f"""
+                SELECT * EXCLUDE ({exclude}), {", ".join(select)}
+                FROM (SELECT *, {shared_select} FROM {tbl_name})
+                WINDOW w AS (PARTITION BY {id_field})
+            """
+            swap_table(conn, tbl_name, query)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
 def area_difference(
-    db_path: str, tbl_name: str, field_a: str, field_b: str, area_diff_field: str
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    field_a: str,
+    field_b: str,
+    area_diff_field: str,
 ) -> None:
     """
     Calculate the area difference between two area fields and store the result in a new field.
     Null values are set to 0 before calculating the difference.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         field_a (str): Name of the first area field.
         field_b (str): Name of the second area field.
@@ -298,11 +450,7 @@ def area_difference(
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
+        with get_connection(db_path) as conn:
             # add the area field to the study area table
             conn.sql(
                 f"""
@@ -321,39 +469,96 @@ def area_difference(
     except Exception as e:
         print(f"An error occurred: {e}")
 
+def _export_columns(conn, tbl_name: str, geom_field: str = "geom") -> list:
+    """Columns of a table to export, without the geometry field."""
+    return [col for col in conn.table(tbl_name).columns if col != geom_field]
+
+
+def _wkb_to_gdf(table, crs=None) -> gpd.GeoDataFrame:
+    """Build a GeoDataFrame from an Arrow table with a WKB "geometry" column."""
+    import shapely
+
+    wkb = table.column("geometry").to_numpy(zero_copy_only=False)
+    df = table.drop_columns(["geometry"]).to_pandas()
+    return gpd.GeoDataFrame(df, geometry=shapely.from_wkb(wkb), crs=crs)
+
+
 # export duckdb table to gdf 
-def export_toGDF(db_path: str, tbl_name: str) -> gpd.GeoDataFrame:
+def export_toGDF(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    geom_field: str = "geom",
+    crs: str = None,
+) -> gpd.GeoDataFrame:
     """
     Export a table from a duckdb database to a geopandas dataframe.
 
+    The geometries are fetched as WKB in an Arrow table and decoded with the
+    vectorized shapely.from_wkb, instead of a WKT round-trip per row.
+
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
+        geom_field (str): Name of the geometry field. Defaults to "geom".
+        crs (str, optional): CRS of the geometries, e.g. "EPSG:25833".
     """
-    from shapely import wkt
-    import geopandas as gpd
-
+    gdf = None
     try:
-        with duckdb.connect(database=db_path, read_only=True) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-            
-            # convert geom to correct format
-            df = conn.execute(f"SELECT ST_AsText(geom) as geometry, * FROM {tbl_name}").fetchdf()
-            df = df.drop(columns=["geom"])
-
-            # convert to wkt 
-            df['geometry'] = df['geometry'].apply(wkt.loads)
-
-            # convert to gdf
-            gdf = gpd.GeoDataFrame(df, geometry='geometry')
+        with get_connection(db_path, read_only=True) as conn:
+            columns = _export_columns(conn, tbl_name, geom_field)
+            select = ", ".join([*columns, f"ST_AsWKB({geom_field}) AS geometry"])
+            table = conn.execute(f"SELECT {select} FROM {tbl_name}").fetch_arrow_table()
+            gdf = _wkb_to_gdf(table, crs=crs)
     except Exception as e:
         print(f"An error occurred: {e}")
         
     return gdf
 
 
+def export_toFile(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    out_path: str,
+    fmt: str = "GPKG",
+    geom_field: str = "geom",
+    crs: str = None,
+) -> None:
+    """
+    Write a table from a duckdb database straight to a GeoPackage or
+    GeoParquet file with COPY ... TO, without a GeoDataFrame in between.
+
+    The GeoPackage is written by the GDAL driver of the spatial extension, it
+    overwrites the file and the layer is named after the file. The GeoParquet
+    file gets the geo metadata of the spatial extension.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_name (str): Name of the table.
+        out_path (str): Path to the output file.
+        fmt (str): "GPKG" or "Parquet". Defaults to "GPKG".
+        geom_field (str): Name of the geometry field. Defaults to "geom".
+        crs (str, optional): CRS written to the GeoPackage, e.g. "EPSG:25833".
+    """
+    if fmt == "GPKG":
+        options = "FORMAT GDAL, DRIVER 'GPKG'"
+        if crs is not None:
+            options += f", SRS '{crs}'"
+    elif fmt == "Parquet":
+        options = "FORMAT PARQUET"
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, use 'GPKG' or 'Parquet'.")
+
+    try:
+        with get_connection(db_path, read_only=True) as conn:
+            columns = _export_columns(conn, tbl_name, geom_field)
+            select = ", ".join([*columns, f"{geom_field} AS geom"])
+            conn.execute(
+                f"COPY (SELECT {select} FROM {tbl_name}) TO '{out_path}' ({options})"
+            )
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
 if __name__ == "__main__":
     
     import os
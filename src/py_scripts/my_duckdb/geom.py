@@ -2,16 +2,41 @@
 Module for geometry operations.
 """
 
-import duckdb
+from .session import get_connection
 
+FINGERPRINT_TABLE = "_geom_fingerprints"
 
-def group_to_multipolygon(db_path, input_table, output_table, id_field):
-    try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.execute("INSTALL spatial;")
-            conn.execute("LOAD spatial;")
 
+def group_to_multipolygon(
+    db_path,
+    input_table,
+    output_table,
+    id_field,
+    method="agg",
+    batch_size=1024,
+    workers=None,
+):
+    """Union the geometries per ID into one geometry.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        input_table (str): Name of the input table.
+        output_table (str): Name of the output table.
+        id_field (str): Name of the ID field to group by.
+        method (str): "agg" for ST_Union_Agg, or "cascaded" for a cascaded union
+            of Hilbert sorted batches on a thread pool (see vector.union), for
+            groups with many parts. Defaults to "agg".
+        batch_size (int): Geometries per union of the cascaded union.
+        workers (int, optional): Threads of the cascaded union.
+    """
+    if method == "cascaded":
+        _cascaded_group_union(
+            db_path, input_table, output_table, id_field, batch_size, workers
+        )
+        return
+
+    try:
+        with get_connection(db_path) as conn:
             conn.execute(
                 f"""
                 CREATE TABLE {output_table} AS
@@ -29,13 +54,70 @@ def group_to_multipolygon(db_path, input_table, output_table, id_field):
         print(f"An error occurred: {e}")
 
 
-def delete_lines_points(db_path, input_table, output_table):
+def _cascaded_group_union(
+    db_path, input_table, output_table, id_field, batch_size=1024, workers=None
+):
+    """group_to_multipolygon with a cascaded union per ID in Python."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+    import pyarrow as pa
+    import shapely
+
+    from py_scripts.vector.union import cascaded_union
+
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.execute("INSTALL spatial;")
-            conn.execute("LOAD spatial;")
+        with get_connection(db_path) as conn:
+            table = conn.execute(
+                f"""
+                SELECT {id_field}, ST_AsWKB(geom) AS wkb
+                FROM {input_table}
+                ORDER BY {id_field} NULLS LAST
+                """
+            ).fetch_arrow_table()
+            id_column = table.column(id_field)
+            n_ids = len(id_column) - id_column.null_count
+            ids = id_column.slice(0, n_ids).to_numpy(zero_copy_only=False)
+            geoms = shapely.from_wkb(table.column("wkb").to_numpy(zero_copy_only=False))
+            del table
+
+            # rows are sorted by id: one slice per group, and one for all rows
+            # without an id (NaN != NaN would split them), as GROUP BY does
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])[:n_ids]
+            if n_ids < len(geoms):
+                starts = np.r_[starts, n_ids]
+            ends = np.r_[starts[1:], len(geoms)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                unions = [
+                    cascaded_union(geoms[start:end], batch_size, executor=executor)
+                    for start, end in zip(starts, ends)
+                ]
+
+            result = pa.table(
+                {
+                    id_field: id_column.take(pa.array(starts, type=pa.int64())),
+                    "wkb": shapely.to_wkb(np.asarray(unions, dtype=object)),
+                }
+            )
+            conn.register("_unions", result)
+            try:
+                conn.execute(
+                    f"""
+                    CREATE TABLE {output_table} AS
+                    SELECT {id_field}, ST_GeomFromWKB(wkb) AS geom
+                    FROM _unions
+                    """
+                )
+            finally:
+                conn.unregister("_unions")
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
+
+def delete_lines_points(db_path, input_table, output_table):
+    try:
+        with get_connection(db_path) as conn:
             # Clean the geometry and remove points and lines
             conn.execute(
                 f"""
@@ -52,46 +134,349 @@ def delete_lines_points(db_path, input_table, output_table):
         print(f"An error occurred: {e}")
 
 
-def blob_to_geom(db_path, tbl_name, blob_field, geom_field):
+def _table_columns(conn, tbl_name):
+    return list(conn.table(tbl_name).columns)
+
+
+def swap_table(conn, tbl_name, query):
+    """Replace a table with the result of a query in one transaction.
+
+    Args:
+        conn (duckdb.DuckDBPyConnection): Open connection.
+        tbl_name (str): Name of the table.
+        query (str): SELECT query, may read from the table itself.
+    """
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {tbl_name}_tmp")
+        conn.execute(f"CREATE TABLE {tbl_name}_tmp AS {query}")
+        conn.execute(f"DROP TABLE {tbl_name}")
+        conn.execute(f"ALTER TABLE {tbl_name}_tmp RENAME TO {tbl_name}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def derive_columns(db_path, tbl_name, columns, drop=None):
+    """Compute derived columns in one pass and swap the result in atomically.
+
+    duckdb rewrites a whole table for every ALTER TABLE ADD COLUMN and
+    full-table UPDATE. Here all columns are computed by one
+    CREATE TABLE AS SELECT, and the new table replaces the original in one
+    transaction. Each expression may use the columns derived before it, an
+    existing column with the same name is replaced in place. Constraints and
+    indexes of the original table are not copied.
+
+    Replacing or dropping a GEOMETRY column drops the stored fingerprints of
+    that column (see geom_fingerprint), unless they are derived in the same
+    call, so they are not used with stale values.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_name (str): Name of the table.
+        columns (dict): Name and SQL expression of each derived column, in order,
+            e.g. {"geom": "ST_GeomFromWKB(geometry)", "areal_m2": "ST_Area(geom)"}.
+        drop (list, optional): Columns to drop from the result.
+
+    Example:
+        derive_columns(
+            session,
+            tbl_name,
+            {"geom": "ST_GeomFromWKB(geometry)", "areal_m2": "ST_Area(geom)"},
+            drop=["geometry"],
+        )
+    """
+    drop = list(drop or [])
+    try:
+        with get_connection(db_path) as conn:
+            current = _table_columns(conn, tbl_name)
+            stale = [
+                field
+                for field in _stored_fingerprints(conn, tbl_name, [*columns, *drop])
+                if field in current and field not in columns
+            ]
+            drop += [field for field in stale if field not in drop]
+
+            query = f"SELECT * FROM {tbl_name}"
+            for name, expr in columns.items():
+                if name in current:
+                    query = f"SELECT * REPLACE ({expr} AS {name}) FROM ({query})"
+                else:
+                    query = f"SELECT *, {expr} AS {name} FROM ({query})"
+                    current.append(name)
+            if drop:
+                query = f"SELECT * EXCLUDE ({', '.join(drop)}) FROM ({query})"
+
+            swap_table(conn, tbl_name, query)
+            if stale:
+                _forget_fingerprints(conn, tbl_name, stale)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def blob_to_geom(db_path, tbl_name, blob_field, geom_field, derived=None):
     """Convert a BLOB field to a geometry field.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
         blob_field (str): Name of the BLOB field.
         geom_field (str): Name of the geometry field.
+        derived (dict, optional): Further derived columns computed in the same
+            pass, see derive_columns, e.g. {"areal_m2": "ST_Area(geom)"}.
+    """
+    # one CREATE TABLE AS SELECT, the blob field is dropped from the result
+    columns = {geom_field: f"ST_GeomFromWKB({blob_field})", **(derived or {})}
+    drop = [blob_field] if blob_field != geom_field else None
+    derive_columns(db_path, tbl_name, columns, drop=drop)
+
+
+def fingerprint_expression(geom_field="geom", tolerance=None):
+    """SQL expression of a geometry fingerprint: md5 of the normalized WKB.
+
+    ST_Normalize orders the rings and vertices, so equal geometries with a
+    different start vertex or ring order get the same fingerprint. With a
+    tolerance the coordinates are snapped to a grid of that size first.
+
+    Args:
+        geom_field (str): Name of the geometry field.
+        tolerance (float, optional): Grid size, e.g. 0.01 for centimeters.
     """
+    geom = geom_field
+    if tolerance:
+        geom = f"ST_ReducePrecision({geom}, {float(tolerance)})"
+    return f"md5(ST_AsHEXWKB(ST_Normalize({geom})))"
+
+
+def _fingerprint_table(conn):
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {FINGERPRINT_TABLE} (
+            tbl_name VARCHAR,
+            hash_field VARCHAR,
+            geom_field VARCHAR,
+            tolerance DOUBLE,
+            PRIMARY KEY (tbl_name, hash_field)
+        )
+        """
+    )
+
+
+def _stored_fingerprints(conn, tbl_name, geom_fields):
+    """Recorded fingerprint fields of a table computed from the geom_fields."""
+    from .utils import _table_exists
+
+    if not _table_exists(conn, FINGERPRINT_TABLE):
+        return []
+    return [
+        row[0]
+        for row in conn.execute(
+            f"""
+            SELECT hash_field FROM {FINGERPRINT_TABLE}
+            WHERE tbl_name = ? AND list_contains(?, geom_field)
+            """,
+            [tbl_name, list(geom_fields)],
+        ).fetchall()
+    ]
+
+
+def _forget_fingerprints(conn, tbl_name, hash_fields):
+    conn.execute(
+        f"""
+        DELETE FROM {FINGERPRINT_TABLE}
+        WHERE tbl_name = ? AND list_contains(?, hash_field)
+        """,
+        [tbl_name, list(hash_fields)],
+    )
+
+
+def geom_fingerprint(
+    db_path, tbl_name, geom_field="geom", hash_field="geom_hash", tolerance=None
+):
+    """Store the fingerprint of each geometry in a field, see fingerprint_expression.
+
+    The geometry field and tolerance are recorded in the FINGERPRINT_TABLE,
+    duplicate_geometries and compare_versions only use the stored field for the
+    same geometry field and tolerance. derive_columns drops the field when the
+    geometry is replaced; after other edits of the geometries (UPDATE) call
+    geom_fingerprint again.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_name (str): Name of the table.
+        geom_field (str): Name of the geometry field.
+        hash_field (str): Name of the fingerprint field.
+        tolerance (float, optional): Grid size the coordinates are snapped to.
+    """
+    derive_columns(
+        db_path, tbl_name, {hash_field: fingerprint_expression(geom_field, tolerance)}
+    )
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # spatial extension
-            conn.sql("INSTALL spatial;")
-            conn.sql("LOAD spatial;")
-
-            # Create a tmp table with the geometry field
-            # duckdb does not support direct updating of columns
-            conn.sql(
-                f"""
-                CREATE TABLE {tbl_name}_tmp AS 
-                SELECT *, ST_GeomFromWKB({blob_field}) AS {geom_field}
-                FROM {tbl_name}
-            """
+        with get_connection(db_path) as conn:
+            _fingerprint_table(conn)
+            conn.execute(
+                f"INSERT OR REPLACE INTO {FINGERPRINT_TABLE} VALUES (?, ?, ?, ?)",
+                [tbl_name, hash_field, geom_field, float(tolerance or 0) or None],
             )
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def _hash_select(conn, tbl_name, geom_field, hash_field, tolerance):
+    """The stored fingerprint field, or the fingerprint computed on the fly.
+
+    The stored field is only used if geom_fingerprint recorded it for the same
+    geometry field and tolerance, so it equals the computed fingerprint.
+    """
+    from .utils import _table_exists
+
+    columns = conn.table(tbl_name).columns
+    if hash_field in columns and _table_exists(conn, FINGERPRINT_TABLE):
+        recorded = conn.execute(
+            f"""
+            SELECT geom_field, tolerance FROM {FINGERPRINT_TABLE}
+            WHERE tbl_name = ? AND hash_field = ?
+            """,
+            [tbl_name, hash_field],
+        ).fetchone()
+        if recorded == (geom_field, float(tolerance or 0) or None):
+            return hash_field
+        print(
+            f"{tbl_name}.{hash_field} is not a fingerprint of {geom_field} "
+            f"with tolerance {tolerance}, computing it"
+        )
+    return fingerprint_expression(geom_field, tolerance)
 
-            # drop the blob field
-            conn.sql(
+
+def duplicate_geometries(
+    db_path,
+    tbl_name,
+    id_field,
+    geom_field="geom",
+    hash_field="geom_hash",
+    tolerance=None,
+):
+    """Find groups of equal geometries by fingerprint, in one hash aggregate.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_name (str): Name of the table.
+        id_field (str): Name of the ID field.
+        geom_field (str): Name of the geometry field.
+        hash_field (str): Name of the fingerprint field, computed if it does not
+            exist or was stored for another tolerance.
+        tolerance (float, optional): Grid size the coordinates are snapped to.
+
+    Returns:
+        pd.DataFrame: fingerprint, number of rows and the ids of each group.
+    """
+    try:
+        with get_connection(db_path) as conn:
+            key = _hash_select(conn, tbl_name, geom_field, hash_field, tolerance)
+            return conn.execute(
                 f"""
-                ALTER TABLE {tbl_name}_tmp
-                DROP COLUMN {blob_field}
-            """
-            )
+                SELECT {key} AS geom_hash, COUNT(*) AS n, LIST({id_field}) AS ids
+                FROM {tbl_name}
+                GROUP BY 1
+                HAVING COUNT(*) > 1
+                ORDER BY n DESC
+                """
+            ).fetchdf()
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
-            # drop the original table
-            conn.sql(f"DROP TABLE {tbl_name}")
 
-            # rename the tmp table
-            conn.sql(f"ALTER TABLE {tbl_name}_tmp RENAME TO {tbl_name}")
+def compare_versions(
+    db_path,
+    old_table,
+    new_table,
+    output_table,
+    id_field=None,
+    geom_field="geom",
+    hash_field="geom_hash",
+    tolerance=None,
+):
+    """Classify the rows of two versions of a layer by geometry fingerprint.
 
-            return
+    The versions are joined on the id (or on the fingerprint without id_field)
+    with one hash join, instead of a pairwise ST_Equals. Status per row:
 
+        - unchanged: same id and fingerprint (without id_field: fingerprint in both)
+        - moved: same id, other fingerprint (only with id_field)
+        - new: only in new_table
+        - deleted: only in old_table
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        old_table (str): Name of the old version.
+        new_table (str): Name of the new version.
+        output_table (str): Name of the output table with id, fingerprints and status.
+        id_field (str, optional): Name of a stable ID field in both versions.
+        geom_field (str): Name of the geometry field.
+        hash_field (str): Name of the fingerprint field, computed if it does not
+            exist or was stored for another tolerance.
+        tolerance (float, optional): Grid size the coordinates are snapped to.
+
+    Returns:
+        dict: number of rows per status.
+    """
+    try:
+        with get_connection(db_path) as conn:
+            # a stored fingerprint on one side and a computed one on the other
+            # compare equal, see _hash_select
+            old_hash = _hash_select(conn, old_table, geom_field, hash_field, tolerance)
+            new_hash = _hash_select(conn, new_table, geom_field, hash_field, tolerance)
+
+            if id_field is not None:
+                key = id_field
+                select = f"COALESCE(n.{id_field}, o.{id_field}) AS {id_field}, "
+                status = """
+                    CASE
+                        WHEN o.key IS NULL THEN 'new'
+                        WHEN n.key IS NULL THEN 'deleted'
+                        WHEN o.old_hash = n.new_hash THEN 'unchanged'
+                        ELSE 'moved'
+                    END
+                """
+                old_cols, new_cols = f"{id_field}, ", f"{id_field}, "
+            else:
+                # without ids, rows match on fingerprint and occurrence number
+                key = "geom_hash, ROW_NUMBER() OVER (PARTITION BY geom_hash)"
+                select = ""
+                status = """
+                    CASE
+                        WHEN o.key IS NULL THEN 'new'
+                        WHEN n.key IS NULL THEN 'deleted'
+                        ELSE 'unchanged'
+                    END
+                """
+                old_cols = new_cols = ""
+
+            conn.execute(
+                f"""
+                CREATE OR REPLACE TABLE {output_table} AS
+                WITH
+                    o AS (
+                        SELECT {old_cols}geom_hash AS old_hash, ({key}) AS key
+                        FROM (SELECT {old_cols}{old_hash} AS geom_hash FROM {old_table})
+                    ),
+                    n AS (
+                        SELECT {new_cols}geom_hash AS new_hash, ({key}) AS key
+                        FROM (SELECT {new_cols}{new_hash} AS geom_hash FROM {new_table})
+                    )
+                SELECT {select}o.old_hash, n.new_hash, {status} AS status
+                FROM n
+                FULL OUTER JOIN o ON n.key = o.key
+                """
+            )
+            counts = dict(
+                conn.execute(
+                    f"SELECT status, COUNT(*) FROM {output_table} GROUP BY status"
+                ).fetchall()
+            )
+        print(f"{new_table} compared to {old_table}: {counts}")
+        return counts
     except Exception as e:
         print(f"An error occurred: {e}")
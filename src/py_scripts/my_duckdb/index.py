@@ -0,0 +1,118 @@
+"""
+Module for bounding box pre-filters of spatial joins.
+
+The bounding box of each geometry is derived from the current geometry in a
+subquery of the overlay (bbox_source), it is not stored in the table. Joining
+on bbox overlap lets DuckDB use a range join instead of a cross join, so the
+exact predicate (ST_Intersects) only runs on candidate pairs.
+"""
+
+from typing import Dict, Union
+
+from .session import DuckSession, get_connection
+
+BBOX_FIELDS = ("bbox_minx", "bbox_miny", "bbox_maxx", "bbox_maxy")
+
+
+def bbox_expressions(geom_field: str = "geom") -> Dict[str, str]:
+    """SQL expressions of the bbox fields of a geometry field."""
+    return {
+        "bbox_minx": f"ST_XMin({geom_field})",
+        "bbox_miny": f"ST_YMin({geom_field})",
+        "bbox_maxx": f"ST_XMax({geom_field})",
+        "bbox_maxy": f"ST_YMax({geom_field})",
+    }
+
+
+def bbox_overlap(alias_a: str, alias_b: str) -> str:
+    """SQL condition for overlapping bounding boxes of two aliased tables."""
+    return (
+        f"{alias_a}.bbox_minx <= {alias_b}.bbox_maxx AND "
+        f"{alias_a}.bbox_maxx >= {alias_b}.bbox_minx AND "
+        f"{alias_a}.bbox_miny <= {alias_b}.bbox_maxy AND "
+        f"{alias_a}.bbox_maxy >= {alias_b}.bbox_miny"
+    )
+
+
+def bbox_source(tbl_name: str, geom_field: str = "geom") -> str:
+    """
+    Subquery with all fields of a table and the bbox fields of its geometries,
+    to join with bbox_overlap. bbox_* fields stored in the table by earlier
+    versions are replaced, so the boxes always match the current geometries.
+
+    Args:
+        tbl_name (str): Name of the table.
+        geom_field (str, optional): Name of the geometry field. Defaults to "geom".
+
+    Returns:
+        str: SQL subquery, e.g. FROM {bbox_source("ar50")} as ar50
+    """
+    stored = ", ".join(f"'{field}'" for field in BBOX_FIELDS)
+    bbox = ", ".join(
+        f"{expr} as {field}" for field, expr in bbox_expressions(geom_field).items()
+    )
+    return (
+        f"(SELECT COLUMNS(c -> NOT list_contains([{stored}], c)), {bbox} "
+        f"FROM {tbl_name})"
+    )
+
+
+def drop_bbox_index(db_path: Union[str, DuckSession], tbl_name: str) -> None:
+    """
+    Remove the bbox_* fields that earlier versions stored in a table.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_name (str): Name of the table.
+    """
+    try:
+        with get_connection(db_path) as conn:
+            columns = conn.table(tbl_name).columns
+            for field in BBOX_FIELDS:
+                if field in columns:
+                    conn.sql(f"ALTER TABLE {tbl_name} DROP COLUMN {field}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def prefilter_report(
+    con,
+    tbl_a: str,
+    tbl_b: str,
+    where_a: str = "TRUE",
+    where_b: str = "TRUE",
+) -> Dict[str, int]:
+    """
+    Count the pairs of a join that remain after the bbox pre-filter.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Open connection.
+        tbl_a (str): Name of the first table (alias a in where_a).
+        tbl_b (str): Name of the second table (alias b in where_b).
+        where_a (str, optional): Filter on the first table. Defaults to "TRUE".
+        where_b (str, optional): Filter on the second table. Defaults to "TRUE".
+
+    Returns:
+        dict: total pairs, candidate pairs and pairs removed by the pre-filter.
+    """
+    n_a = con.sql(f"SELECT COUNT(*) FROM {tbl_a} as a WHERE {where_a}").fetchone()[0]
+    n_b = con.sql(f"SELECT COUNT(*) FROM {tbl_b} as b WHERE {where_b}").fetchone()[0]
+    candidates = con.sql(
+        f"""
+        SELECT COUNT(*)
+        FROM {bbox_source(tbl_a)} as a
+        JOIN {bbox_source(tbl_b)} as b ON {bbox_overlap("a", "b")}
+        WHERE ({where_a}) AND ({where_b})
+        """
+    ).fetchone()[0]
+
+    report = {
+        "pairs": n_a * n_b,
+        "candidates": candidates,
+        "removed": n_a * n_b - candidates,
+    }
+    print(
+        f"Bbox pre-filter {tbl_a} x {tbl_b}: {report['removed']} of "
+        f"{report['pairs']} pairs removed, {report['candidates']} candidates left."
+    )
+    return report
@@ -2,17 +2,19 @@
 Module for joining tables in a DuckDB database.
 """
 
-import duckdb
+from typing import Union
+
+from .session import DuckSession, get_connection
 
 
 def join_tables_create_new(
-    db_path: str, tbl1: str, tbl2: str, id_field: str, new_tbl: str
+    db_path: Union[str, DuckSession], tbl1: str, tbl2: str, id_field: str, new_tbl: str
 ) -> None:
     """
     Join two tables on a common ID field and create a new table from the result.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl1 (str): Name of the first table.
         tbl2 (str): Name of the second table.
         id_field (str): Name of the ID field to join on.
@@ -20,7 +22,7 @@ def join_tables_create_new(
     """
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
+        with get_connection(db_path) as conn:
             # join the tables and create a new table
             conn.sql(
                 f"""
@@ -3,51 +3,214 @@ Module for importing data into DuckDB
 """
 
 import os
-import geopandas as gpd
-import duckdb
-
-
-def load_gpkg_layers(db_path, gpkg_path, layer_name):
-    # Convert the geopackage layer to a Parquet file
-
-    # basename of db_path
-    db_basename = os.path.basename(db_path)
-
-    # create parquet folder if it does not exist
-    parquet_folder = os.path.join(os.path.dirname(db_path), "parquet")
-    if not os.path.exists(parquet_folder):
-        os.makedirs(parquet_folder)
-
-    parquet_path = os.path.join(parquet_folder, f"{layer_name}.parquet")
-    gdf = gpd.read_file(gpkg_path, layer=layer_name)
-    # if parquet does not exist, create it
-    if not os.path.exists(parquet_path):
-        gdf.to_parquet(parquet_path)
-
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # load spatial extension
-        con.install_extension("spatial")
-        con.load_extension("spatial")
-
-        # check if table exists
-        table_exists = con.sql(
-            f"SELECT name FROM sqlite_master WHERE type='table' AND name='{layer_name}';"
-        ).fetchone()
-        if table_exists:
-            print(f"Table {layer_name} already exists in DuckDB database. Skipping.")
+
+from .session import get_connection, get_db_path
+from .staging import (
+    MAX_CACHE_BYTES,
+    MAX_CACHE_ENTRIES,
+    get_loaded_entry,
+    layer_sample_hash,
+    set_loaded_key,
+    source_fingerprint,
+    stage_layer,
+)
+from .utils import _table_exists
+
+
+def _is_loaded(con, tbl_name, fingerprint, reload_unrecorded=False):
+    """Check if a table was loaded from the current source, drop it if it is stale.
+
+    A changed source key (path, layer, mtime/size, schema) drops the table,
+    unless the sample of the layer (see staging.layer_sample_hash) is unchanged,
+    e.g. after a touch or an edit of another layer in the same file. Tables
+    without a load record (loaded before the record was kept) are kept, but
+    their source is not recorded, unless reload_unrecorded drops them.
+    """
+    if not _table_exists(con, tbl_name):
+        return False
+
+    entry = get_loaded_entry(con, tbl_name)
+    if entry is None:
+        if reload_unrecorded:
+            print(f"Table {tbl_name} has no load record. Reloading.")
+            con.sql(f"DROP TABLE {tbl_name}")
+            return False
+        print(
+            f"Table {tbl_name} has no load record and may be stale. Keeping it, "
+            "use reload_unrecorded=True to reload it."
+        )
+        return True
+    if entry["key"] == fingerprint["key"]:
+        print(f"Table {tbl_name} already exists in DuckDB database. Skipping.")
+        return True
+
+    if entry["sample_hash"] is not None:
+        sample = layer_sample_hash(fingerprint["source"], fingerprint["layer"])
+        if sample == entry["sample_hash"]:
+            print(f"Layer of table {tbl_name} unchanged. Skipping.")
+            set_loaded_key(con, tbl_name, fingerprint, sample)
+            return True
+
+    print(f"Source of table {tbl_name} changed. Reloading.")
+    con.sql(f"DROP TABLE {tbl_name}")
+    return False
+
+
+def load_gpkg_layers(
+    db_path,
+    gpkg_path,
+    layer_name,
+    mode="parquet",
+    max_cache_entries=MAX_CACHE_ENTRIES,
+    max_cache_bytes=MAX_CACHE_BYTES,
+    reload_unrecorded=False,
+):
+    """Load a GeoPackage (or FileGDB) layer into a DuckDB table named after the layer.
+
+    The table is only (re)loaded when the source layer changed since the last
+    load (path, layer, mtime/size and schema, see staging.source_fingerprint,
+    and a sample of the layer, see staging.layer_sample_hash).
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        gpkg_path (str): Path to the GeoPackage or FileGDB.
+        layer_name (str): Name of the layer, also used as table name.
+        mode (str, optional): Ingestion mode. Defaults to "parquet".
+            - "parquet": stage the layer as Parquet through GeoPandas, the geometry
+              is loaded as a WKB BLOB in the "geometry" field (see blob_to_geom).
+            - "st_read": read the layer with DuckDB spatial ST_Read.
+            - "arrow": stream the layer in Arrow record batches with pyogrio.
+            The direct modes ("st_read", "arrow") do not hold the layer in memory
+            and store the geometry as GEOMETRY in the "geom" field.
+        max_cache_entries (int, optional): Maximum number of staged Parquet files
+            kept in the "parquet" folder next to the database, None for no limit.
+            Defaults to staging.MAX_CACHE_ENTRIES.
+        max_cache_bytes (int, optional): Maximum size of the staged Parquet files,
+            None for no limit. Defaults to staging.MAX_CACHE_BYTES.
+        reload_unrecorded (bool, optional): Reload an existing table without a
+            load record, instead of keeping it. Defaults to False.
+    """
+    if mode in ("st_read", "arrow"):
+        load_layer_direct(
+            db_path,
+            gpkg_path,
+            layer_name,
+            method=mode,
+            reload_unrecorded=reload_unrecorded,
+        )
+        return
+    if mode != "parquet":
+        raise ValueError(f"Unknown mode {mode!r}, use 'parquet', 'st_read' or 'arrow'.")
+
+    with get_connection(db_path) as con:
+        # check if table exists and is up to date
+        fingerprint = source_fingerprint(gpkg_path, layer_name)
+        if _is_loaded(con, layer_name, fingerprint, reload_unrecorded):
             return
 
+        # Convert the geopackage layer to a Parquet file (cached on source content)
+        parquet_folder = os.path.join(os.path.dirname(get_db_path(db_path)), "parquet")
+        parquet_path, manifest = stage_layer(
+            gpkg_path,
+            layer_name,
+            parquet_folder,
+            max_entries=max_cache_entries,
+            max_bytes=max_cache_bytes,
+        )
+
         # add table
-        if os.path.exists(parquet_path):
+        con.sql(
+            f"""
+            CREATE TABLE {layer_name} AS
+            SELECT *
+            FROM parquet_scan('{parquet_path}')
+            """
+        )
+        set_loaded_key(con, layer_name, manifest)
+        print(f"Loaded table: {layer_name}")
+    return
+
+
+def load_layer_direct(
+    db_path,
+    src_path,
+    layer_name,
+    tbl_name=None,
+    method="st_read",
+    geom_field="geom",
+    batch_size=65536,
+    reload_unrecorded=False,
+):
+    """Stream a GeoPackage/FileGDB layer straight into a DuckDB table, without
+    loading it into a GeoDataFrame first. The geometry is decoded to GEOMETRY
+    at load time.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        src_path (str): Path to the GeoPackage or FileGDB.
+        layer_name (str): Name of the layer in the source.
+        tbl_name (str, optional): Name of the new table. Defaults to layer_name.
+        method (str, optional): "st_read" uses DuckDB spatial ST_Read, "arrow"
+            streams Arrow record batches through pyogrio. Defaults to "st_read".
+        geom_field (str, optional): Name of the geometry field. Defaults to "geom".
+        batch_size (int, optional): Features per Arrow record batch. Defaults to 65536.
+        reload_unrecorded (bool, optional): Reload an existing table without a
+            load record, instead of keeping it. Defaults to False.
+    """
+    tbl_name = tbl_name or layer_name
+    src_sql = str(src_path).replace("'", "''")
+    fingerprint = source_fingerprint(src_path, layer_name)
+
+    with get_connection(db_path) as con:
+        # check if table exists and is up to date
+        if _is_loaded(con, tbl_name, fingerprint, reload_unrecorded):
+            return
+
+        if method == "st_read":
             con.sql(
                 f"""
-                CREATE TABLE {layer_name} AS 
-                SELECT * 
-                FROM parquet_scan('{parquet_path}')
+                CREATE TABLE {tbl_name} AS
+                SELECT * EXCLUDE (geom), geom AS {geom_field}
+                FROM ST_Read('{src_sql}', layer='{layer_name}')
                 """
             )
-            print(f"Loaded table: {layer_name}")
+
+        elif method == "arrow":
+            from pyogrio.raw import open_arrow
+
+            with open_arrow(
+                src_path, layer=layer_name, batch_size=batch_size, use_pyarrow=True
+            ) as (meta, reader):
+                wkb_field = meta["geometry_name"] or "wkb_geometry"
+
+                # DuckDB consumes the RecordBatchReader batch by batch
+                con.register("arrow_reader", reader)
+                try:
+                    # newer DuckDB versions decode GeoArrow WKB to GEOMETRY on scan
+                    schema = con.execute(
+                        "DESCRIBE SELECT * FROM arrow_reader"
+                    ).fetchall()
+                    wkb_type = {row[0]: row[1] for row in schema}[wkb_field]
+                    geom_expr = (
+                        wkb_field
+                        if wkb_type.startswith("GEOMETRY")
+                        else f"ST_GeomFromWKB({wkb_field})"
+                    )
+                    con.sql(
+                        f"""
+                        CREATE TABLE {tbl_name} AS
+                        SELECT
+                            * EXCLUDE ({wkb_field}),
+                            {geom_expr} AS {geom_field}
+                        FROM arrow_reader
+                        """
+                    )
+                finally:
+                    con.unregister("arrow_reader")
 
         else:
-            print(f"File {parquet_path} does not exist. Skipping.")
+            raise ValueError(f"Unknown method {method!r}, use 'st_read' or 'arrow'.")
+
+        set_loaded_key(con, tbl_name, fingerprint)
+        print(f"Loaded table: {tbl_name}")
     return
@@ -0,0 +1,96 @@
+"""
+Module for reusing one DuckDB connection across the my_duckdb helpers.
+"""
+
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+import duckdb
+
+
+class DuckSession(object):
+    """
+    Persistent DuckDB connection with the spatial extension loaded.
+
+    Every my_duckdb helper accepts a DuckSession in place of db_path. A pipeline
+    of helper calls on one session pays the connect and extension costs once.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to the database.
+    read_only : bool
+        Open the database in read-only mode. Default value = False
+    spatial : bool
+        Install and load the spatial extension. Default value = True
+
+    Attributes
+    ----------
+    conn : duckdb.DuckDBPyConnection
+        The open connection.
+
+    Example
+    -------
+        with DuckSession(db_path) as session:
+            remove_field(session, tbl_name, "areal_m2")
+            geom_area(session, tbl_name, "geom", "areal_m2")
+    """
+
+    def __init__(self, db_path: str, read_only: bool = False, spatial: bool = True):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.conn = duckdb.connect(database=db_path, read_only=read_only)
+        if spatial:
+            self.conn.install_extension("spatial")
+            self.conn.load_extension("spatial")
+
+    def sql(self, query: str):
+        """Run a query on the session connection."""
+        return self.conn.sql(query)
+
+    def execute(self, query: str, parameters=None):
+        """Execute a statement on the session connection."""
+        return self.conn.execute(query, parameters)
+
+    def close(self) -> None:
+        """Close the session connection."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextmanager
+def get_connection(
+    db: Union[str, DuckSession], read_only: bool = False, spatial: bool = True
+) -> Iterator[duckdb.DuckDBPyConnection]:
+    """
+    Yield a connection for a database path or an open DuckSession.
+
+    A DuckSession connection is reused and left open. For a path a new
+    connection is opened, the spatial extension loaded, and closed on exit.
+
+    Args:
+        db (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        read_only (bool, optional): Open a new connection read-only. Defaults to False.
+        spatial (bool, optional): Load the spatial extension. Defaults to True.
+    """
+    if isinstance(db, DuckSession):
+        yield db.conn
+        return
+
+    with duckdb.connect(database=db, read_only=read_only) as conn:
+        if spatial:
+            conn.install_extension("spatial")
+            conn.load_extension("spatial")
+        yield conn
+
+
+def get_db_path(db: Union[str, DuckSession]) -> str:
+    """Return the database path of a db_path or an open DuckSession."""
+    return db.db_path if isinstance(db, DuckSession) else db
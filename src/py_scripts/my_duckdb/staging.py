@@ -0,0 +1,310 @@
+"""
+Module for the Parquet staging cache used when loading layers into DuckDB.
+
+Staged Parquet files are keyed on the source path, layer name, source mtime/size
+and a hash of the layer schema. Every entry has a JSON manifest next to the
+Parquet file, which is used for least-recently-used eviction.
+"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+STAGING_TABLE = "_staging_manifest"
+
+# default limits of the staging cache
+MAX_CACHE_ENTRIES = 16
+MAX_CACHE_BYTES = 20 * 1024**3
+# rows per window of the layer sample, see layer_sample_hash
+SAMPLE_ROWS = 1000
+
+
+def _path_stat(path: str) -> Tuple[float, int]:
+    """Return (mtime, size) of a file, or of all files in a directory (FileGDB)."""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    mtime, size = os.stat(path).st_mtime, 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            mtime = max(mtime, stat.st_mtime)
+            size += stat.st_size
+    return mtime, size
+
+
+def layer_sample_hash(
+    src_path: str, layer_name: str, n_rows: int = SAMPLE_ROWS
+) -> Optional[str]:
+    """
+    Hash the feature count and a sample of rows of one layer.
+
+    The sample is n_rows features at the start, the middle and the end of the
+    layer, so only this layer is read, and only a few thousand rows of it.
+    Edits that keep the feature count and do not touch the sampled rows are
+    not detected.
+
+    Args:
+        src_path (str): Path to the GeoPackage or FileGDB.
+        layer_name (str): Name of the layer.
+        n_rows (int, optional): Rows per sample window, 0 or None for no sample.
+            Defaults to SAMPLE_ROWS.
+
+    Returns:
+        str: hash of the sample, None without a sample.
+    """
+    if not n_rows:
+        return None
+
+    import pyarrow as pa
+    from pyogrio import read_info
+    from pyogrio.raw import read_arrow
+
+    n_features = read_info(src_path, layer=layer_name, force_feature_count=True)[
+        "features"
+    ]
+    digest = hashlib.sha256(str(n_features).encode())
+    starts = sorted(
+        {0, max(n_features // 2 - n_rows // 2, 0), max(n_features - n_rows, 0)}
+    )
+    for start in starts:
+        _, table = read_arrow(
+            src_path, layer=layer_name, skip_features=start, max_features=n_rows
+        )
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        digest.update(sink.getvalue())
+    return digest.hexdigest()
+
+
+def schema_hash(src_path: str, layer_name: str) -> str:
+    """Hash the field names, field types, geometry type and CRS of a layer."""
+    from pyogrio import read_info
+
+    info = read_info(src_path, layer=layer_name)
+    schema = {
+        "fields": [str(field) for field in info["fields"]],
+        "dtypes": [str(dtype) for dtype in info["dtypes"]],
+        "geometry_type": info["geometry_type"],
+        "crs": info["crs"],
+    }
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+
+def source_fingerprint(src_path: str, layer_name: str) -> Dict:
+    """
+    Fingerprint a source layer by path, layer, mtime, size and schema hash.
+
+    Args:
+        src_path (str): Path to the GeoPackage or FileGDB.
+        layer_name (str): Name of the layer.
+
+    Returns:
+        dict: fingerprint including the derived cache "key".
+    """
+    mtime, size = _path_stat(src_path)
+    fingerprint = {
+        "source": os.path.abspath(src_path),
+        "layer": layer_name,
+        "mtime": mtime,
+        "size": size,
+        "schema_hash": schema_hash(src_path, layer_name),
+    }
+    fingerprint["key"] = hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode()
+    ).hexdigest()[:16]
+    return fingerprint
+
+
+def _entry_paths(cache_dir: str, layer_name: str, key: str) -> Tuple[str, str]:
+    base = os.path.join(cache_dir, f"{layer_name}-{key}")
+    return f"{base}.parquet", f"{base}.json"
+
+
+def _write_manifest(manifest_path: str, manifest: Dict) -> None:
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def stage_layer(
+    src_path: str,
+    layer_name: str,
+    cache_dir: str,
+    max_entries: Optional[int] = MAX_CACHE_ENTRIES,
+    max_bytes: Optional[int] = MAX_CACHE_BYTES,
+) -> Tuple[str, Dict]:
+    """
+    Return the staged Parquet file of a layer, creating it when the source changed.
+
+    A cached entry is reused when source path, layer, mtime, size and schema hash
+    are unchanged. Otherwise the layer is written to a new entry, and the cache
+    is evicted down to max_entries/max_bytes (least recently used first).
+
+    Args:
+        src_path (str): Path to the GeoPackage or FileGDB.
+        layer_name (str): Name of the layer.
+        cache_dir (str): Folder with the staged Parquet files.
+        max_entries (int, optional): Maximum number of cache entries, None for no
+            limit. Defaults to MAX_CACHE_ENTRIES.
+        max_bytes (int, optional): Maximum total size of the cache, None for no
+            limit. Defaults to MAX_CACHE_BYTES.
+
+    Returns:
+        Tuple[str, dict]: path to the Parquet file and its manifest.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = source_fingerprint(src_path, layer_name)
+    parquet_path, manifest_path = _entry_paths(
+        cache_dir, layer_name, fingerprint["key"]
+    )
+
+    if os.path.exists(parquet_path) and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        manifest["last_access"] = time.time()
+        _write_manifest(manifest_path, manifest)
+        print(f"Using staged Parquet for {layer_name} ({fingerprint['key']}).")
+        return parquet_path, manifest
+
+    import geopandas as gpd
+
+    gdf = gpd.read_file(src_path, layer=layer_name)
+    tmp_path = f"{parquet_path}.tmp"
+    gdf.to_parquet(tmp_path)
+    del gdf
+    os.replace(tmp_path, parquet_path)
+
+    now = time.time()
+    manifest = dict(
+        fingerprint,
+        parquet=os.path.basename(parquet_path),
+        bytes=os.path.getsize(parquet_path),
+        created=now,
+        last_access=now,
+    )
+    _write_manifest(manifest_path, manifest)
+    print(f"Staged {layer_name} as Parquet ({fingerprint['key']}).")
+
+    evict_cache(cache_dir, max_entries, max_bytes, keep=[fingerprint["key"]])
+    return parquet_path, manifest
+
+
+def list_cache(cache_dir: str) -> List[Dict]:
+    """List the manifests in the staging cache, least recently used first."""
+    manifests = []
+    if not os.path.isdir(cache_dir):
+        return manifests
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(cache_dir, name), "r") as f:
+            manifest = json.load(f)
+        manifest["manifest"] = name
+        manifests.append(manifest)
+    return sorted(manifests, key=lambda m: m["last_access"])
+
+
+def evict_cache(
+    cache_dir: str,
+    max_entries: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    keep: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    Remove least recently used entries until the cache is within its limits.
+
+    Args:
+        cache_dir (str): Folder with the staged Parquet files.
+        max_entries (int, optional): Maximum number of cache entries. Defaults to None.
+        max_bytes (int, optional): Maximum total size of the cache. Defaults to None.
+        keep (List[str], optional): Cache keys that are never evicted. Defaults to None.
+
+    Returns:
+        List[str]: keys of the removed entries.
+    """
+    keep = set(keep or [])
+    manifests = list_cache(cache_dir)
+    n_entries = len(manifests)
+    n_bytes = sum(m["bytes"] for m in manifests)
+
+    removed = []
+    for manifest in manifests:
+        over_entries = max_entries is not None and n_entries > max_entries
+        over_bytes = max_bytes is not None and n_bytes > max_bytes
+        if not (over_entries or over_bytes):
+            break
+        if manifest["key"] in keep:
+            continue
+        parquet_path = os.path.join(cache_dir, manifest["parquet"])
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+        os.remove(os.path.join(cache_dir, manifest["manifest"]))
+        n_entries -= 1
+        n_bytes -= manifest["bytes"]
+        removed.append(manifest["key"])
+        print(f"Evicted staged Parquet {manifest['parquet']}.")
+    return removed
+
+
+def _manifest_table(con) -> None:
+    con.sql(
+        f"""
+        CREATE TABLE IF NOT EXISTS {STAGING_TABLE} (
+            tbl_name VARCHAR PRIMARY KEY,
+            cache_key VARCHAR,
+            source VARCHAR,
+            layer VARCHAR,
+            loaded_at TIMESTAMP,
+            sample_hash VARCHAR
+        )
+        """
+    )
+    # manifest tables created before the layer sample was recorded
+    con.sql(f"ALTER TABLE {STAGING_TABLE} ADD COLUMN IF NOT EXISTS sample_hash VARCHAR")
+
+
+def get_loaded_entry(con, tbl_name: str) -> Optional[Dict]:
+    """Return the source key and layer sample a table was loaded from, or None."""
+    _manifest_table(con)
+    result = con.execute(
+        f"SELECT cache_key, sample_hash FROM {STAGING_TABLE} WHERE tbl_name = ?",
+        [tbl_name],
+    ).fetchone()
+    if result is None:
+        return None
+    return {"key": result[0], "sample_hash": result[1]}
+
+
+def get_loaded_key(con, tbl_name: str) -> Optional[str]:
+    """Return the source key a table was loaded from, or None if unknown."""
+    entry = get_loaded_entry(con, tbl_name)
+    return entry["key"] if entry else None
+
+
+def set_loaded_key(
+    con, tbl_name: str, fingerprint: Dict, sample: Optional[str] = None
+) -> None:
+    """Record the source key and layer sample a table was loaded from."""
+    _manifest_table(con)
+    if sample is None:
+        sample = layer_sample_hash(fingerprint["source"], fingerprint["layer"])
+    con.execute(
+        f"""
+        INSERT OR REPLACE INTO {STAGING_TABLE}
+            (tbl_name, cache_key, source, layer, loaded_at, sample_hash)
+        VALUES (?, ?, ?, ?, current_timestamp, ?)
+        """,
+        [
+            tbl_name,
+            fingerprint["key"],
+            fingerprint["source"],
+            fingerprint["layer"],
+            sample,
+        ],
+    )
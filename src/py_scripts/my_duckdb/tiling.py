@@ -0,0 +1,413 @@
+"""
+Module for running large overlays tile by tile.
+
+The extent of the input tables is split into a grid of square tiles. Each tile
+is processed as a separate query by a pool of worker threads, geometries that
+cross a tile edge are clipped to the tile, and the per-tile parts are merged
+afterwards. Finished tiles are recorded in the database, so an interrupted run
+resumes at the first unfinished tile.
+
+Tables used by a tiled run of <output_table>:
+    <output_table>_tile_grid: tile_id, geom and bbox_* fields of each tile
+    <output_table>_tile_parts: per-tile results tagged with tile_id
+    <output_table>_tile_done: finished tiles
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Union
+
+from .area_overlay import _sql_literal, _write_class_areas
+from .index import bbox_overlap, bbox_source
+from .session import DuckSession, get_connection
+from .utils import _table_exists
+
+
+def _tile_tables(output_table: str):
+    return (
+        f"{output_table}_tile_grid",
+        f"{output_table}_tile_parts",
+        f"{output_table}_tile_done",
+    )
+
+
+def create_tile_grid(
+    db_path: Union[str, DuckSession],
+    extent_tables: List[str],
+    grid_table: str,
+    tile_size: float,
+    geom_field: str = "geom",
+) -> int:
+    """
+    Create a grid of square tiles covering the extent of one or more tables.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        extent_tables (List[str]): Tables that the grid must cover.
+        grid_table (str): Name of the new grid table.
+        tile_size (float): Tile width and height in map units.
+        geom_field (str, optional): Name of the geometry field. Defaults to "geom".
+
+    Returns:
+        int: number of tiles.
+    """
+    extent_sql = " UNION ALL ".join(
+        f"""
+        SELECT
+            MIN(ST_XMin({geom_field})) as minx, MIN(ST_YMin({geom_field})) as miny,
+            MAX(ST_XMax({geom_field})) as maxx, MAX(ST_YMax({geom_field})) as maxy
+        FROM {tbl}
+        """
+        for tbl in extent_tables
+    )
+
+    with get_connection(db_path) as conn:
+        minx, miny, maxx, maxy = conn.sql(
+            f"""
+            SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy)
+            FROM ({extent_sql})
+            """
+        ).fetchone()
+        if minx is None:
+            # no geometries: an empty grid, the tiled run has no tiles
+            minx = miny = n_x = n_y = 0
+        else:
+            n_x = max(1, int(-(-(maxx - minx) // tile_size)))
+            n_y = max(1, int(-(-(maxy - miny) // tile_size)))
+
+        conn.sql(
+            f"""
+            CREATE OR REPLACE TABLE {grid_table} AS
+            SELECT
+                tile_y * {n_x} + tile_x as tile_id,
+                {minx} + tile_x * {tile_size} as bbox_minx,
+                {miny} + tile_y * {tile_size} as bbox_miny,
+                {minx} + (tile_x + 1) * {tile_size} as bbox_maxx,
+                {miny} + (tile_y + 1) * {tile_size} as bbox_maxy,
+                ST_MakeEnvelope(bbox_minx, bbox_miny, bbox_maxx, bbox_maxy) as geom
+            FROM range({n_x}) t_x(tile_x), range({n_y}) t_y(tile_y)
+            """
+        )
+    print(f"Created tile grid {grid_table}: {n_x} x {n_y} tiles of {tile_size}.")
+    return n_x * n_y
+
+
+def run_tiled(
+    db_path: Union[str, DuckSession],
+    tile_sql: str,
+    output_table: str,
+    workers: int = 4,
+) -> int:
+    """
+    Run a query for every tile of the grid of output_table and append the rows
+    to <output_table>_tile_parts. Tiles that finished in an earlier run are skipped.
+
+    The query can use the CTE "tile" with the tile_id, geom and bbox_* fields of
+    the current tile.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tile_sql (str): Per-tile SELECT query.
+        output_table (str): Name of the output table of the tiled run.
+        workers (int, optional): Number of tiles processed at the same time.
+            Defaults to 4.
+
+    Returns:
+        int: number of tiles processed in this run.
+    """
+    grid_table, parts_table, done_table = _tile_tables(output_table)
+
+    def tile_query(tile_id):
+        return f"""
+            WITH tile AS (SELECT * FROM {grid_table} WHERE tile_id = {tile_id})
+            SELECT {tile_id} as tile_id, * FROM ({tile_sql})
+        """
+
+    with get_connection(db_path) as conn:
+        tiles = [
+            row[0] for row in conn.sql(f"SELECT tile_id FROM {grid_table}").fetchall()
+        ]
+        conn.sql(
+            f"""
+            CREATE TABLE IF NOT EXISTS {done_table} (
+                tile_id BIGINT PRIMARY KEY,
+                finished_at TIMESTAMP
+            )
+            """
+        )
+        if not _table_exists(conn, parts_table):
+            # only the schema, the grid can be empty
+            conn.sql(
+                f"""
+                CREATE TABLE {parts_table} AS
+                SELECT * FROM ({tile_query(-1)}) LIMIT 0
+                """
+            )
+        done = {
+            row[0] for row in conn.sql(f"SELECT tile_id FROM {done_table}").fetchall()
+        }
+        todo = sorted(tile_id for tile_id in tiles if tile_id not in done)
+        if done:
+            print(f"Resuming {output_table}: {len(done)} of {len(tiles)} tiles done.")
+
+        def process_tile(tile_id):
+            # one cursor (connection to the same database) per tile
+            cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                cursor.execute(f"INSERT INTO {parts_table} {tile_query(tile_id)}")
+                cursor.execute(
+                    f"INSERT INTO {done_table} VALUES ({tile_id}, current_timestamp)"
+                )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            finally:
+                cursor.close()
+            return tile_id
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_tile, tile_id) for tile_id in todo]
+            for n, future in enumerate(as_completed(futures), start=len(done) + 1):
+                tile_id = future.result()
+                print(
+                    f"Tile {n}/{len(tiles)} done (tile_id {tile_id}, "
+                    f"{time.perf_counter() - start:.1f} sec)"
+                )
+    return len(todo)
+
+
+def drop_tiles(db_path: Union[str, DuckSession], output_table: str) -> None:
+    """Remove the grid, parts and progress tables of a tiled run."""
+    with get_connection(db_path) as conn:
+        for tbl in _tile_tables(output_table):
+            conn.sql(f"DROP TABLE IF EXISTS {tbl}")
+
+
+def _start_tiled(db_path, output_table, extent_tables, tile_size, resume):
+    """Create the tile grid, unless an unfinished run of output_table is resumed."""
+    grid_table = _tile_tables(output_table)[0]
+    if not resume:
+        drop_tiles(db_path, output_table)
+    with get_connection(db_path) as conn:
+        grid_exists = _table_exists(conn, grid_table)
+    if not grid_exists:
+        create_tile_grid(db_path, extent_tables, grid_table, tile_size)
+
+
+def _tile_inputs(input_a, input_b, row_ids=False):
+    """CTEs with the features of input_a (a) and input_b (b) that touch the tile,
+    with their rowid as tile_row_id if row_ids is set."""
+    source_a, source_b = (
+        bbox_source(f"(SELECT rowid as tile_row_id, * FROM {tbl})" if row_ids else tbl)
+        for tbl in (input_a, input_b)
+    )
+    return f"""
+        WITH a AS (
+            SELECT src.* FROM {source_a} as src, tile
+            WHERE {bbox_overlap("src", "tile")}
+        ),
+        b AS (
+            SELECT src.* FROM {source_b} as src, tile
+            WHERE {bbox_overlap("src", "tile")}
+        )
+    """
+
+
+def tiled_extract_overlap_geom(
+    db_path: Union[str, DuckSession],
+    id: str,
+    input_a: str,
+    group_field: str,
+    group: str,
+    input_b: str,
+    output_a: str,
+    output_b: str,
+    tile_size: float,
+    workers: int = 4,
+    resume: bool = True,
+) -> None:
+    """Tiled version of extract_overlap_geom. The overlap of each pair is clipped
+    to the tiles it intersects, and the parts of each pair are merged with
+    ST_Union_Agg. Like extract_overlap_geom, the outputs have one row per
+    intersecting pair of input_a and input_b.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        id (str): id of table that needs to be split
+        input_a (str): split by this table
+        group_field (str/int): split by this value
+        group (str): field name of the group
+        input_b (str): table to split
+        output_a (str): output split 1 (sea)
+        output_b (str): output split 2 (land)
+        tile_size (float): Tile width and height in map units.
+        workers (int, optional): Number of tiles processed at the same time.
+            Defaults to 4.
+        resume (bool, optional): Continue an interrupted run. Defaults to True.
+    """
+    for output_table, operator in [(output_a, "="), (output_b, "!=")]:
+        _start_tiled(db_path, output_table, [input_a, input_b], tile_size, resume)
+        # the pairs are identified by the rowids of both inputs across tiles
+        tile_sql = f"""
+            {_tile_inputs(input_a, input_b, row_ids=True)},
+            pairs AS (
+                SELECT
+                    a.tile_row_id as row_a,
+                    b.tile_row_id as row_b,
+                    b.{id},
+                    ST_Intersection(a.geom, b.geom) as overlap
+                FROM a JOIN b ON {bbox_overlap("a", "b")}
+                WHERE
+                    a.{group_field} {operator} {_sql_literal(group)} AND
+                    ST_Intersects(a.geom, b.geom)
+            )
+            SELECT
+                row_a, row_b, {id}, ST_Intersection(overlap, tile.geom) as geom
+            FROM pairs, tile
+            WHERE ST_Intersects(overlap, tile.geom)
+        """
+        run_tiled(db_path, tile_sql, output_table, workers)
+        merge_tiles(db_path, output_table, ["row_a", "row_b", id], geom_field="geom")
+        with get_connection(db_path) as conn:
+            for field in ("row_a", "row_b"):
+                conn.sql(f"ALTER TABLE {output_table} DROP COLUMN {field}")
+
+
+def tiled_group_to_multipolygon(
+    db_path: Union[str, DuckSession],
+    input_table: str,
+    output_table: str,
+    id_field: str,
+    tile_size: float,
+    workers: int = 4,
+    resume: bool = True,
+) -> None:
+    """Tiled version of group_to_multipolygon. The geometries are clipped and
+    unioned per tile, the tile parts of each id are unioned in the merge.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        input_table (str): Name of the input table.
+        output_table (str): Name of the output table.
+        id_field (str): Name of the field to group by.
+        tile_size (float): Tile width and height in map units.
+        workers (int, optional): Number of tiles processed at the same time.
+            Defaults to 4.
+        resume (bool, optional): Continue an interrupted run. Defaults to True.
+    """
+    _start_tiled(db_path, output_table, [input_table], tile_size, resume)
+    tile_sql = f"""
+        SELECT
+            {id_field},
+            ST_Union_Agg(ST_Intersection(src.geom, tile.geom)) as geom
+        FROM {bbox_source(input_table)} as src, tile
+        WHERE
+            {bbox_overlap("src", "tile")} AND
+            ST_Intersects(src.geom, tile.geom)
+        GROUP BY {id_field}
+    """
+    run_tiled(db_path, tile_sql, output_table, workers)
+    merge_tiles(db_path, output_table, [id_field], geom_field="geom")
+
+
+def tiled_area_class_overlay(
+    db_path: Union[str, DuckSession],
+    tbl_study_area: str,
+    id: str,
+    tbl_class: str,
+    class_field: str,
+    area_classes: List[Union[int, str]],
+    tile_size: float,
+    field_template: str = "area_{}_m2",
+    workers: int = 4,
+    resume: bool = True,
+) -> None:
+    """Tiled version of area_class_overlay (e.g. the AR50 bonitet overlap). The
+    overlap areas are clipped to the tiles, so the per-tile sums add up to the
+    total overlap area of each (id, class).
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        tbl_study_area (str): Name of the study area table.
+        id (str): ID field name.
+        tbl_class (str): Name of the class table (e.g. AR50).
+        class_field (str): Class field name (e.g. ar50_bonitet).
+        area_classes (List[Union[int, str]]): List of area classes.
+        tile_size (float): Tile width and height in map units.
+        field_template (str, optional): Template for the new field names, formatted
+            with the area class. Defaults to "area_{}_m2".
+        workers (int, optional): Number of tiles processed at the same time.
+            Defaults to 4.
+        resume (bool, optional): Continue an interrupted run. Defaults to True.
+    """
+    output_table = f"{tbl_study_area}_{class_field}"
+    new_fields = {
+        area_class: field_template.format(area_class) for area_class in area_classes
+    }
+    area_class_str = ", ".join(_sql_literal(item) for item in area_classes)
+
+    _start_tiled(db_path, output_table, [tbl_study_area, tbl_class], tile_size, resume)
+    tile_sql = f"""
+        {_tile_inputs(tbl_study_area, tbl_class)}
+        SELECT
+            a.{id},
+            b.{class_field} as class,
+            SUM(ST_Area(ST_Intersection(ST_Intersection(a.geom, b.geom), tile.geom))) as area
+        FROM a JOIN b ON {bbox_overlap("a", "b")}, tile
+        WHERE
+            b.{class_field} IN ({area_class_str}) AND
+            ST_Intersects(a.geom, b.geom)
+        GROUP BY a.{id}, b.{class_field}
+    """
+    run_tiled(db_path, tile_sql, output_table, workers)
+
+    with get_connection(db_path) as conn:
+        parts_table = _tile_tables(output_table)[1]
+        _write_class_areas(
+            conn, tbl_study_area, id, new_fields, f"SELECT * FROM {parts_table}"
+        )
+    drop_tiles(db_path, output_table)
+
+
+def merge_tiles(
+    db_path: Union[str, DuckSession],
+    output_table: str,
+    key_fields: List[str],
+    geom_field: Optional[str] = "geom",
+    sum_fields: Optional[List[str]] = None,
+    keep_tiles: bool = False,
+) -> None:
+    """
+    Merge the tile parts of a tiled run into output_table. Parts with the same
+    key are combined: geometries with ST_Union_Agg and sum_fields with SUM.
+
+    Args:
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
+        output_table (str): Name of the output table of the tiled run.
+        key_fields (List[str]): Fields identifying a feature across tiles.
+        geom_field (str, optional): Geometry field to union. Defaults to "geom".
+        sum_fields (List[str], optional): Fields to sum. Defaults to None.
+        keep_tiles (bool, optional): Keep the grid, parts and progress tables.
+            Defaults to False.
+    """
+    parts_table = _tile_tables(output_table)[1]
+    aggregates = [f"SUM({field}) as {field}" for field in sum_fields or []]
+    if geom_field:
+        aggregates.append(f"ST_Union_Agg({geom_field}) as {geom_field}")
+
+    with get_connection(db_path) as conn:
+        conn.sql(
+            f"""
+            CREATE OR REPLACE TABLE {output_table} AS
+            SELECT
+                {", ".join(key_fields + aggregates)}
+            FROM {parts_table}
+            GROUP BY {", ".join(key_fields)}
+            """
+        )
+    print(f"Merged tiles into {output_table}.")
+    if not keep_tiles:
+        drop_tiles(db_path, output_table)
@@ -3,15 +3,14 @@ Module for common DuckDB operations.
 """
 
 import os
-import duckdb
+from typing import Union
 
+from .geom import fingerprint_expression
+from .session import DuckSession, get_connection
 
-def print_duckdb_info(db_path):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # load spatial extension
-        con.install_extension("spatial")
-        con.load_extension("spatial")
 
+def print_duckdb_info(db_path):
+    with get_connection(db_path) as con:
         # Get table names
         tables = con.sql(
             "SELECT name FROM sqlite_master WHERE type='table';"
@@ -30,67 +29,114 @@ def remove_database(db_path):
 
 
 def remove_table(db_path, table_name):
-    with duckdb.connect(database=db_path, read_only=False) as con:
+    with get_connection(db_path) as con:
         # if the table exists, drop it
         con.sql(f"DROP TABLE IF EXISTS {table_name}")
     return
 
 
+def _table_exists(con, table_name):
+    result = con.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?;", [table_name]
+    ).fetchone()
+    return result is not None
+
+
 def field_exists(db_path, table_name, field_name):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        result = con.execute(f"PRAGMA table_info({table_name})").fetchdf()
-        return field_name in result["name"].values
+    with get_connection(db_path) as con:
+        return _field_exists(con, table_name, field_name)
+
+
+def _field_exists(con, table_name, field_name):
+    result = con.execute(f"PRAGMA table_info({table_name})").fetchdf()
+    return field_name in result["name"].values
 
 
 def remove_field(db_path, table_name, field_name):
-    with duckdb.connect(database=db_path, read_only=False) as con:
-        # if the field exists, drop it
-        if field_exists(db_path, table_name, field_name):
+    with get_connection(db_path) as con:
+        # if the field exists, drop it (checked on the same connection)
+        if _field_exists(con, table_name, field_name):
             con.sql(f"ALTER TABLE {table_name} DROP COLUMN {field_name}")
     return
 
 
-def remove_duplicates(db_path: str, tbl_name: str, id_field: str) -> None:
+def _set_settings(con, settings):
+    """Apply duckdb settings, return the previous values."""
+    previous = {}
+    for name, value in settings.items():
+        if value is None:
+            continue
+        previous[name] = con.execute(f"SELECT current_setting('{name}')").fetchone()[0]
+        con.execute(f"SET {name} = ?", [value])
+    return previous
+
+
+def remove_duplicates(
+    db_path: Union[str, DuckSession],
+    tbl_name: str,
+    id_field: Union[str, list, None] = None,
+    geom_field: str = "geom",
+    memory_limit: str = None,
+    temp_directory: str = None,
+) -> int:
     """
-    Remove duplicate entries from a table based on a specific field.
+    Remove duplicate entries from a table based on a key.
+
+    The key is id_field, or the fingerprint of the geometry field (md5 of the
+    normalized WKB, see my_duckdb.geom.fingerprint_expression). The
+    rows are numbered per key with a window function, and all but the first
+    row (lowest rowid) of each key are deleted in place, without a copy of the
+    table. The window is spilled to temp_directory beyond memory_limit.
 
     Args:
-        db_path (str): Path to the database.
+        db_path (Union[str, DuckSession]): Path to the database or an open DuckSession.
         tbl_name (str): Name of the table.
-        id_field (str): Name of the field to check for duplicates.
+        id_field (Union[str, list], optional): Field(s) to check for duplicates,
+            defaults to the geometry hash.
+        geom_field (str): Name of the geometry field, used without id_field.
+        memory_limit (str, optional): duckdb memory limit during the operation, e.g. "4GB".
+        temp_directory (str, optional): Folder for spilling to disk.
+
+    Returns:
+        int: number of removed duplicates, None if an error occurred.
     """
+    if id_field is None:
+        key = fingerprint_expression(geom_field)
+    elif isinstance(id_field, str):
+        key = id_field
+    else:
+        key = ", ".join(id_field)
 
     try:
-        with duckdb.connect(database=db_path, read_only=False) as conn:
-            # create a temporary table with distinct records
-            conn.sql(
-                f"""
-                CREATE TABLE temp_table AS
-                SELECT DISTINCT *
-                FROM {tbl_name}
-                """
-            )
-
-            # delete all records from the original table
-            conn.sql(
-                f"""
-                DELETE FROM {tbl_name}
-                """
-            )
-
-            # insert the distinct records back into the original table
-            conn.sql(
-                f"""
-                INSERT INTO {tbl_name}
-                SELECT * FROM temp_table
-                """
-            )
-
-            # drop the temporary table
-            conn.sql(
-                f"""
-                DROP TABLE temp_table
-                """
+        with get_connection(db_path) as conn:
+            previous = _set_settings(
+                conn,
+                {
+                    "memory_limit": memory_limit,
+                    "temp_directory": temp_directory,
+                    "preserve_insertion_order": False,
+                },
             )
+            try:
+                n_removed = conn.execute(
+                    f"""
+                    DELETE FROM {tbl_name}
+                    WHERE rowid IN (
+                        SELECT rowid
+                        FROM (
+                            SELECT
+                                rowid,
+                                ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY rowid) AS n
+                            FROM {tbl_name}
+                        )
+                        WHERE n > 1
+                    )
+                    """
+                ).fetchone()[0]
+            finally:
+                _set_settings(conn, previous)
+
+        print(f"Removed {n_removed} duplicates from {tbl_name}.")
+        return n_removed
     except Exception as e:
         print(f"An error occurred: {e}")
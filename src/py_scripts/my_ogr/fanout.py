@@ -1,58 +1,219 @@
 import argparse
-from osgeo import ogr
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def fanout(vector_dataset, region_dataset, output_base_name):
-    """Fanout a vector dataset based on a region dataset
+from osgeo import gdal, ogr
+
+try:
+    from .load import BatchedWriter
+except ImportError:  # run as script
+    from load import BatchedWriter
 
-    Args:
-        vector_dataset (str): path to vector dataset
-        region_dataset (str): path to region dataset to fanout the vector dataset
-    """
-    
-    # Load the vector dataset
-    vector_ds = ogr.Open(vector_dataset, 0)
-    vector_layer = vector_ds.GetLayer()
 
-    # Load the region dataset
+def _read_regions(region_dataset, region_field=None):
+    """Read the regions as (name, wkb) tuples, named by region_field or FID."""
     region_ds = ogr.Open(region_dataset, 0)
     region_layer = region_ds.GetLayer()
 
-    # Loop through each region
-    for i in range(region_layer.GetFeatureCount()):
-        region_feature = region_layer.GetFeature(i)
+    regions = []
+    for region_feature in region_layer:
+        if region_field:
+            name = str(region_feature.GetField(region_field))
+        else:
+            name = str(region_feature.GetFID())
         region_geom = region_feature.GetGeometryRef()
+        regions.append((name, bytes(region_geom.ExportToWkb())))
+
+    region_ds = None
+    return regions
+
+
+def _unique_names(names):
+    """Make the region names safe as file and layer names, and number duplicates."""
+    unique = []
+    used = set()
+    for name in names:
+        safe = re.sub(r"[^\w-]+", "_", name).strip("_") or "region"
+        candidate, n = safe, 1
+        while candidate in used:
+            n += 1
+            candidate = f"{safe}_{n}"
+        used.add(candidate)
+        unique.append(candidate)
+    return unique
+
+
+def _fanout_region(
+    vector_dataset,
+    region_name,
+    region_wkb,
+    out_path,
+    layer_name,
+    driver_name,
+    batch_size=10000,
+):
+    """Clip the features of the vector dataset that intersect one region and
+    write them to a new layer. Runs in a worker process."""
+    ogr.UseExceptions()
+
+    vector_ds = ogr.Open(vector_dataset, 0)
+    vector_layer = vector_ds.GetLayer()
+    region_geom = ogr.CreateGeometryFromWkb(region_wkb)
 
-        # Create a new layer for this region
-        driver = ogr.GetDriverByName('ESRI Shapefile')
-        output_ds = driver.CreateDataSource(f'{output_base_name}_{i+1}.shp')
-        output_layer = output_ds.CreateLayer('', vector_layer.GetSpatialRef(), ogr.wkbPolygon)
+    # only the candidates with a bbox overlapping the region (uses the spatial index)
+    vector_layer.SetSpatialFilter(region_geom)
 
-        # Loop through each polygon in the vector dataset
-        for j in range(vector_layer.GetFeatureCount()):
-            vector_feature = vector_layer.GetFeature(j)
+    # output layer with the schema of the vector dataset
+    geom_type = ogr.GT_GetCollection(vector_layer.GetGeomType())
+    driver = ogr.GetDriverByName(driver_name)
+    output_ds = driver.CreateDataSource(out_path)
+    output_layer = output_ds.CreateLayer(
+        layer_name, vector_layer.GetSpatialRef(), geom_type
+    )
+    vector_defn = vector_layer.GetLayerDefn()
+    for i in range(vector_defn.GetFieldCount()):
+        output_layer.CreateField(vector_defn.GetFieldDefn(i))
+    output_defn = output_layer.GetLayerDefn()
+
+    with BatchedWriter(output_layer, output_ds, batch_size=batch_size) as writer:
+        for vector_feature in vector_layer:
             vector_geom = vector_feature.GetGeometryRef()
+            if vector_geom is None or not vector_geom.Intersects(region_geom):
+                continue
+
+            # Clip the feature with the region's outline and add it to the region's layer
+            intersection_geom = ogr.ForceTo(
+                vector_geom.Intersection(region_geom), geom_type
+            )
+            intersection_feature = ogr.Feature(output_defn)
+            intersection_feature.SetFrom(vector_feature)
+            intersection_feature.SetGeometry(intersection_geom)
+            writer.create_feature(intersection_feature)
+    n_features = writer.n_written
+
+    # Cleanup
+    output_ds = None
+    vector_ds = None
+    return region_name, out_path, n_features
+
+
+def fanout(
+    vector_dataset,
+    region_dataset,
+    output_path,
+    region_field=None,
+    fmt="GPKG",
+    workers=None,
+    batch_size=10000,
+):
+    """Fanout a vector dataset based on a region dataset
+
+    The features of the vector dataset are clipped to each region. Candidates per
+    region are selected with a spatial filter, and the regions are distributed
+    over a process pool.
+
+    Args:
+        vector_dataset (str): path to vector dataset
+        region_dataset (str): path to region dataset to fanout the vector dataset
+        output_path (str): output GeoPackage (fmt="GPKG") with one layer per region,
+            or output folder (fmt="Parquet") with one GeoParquet partition per
+            region (<output_path>/region=<name>/part.parquet)
+        region_field (str, optional): field used to name the regions, defaults
+            to the FID of the region
+        fmt (str, optional): "GPKG" or "Parquet", defaults to "GPKG"
+        workers (int, optional): number of worker processes, defaults to the
+            number of CPUs
+        batch_size (int, optional): features per write transaction, defaults
+            to 10000
+
+    Returns:
+        dict: number of features per region, by region name made safe for
+            file and layer names (duplicate names are numbered, e.g. "Oslo_2")
+    """
+    if fmt not in ("GPKG", "Parquet"):
+        raise ValueError(f"Unknown format {fmt!r}, use 'GPKG' or 'Parquet'.")
+
+    regions = _read_regions(region_dataset, region_field)
+    names = _unique_names(name for name, _ in regions)
+    regions = [(name, wkb) for name, (_, wkb) in zip(names, regions)]
+    base_name = os.path.splitext(os.path.basename(output_path))[0]
+
+    if fmt == "GPKG":
+        # SQLite allows one writer: workers write temporary GeoPackages
+        out_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+        # temporary files are named by region index, not by region name
+        tasks = [
+            (name, wkb, os.path.join(out_dir, f"{i}.gpkg"), f"{base_name}_{name}")
+            for i, (name, wkb) in enumerate(regions)
+        ]
+    else:
+        out_dir = output_path
+        tasks = []
+        for name, wkb in regions:
+            partition = os.path.join(output_path, f"region={name}")
+            os.makedirs(partition, exist_ok=True)
+            tasks.append((name, wkb, os.path.join(partition, "part.parquet"), name))
 
-            # Check if the polygon intersects with the current region
-            if vector_geom.Intersects(region_geom):
-                # Clip the polygon with the region's outline and add it to the current region's layer
-                intersection_geom = vector_geom.Intersection(region_geom)
-                intersection_feature = ogr.Feature(output_layer.GetLayerDefn())
-                intersection_feature.SetGeometry(intersection_geom)
-                output_layer.CreateFeature(intersection_feature)
+    n_features = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _fanout_region,
+                    vector_dataset,
+                    name,
+                    wkb,
+                    out_path,
+                    layer_name,
+                    fmt,
+                    batch_size,
+                )
+                for name, wkb, out_path, layer_name in tasks
+            ]
+            for n, future in enumerate(as_completed(futures), start=1):
+                region_name, _, count = future.result()
+                n_features[region_name] = count
+                print(f"Region {n}/{len(tasks)} done: {region_name} ({count} features)")
 
-        # Cleanup
-        output_ds = None
+        if fmt == "GPKG":
+            # merge the temporary GeoPackages into the output GeoPackage
+            gdal.UseExceptions()
+            for name, _, out_path, layer_name in tasks:
+                # overwrite the region layer if the output GeoPackage exists
+                access_mode = "overwrite" if os.path.exists(output_path) else None
+                gdal.VectorTranslate(
+                    output_path,
+                    out_path,
+                    format="GPKG",
+                    accessMode=access_mode,
+                    layerName=layer_name,
+                )
+    finally:
+        if fmt == "GPKG":
+            shutil.rmtree(out_dir, ignore_errors=True)
 
-    return
+    return n_features
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fanout a vector dataset based on a region dataset')
     parser.add_argument('vector_dataset', type=str, help='Path to vector dataset')
     parser.add_argument('region_dataset', type=str, help='Path to region dataset to fanout the vector dataset')
-    parser.add_argument('output_base_name', type=str, help='Base name for output files')
+    parser.add_argument('output_path', type=str, help='Output GeoPackage, or output folder for Parquet')
+    parser.add_argument('--region-field', type=str, default=None, help='Field used to name the regions')
+    parser.add_argument('--format', type=str, default='GPKG', choices=['GPKG', 'Parquet'], help='Output format')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
     args = parser.parse_args()
 
-    fanout(args.vector_dataset, args.region_dataset, args.output_base_name)
-    
-# python fanout.py vector_dataset.shp region_dataset.shp output_base_name
+    fanout(
+        args.vector_dataset,
+        args.region_dataset,
+        args.output_path,
+        region_field=args.region_field,
+        fmt=args.format,
+        workers=args.workers,
+    )
 
+# python fanout.py buildings.gpkg kommuner.gpkg buildings_per_kommune.gpkg --region-field kommunenummer
@@ -15,3 +15,115 @@ def print_layer_schema(lyr):
     print("Name, Type, Width, Precision")
     for field in lyr.schema:
         print(field.name, field.type, field.width, field.precision)
+
+
+# pragmas for bulk writes to GeoPackage/SQLite, restored on exit
+BULK_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -262144,  # 256 MB
+}
+
+
+class BatchedWriter:
+    """Group OGR feature writes into transactions of batch_size features.
+
+    On GeoPackage/SQLite every SetFeature/CreateFeature outside a transaction
+    is its own SQLite transaction. The writer starts a transaction, commits
+    every batch_size writes, and sets the bulk load pragmas while it is open.
+
+    Example:
+        with BatchedWriter(lyr, ds, batch_size=50000) as writer:
+            for feature in lyr:
+                feature.SetField("value", 1)
+                writer.set_feature(feature)
+
+    Args:
+        lyr (ogr.Layer): layer to write to
+        ds (ogr.DataSource, optional): data source of the layer, opened in update
+            mode, needed to set the pragmas
+        batch_size (int, optional): features per transaction, defaults to 10000
+        pragmas (dict, optional): SQLite pragmas for the bulk write, defaults to
+            BULK_PRAGMAS, use {} to keep the current settings
+    """
+
+    def __init__(self, lyr, ds=None, batch_size=10000, pragmas=None):
+        self.lyr = lyr
+        self.ds = ds
+        self.batch_size = batch_size
+        self.pragmas = BULK_PRAGMAS if pragmas is None else pragmas
+        self.n_written = 0
+        # drivers without transactions (e.g. Shapefile, Parquet) write directly
+        self._transactions = bool(lyr.TestCapability(ogr.OLCTransactions))
+        self._restore = {}
+        self._in_transaction = False
+
+    def _is_sqlite(self):
+        if self.ds is None:
+            return False
+        return self.ds.GetDriver().GetName() in ("GPKG", "SQLite")
+
+    def _get_pragma(self, name):
+        result = self.ds.ExecuteSQL(f"PRAGMA {name}")
+        if result is None:
+            return None
+        feature = result.GetNextFeature()
+        value = feature.GetField(0) if feature else None
+        self.ds.ReleaseResultSet(result)
+        return value
+
+    def _set_pragmas(self, pragmas):
+        for name, value in pragmas.items():
+            if value is not None:
+                # PRAGMA journal_mode returns a result layer, which must be released
+                result = self.ds.ExecuteSQL(f"PRAGMA {name} = {value}")
+                if result is not None:
+                    self.ds.ReleaseResultSet(result)
+
+    def _begin(self):
+        if self._transactions:
+            self.lyr.StartTransaction()
+            self._in_transaction = True
+
+    def _commit(self):
+        if self._in_transaction:
+            self.lyr.CommitTransaction()
+            self._in_transaction = False
+
+    def _written(self):
+        self.n_written += 1
+        if self.n_written % self.batch_size == 0:
+            self._commit()
+            print(f"Written {self.n_written} features")
+            self._begin()
+
+    def set_feature(self, feature):
+        """Update an existing feature."""
+        self.lyr.SetFeature(feature)
+        self._written()
+
+    def create_feature(self, feature):
+        """Add a new feature."""
+        self.lyr.CreateFeature(feature)
+        self._written()
+
+    def __enter__(self):
+        if self._is_sqlite() and self.pragmas:
+            self._restore = {name: self._get_pragma(name) for name in self.pragmas}
+            self._set_pragmas(self.pragmas)
+        self._begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self._in_transaction:
+                if exc_type is None:
+                    self._commit()
+                else:
+                    self.lyr.RollbackTransaction()
+                    self._in_transaction = False
+        finally:
+            if self._restore:
+                self._set_pragmas(self._restore)
+                self._restore = {}
+        return False
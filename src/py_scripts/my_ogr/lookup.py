@@ -3,6 +3,11 @@ from typing import Tuple
 from osgeo import ogr
 import pandas as pd
 
+try:
+    from .load import BatchedWriter
+except ImportError:  # run as script
+    from load import BatchedWriter
+
 
 def create_lookup_dict(
     lookup_df: pd.DataFrame,
@@ -27,10 +32,8 @@ def create_lookup_dict(
         lookup_dict {keys:value}
     """
 
-    lookup_dict = {}
-    for index, row in lookup_df.iterrows():
-        lookup_dict[tuple(row[key] for key in keys)] = row[value]
-    return lookup_dict
+    key_columns = [lookup_df[key].tolist() for key in keys]
+    return dict(zip(zip(*key_columns), lookup_df[value].tolist()))
 
 
 def lookup_value(
@@ -38,6 +41,8 @@ def lookup_value(
     lookup_dict: dict,
     keys: tuple,
     value: str,
+    ds: ogr.DataSource = None,
+    batch_size: int = 10000,
 ) -> ogr.Layer:
     """
     Reclassify an attribute value using ogr lyr object
@@ -51,18 +56,199 @@ def lookup_value(
         lookup dict {keys:value}
     field_names : tuple
         tuple with field names
+    ds : ogr data source, optional
+        data source of the lyr, used to set the bulk write pragmas
+    batch_size : int, optional
+        features per transaction, defaults to 10000
     """
 
-    for feature in lyr:
-        key = tuple(int(feature.GetField(key)) for key in keys)
-        print(key)
-        if key in lookup_dict:
-            new_value = lookup_dict[key]
-            feature.SetField(value, int(new_value))
-            lyr.SetFeature(feature)
+    with BatchedWriter(lyr, ds, batch_size=batch_size) as writer:
+        for feature in lyr:
+            key = tuple(int(feature.GetField(key)) for key in keys)
+            if key in lookup_dict:
+                new_value = lookup_dict[key]
+                feature.SetField(value, int(new_value))
+                writer.set_feature(feature)
+    print(f"Updated {writer.n_written} features")
     return key
 
 
+def _native(row):
+    """Convert numpy scalars to Python values for sqlite3/OGR."""
+    return tuple(v.item() if hasattr(v, "item") else v for v in row)
+
+
+def _lookup_table(lookup_df, keys, value):
+    """Unique lookup rows (keys, value) without missing keys."""
+    lookup = lookup_df[[*keys, value]].dropna(subset=list(keys))
+    duplicated = lookup.duplicated(subset=list(keys))
+    if duplicated.any():
+        print(f"Lookup table has {duplicated.sum()} duplicated keys, using the last.")
+        lookup = lookup.drop_duplicates(subset=list(keys), keep="last")
+    return lookup
+
+
+def _sql_literal(value):
+    """Format a lookup value as an SQLite literal."""
+    if value is None or value != value:
+        return "NULL"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def _reclassify_sql(gpkg_path, layer_name, lookup, keys, value, target_field):
+    """Reclassify a GeoPackage layer with a single UPDATE ... FROM statement.
+    Runs through OGR, which provides the GPKG functions used by the triggers."""
+    ds = ogr.Open(gpkg_path, 1)
+    try:
+        lyr = ds.GetLayerByName(layer_name)
+        if lyr.GetLayerDefn().GetFieldIndex(target_field) == -1:
+            raise ValueError(f"Field {target_field} does not exist in {layer_name}.")
+        if lookup.empty:
+            # nothing to update, and INSERT ... VALUES needs at least one row
+            return 0
+
+        key_list = ", ".join(f'"{key}"' for key in keys)
+        join = " AND ".join(f'"{layer_name}"."{key}" = l."{key}"' for key in keys)
+        rows = ",\n".join(
+            "(" + ", ".join(_sql_literal(v) for v in _native(row)) + ")"
+            for row in lookup.itertuples(index=False, name=None)
+        )
+
+        ds.StartTransaction()
+        try:
+            ds.ExecuteSQL("DROP TABLE IF EXISTS temp._lookup")
+            ds.ExecuteSQL(f'CREATE TEMP TABLE _lookup ({key_list}, "{value}")')
+            ds.ExecuteSQL(f"INSERT INTO temp._lookup VALUES {rows}")
+            ds.ExecuteSQL(f"CREATE INDEX temp._lookup_keys ON _lookup ({key_list})")
+
+            count = ds.ExecuteSQL(
+                f'SELECT COUNT(*) FROM "{layer_name}" JOIN temp._lookup AS l ON {join}'
+            )
+            n_updated = count.GetNextFeature().GetField(0)
+            ds.ReleaseResultSet(count)
+
+            ds.ExecuteSQL(
+                f"""
+                UPDATE "{layer_name}"
+                SET "{target_field}" = l."{value}"
+                FROM temp._lookup AS l
+                WHERE {join}
+                """
+            )
+            ds.ExecuteSQL("DROP TABLE temp._lookup")
+            ds.CommitTransaction()
+        except Exception:
+            ds.RollbackTransaction()
+            raise
+    finally:
+        ds = None
+    return n_updated
+
+
+def _reclassify_ogr(path, layer_name, lookup, keys, value, target_field, batch_size):
+    """Reclassify an OGR layer: vectorized join on the keys, then write the
+    matched features back in batched transactions."""
+    from pyogrio import read_dataframe
+
+    layer_keys = read_dataframe(
+        path,
+        layer=layer_name,
+        columns=list(keys),
+        read_geometry=False,
+        fid_as_index=True,
+        use_arrow=True,
+    )
+    layer_keys = layer_keys.dropna(subset=list(keys))
+    layer_keys = layer_keys.astype(lookup[list(keys)].dtypes.to_dict())
+    fid_name = layer_keys.index.name or "fid"
+    matched = (
+        layer_keys.rename_axis(fid_name)
+        .reset_index()
+        .merge(lookup, on=list(keys), how="inner")
+    )
+
+    ds = ogr.Open(path, 1)
+    lyr = ds.GetLayerByName(layer_name)
+    if lyr.GetLayerDefn().GetFieldIndex(target_field) == -1:
+        raise ValueError(f"Field {target_field} does not exist in {layer_name}.")
+
+    try:
+        with BatchedWriter(lyr, ds, batch_size=batch_size) as writer:
+            for fid, new_value in zip(
+                matched[fid_name].tolist(), matched[value].tolist()
+            ):
+                feature = lyr.GetFeature(fid)
+                feature.SetField(target_field, new_value)
+                writer.set_feature(feature)
+    finally:
+        ds = None
+    return writer.n_written
+
+
+def reclassify_layer(
+    path: str,
+    layer_name: str,
+    lookup_df: pd.DataFrame,
+    keys: Tuple[str, ...],
+    value: str,
+    target_field: str = None,
+    method: str = "auto",
+    batch_size: int = 10000,
+) -> int:
+    """
+    Reclassify an attribute of a layer in bulk using a lookup DF.
+
+    The key fields of the layer are read as arrays and joined to the lookup
+    table at once, instead of looking up every feature in a DICT.
+
+    Parameters
+    ----------
+    path : str
+        path to the GeoPackage (or other OGR dataset)
+    layer_name : str
+        name of the layer
+    lookup_df : pandas dataframe
+        lookup table loaded into a dataframe
+    keys : tuple
+        lookup key(s), field names in both the layer and the lookup table
+    value : str
+        lookup value
+    target_field : str, optional
+        field to write the value to (must exist, see import_gpkg),
+        defaults to value
+    method : str, optional
+        "sql" runs an UPDATE ... FROM in the GeoPackage, "ogr" writes the
+        joined values with OGR in batched transactions, "auto" uses "sql"
+        for GeoPackages, defaults to "auto"
+    batch_size : int, optional
+        features per transaction for method "ogr", defaults to 10000
+
+    Returns
+    -------
+    int:
+        number of updated features
+    """
+    keys = tuple(keys)
+    target_field = target_field or value
+    if method == "auto":
+        method = "sql" if path.lower().endswith(".gpkg") else "ogr"
+
+    lookup = _lookup_table(lookup_df, keys, value)
+    if method == "sql":
+        n_updated = _reclassify_sql(path, layer_name, lookup, keys, value, target_field)
+    elif method == "ogr":
+        n_updated = _reclassify_ogr(
+            path, layer_name, lookup, keys, value, target_field, batch_size
+        )
+    else:
+        raise ValueError(f"Unknown method {method!r}, use 'auto', 'sql' or 'ogr'.")
+
+    print(f"Updated {n_updated} features in {layer_name}")
+    return n_updated
+
+
 def main():
     from load import import_gpkg, print_layer_schema
 
@@ -72,6 +258,7 @@ def main():
     new_field_name = input("Enter new_field_name:")
     ds, lyr = import_gpkg(in_gpkg, layer_name, new_field_name)
     print_layer_schema(lyr)
+    ds = None
 
     # import lookup CSV
     lookup_csv = input("Enter path to CSV file:")
@@ -79,13 +266,15 @@ def main():
     value = input("Enter value as 'str':")
     lookup_df = pd.read_csv(lookup_csv)
 
-    lookup_dict = create_lookup_dict(lookup_df, keys=keys, value=value)
-
     # lookup value
-    lookup_value(lyr, lookup_dict, keys=keys, value=value)
-
-    # close ogr object
-    ds = None
+    reclassify_layer(
+        in_gpkg,
+        layer_name,
+        lookup_df,
+        keys=keys,
+        value=value,
+        target_field=new_field_name,
+    )
     print("Done")
 
 
@@ -1,33 +1,964 @@
-""" 
+"""
 Script for calculating raster statistics for a given vector layer.
+
+Two modes are available:
+
+- "windowed": the zonal statistics are computed per polygon on the raster window
+  the polygon touches: only that window is read, the polygon is rasterized to a
+  mask of the window and the statistics are NumPy reductions over the masked
+  pixels. Zones are ordered by the raster blocks they touch (plan_reads), so
+  neighbouring zones land in the same chunk, and each worker reads block-aligned
+  windows through an LRU cache of decoded blocks (BlockCache). Chunks of
+  polygons are distributed over a process pool.
+- "labels": the zones are rasterized once into an integer label raster aligned
+  to the value raster (cached on disk), and the statistics of all zones are
+  computed in one pass over the pixels with grouped reductions. A pixel can
+  only carry one label: zones that overlap an earlier zone are left out of the
+  label raster and computed in windowed mode instead.
+
+Median and percentiles are exact by default, which holds all pixel values of a
+zone in memory. With quantiles="approx" they are computed from histograms
+(see histogram_edges) and the pixels are streamed in bounded reads, so memory
+does not grow with the size of a zone.
 """
 
-from rasterstats import zonal_stats
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import rasterio
+import shapely
+from rasterio.features import geometry_mask, rasterize
+from rasterio.windows import Window
+from rasterio.windows import bounds as window_bounds
 
+DEFAULT_STATS = ["min", "max", "mean", "std", "median"]
 
-def overlay_stats(raster_path, vector_gdf, buffer_distance) -> gpd.GeoDataFrame:
-    
-    if buffer_distance > 0:
-        gdf = vector_gdf.copy()
-        gdf['geometry'] = gdf.buffer(buffer_distance)
+STAT_FUNCS = {
+    "count": lambda v: v.size,
+    "min": np.min,
+    "max": np.max,
+    "mean": lambda v: np.mean(v, dtype=np.float64),
+    "sum": lambda v: np.sum(v, dtype=np.float64),
+    "std": lambda v: np.std(v, dtype=np.float64),
+    "median": np.median,
+    "range": np.ptp,
+}
+
+
+def _check_stats(stats):
+    for stat in stats:
+        if stat not in STAT_FUNCS and not stat.startswith("percentile_"):
+            raise ValueError(
+                f"Unknown stat {stat!r}, use {list(STAT_FUNCS)} or percentile_<q>."
+            )
+
+
+def _compute_stats(values, stats):
+    """Compute the statistics of a 1D array of valid pixel values."""
+    if values.size == 0:
+        return {stat: (0 if stat == "count" else None) for stat in stats}
+
+    result = {}
+    for stat in stats:
+        if stat.startswith("percentile_"):
+            value = np.percentile(values, float(stat[len("percentile_") :]))
+        else:
+            value = STAT_FUNCS[stat](values)
+        result[stat] = value.item() if hasattr(value, "item") else value
+    return result
+
+
+def _quantile(stat):
+    """Percentile of a median/percentile_<q> stat, None for other stats."""
+    if stat == "median":
+        return 50.0
+    if stat.startswith("percentile_"):
+        return float(stat[len("percentile_") :])
+    return None
+
+
+def histogram_edges(raster_path, band=1, bins=1000):
+    """
+    Histogram bins for the approximate quantiles of a raster band.
+
+    Integer rasters with at most `bins` values in their range get one bin per
+    value, which gives exact quantiles. Other rasters get `bins` bins of equal
+    width over the band range, the error of a quantile is then at most one bin
+    width.
+
+    Args:
+        raster_path (str): Path to the raster.
+        band (int, optional): Raster band. Defaults to 1.
+        bins (int, optional): Maximum number of bins. Defaults to 1000.
+
+    Returns:
+        Tuple[np.ndarray, bool]: bin edges, and whether the bins hold one
+            integer value each.
+    """
+    with rasterio.open(raster_path) as src:
+        dtype = np.dtype(src.dtypes[band - 1])
+        if hasattr(src, "stats"):
+            band_stats = src.stats(indexes=[band])[0]
+        else:
+            band_stats = src.statistics(band)
+    vmin, vmax = float(band_stats.min), float(band_stats.max)
+
+    if dtype.kind in "iu" and vmax - vmin + 1 <= bins:
+        return np.arange(vmin, vmax + 2) - 0.5, True
+    if vmax <= vmin:
+        vmax = vmin + 1
+    return np.linspace(vmin, vmax, bins + 1), False
+
+
+def _histogram_percentiles(hist, edges, discrete, q):
+    """Percentile (linear interpolation, as np.percentile) of each row of a 2D
+    array of histograms, NaN for empty rows."""
+    count = hist.sum(axis=1)
+    cum = np.cumsum(hist, axis=1)
+    result = np.full(len(hist), np.nan)
+    has = count > 0
+    if not has.any():
+        return result
+    hist, cum, count = hist[has], cum[has], count[has]
+    rows = np.arange(len(hist))
+
+    def value_at(rank):
+        # bin of the value with 0-based rank, then the position within the bin
+        b = np.minimum((cum <= rank[:, None]).sum(axis=1), hist.shape[1] - 1)
+        if discrete:
+            return (edges[b] + edges[b + 1]) / 2
+        before = cum[rows, b] - hist[rows, b]
+        frac = (rank - before + 0.5) / np.maximum(hist[rows, b], 1)
+        return edges[b] + frac * (edges[b + 1] - edges[b])
+
+    pos = q / 100 * (count - 1)
+    lo, hi = np.floor(pos), np.ceil(pos)
+    v_lo, v_hi = value_at(lo), value_at(hi)
+    result[has] = v_lo + (v_hi - v_lo) * (pos - lo)
+    return result
+
+
+class _StreamStats:
+    """Statistics of a zone accumulated over several reads."""
+
+    def __init__(self, edges, discrete):
+        self.edges = edges
+        self.discrete = discrete
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.vmin = np.inf
+        self.vmax = -np.inf
+        self.hist = np.zeros(len(edges) - 1, dtype=np.int64)
+
+    def add(self, values):
+        if values.size == 0:
+            return
+        values = values.astype(np.float64)
+        self.count += values.size
+        self.total += values.sum()
+        self.total_sq += (values * values).sum()
+        self.vmin = min(self.vmin, values.min())
+        self.vmax = max(self.vmax, values.max())
+        bins = np.searchsorted(self.edges, values, side="right") - 1
+        bins = np.clip(bins, 0, len(self.hist) - 1)
+        self.hist += np.bincount(bins, minlength=len(self.hist))
+
+    def result(self, stats):
+        if self.count == 0:
+            return _compute_stats(np.empty(0), stats)
+        mean = self.total / self.count
+        values = {
+            "count": self.count,
+            "min": self.vmin,
+            "max": self.vmax,
+            "mean": mean,
+            "sum": self.total,
+            "std": math.sqrt(max(self.total_sq / self.count - mean * mean, 0)),
+            "range": self.vmax - self.vmin,
+        }
+        result = {}
+        for stat in stats:
+            q = _quantile(stat)
+            if q is None:
+                result[stat] = float(values[stat]) if stat != "count" else self.count
+            else:
+                result[stat] = _histogram_percentiles(
+                    self.hist[None, :], self.edges, self.discrete, q
+                )[0].item()
+        return result
+
+
+def _window(transform, bounds, height, width):
+    """Raster window covering the bounds, clipped to the raster, or None."""
+    minx, miny, maxx, maxy = bounds
+    inv = ~transform
+    cols, rows = zip(inv * (minx, maxy), inv * (maxx, miny))
+    col_off = max(int(math.floor(min(cols))), 0)
+    row_off = max(int(math.floor(min(rows))), 0)
+    col_end = min(int(math.ceil(max(cols))), width)
+    row_end = min(int(math.ceil(max(rows))), height)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+class BlockCache:
+    """LRU cache of decoded raster blocks.
+
+    Windows are read as the block-aligned window covering their missing blocks,
+    matching the tile layout of the GeoTIFF, and then served from the cache.
+    Neighbouring zones share the decoded blocks instead of reading them again.
+
+    Args:
+        src (rasterio.DatasetReader): open raster
+        band (int, optional): raster band, defaults to 1
+        max_blocks (int, optional): number of blocks kept, defaults to 256
+    """
+
+    def __init__(self, src, band=1, max_blocks=256):
+        self.src = src
+        self.band = band
+        self.max_blocks = max_blocks
+        self.block_height, self.block_width = src.block_shapes[band - 1]
+        self.blocks = OrderedDict()
+        self.n_reads = 0
+        self.n_hits = 0
+
+    def _block_window(self, row0, row1, col0, col1):
+        """Window of the blocks row0..row1, col0..col1 (inclusive)."""
+        row_off, col_off = row0 * self.block_height, col0 * self.block_width
+        row_end = min((row1 + 1) * self.block_height, self.src.height)
+        col_end = min((col1 + 1) * self.block_width, self.src.width)
+        return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+    def _load(self, keys):
+        """Read the missing blocks in one block-aligned read."""
+        missing = [key for key in keys if key not in self.blocks]
+        self.n_hits += len(keys) - len(missing)
+        if not missing:
+            return
+        rows, cols = zip(*missing)
+        window = self._block_window(min(rows), max(rows), min(cols), max(cols))
+        data = self.src.read(self.band, window=window, masked=True)
+        mask = np.ma.getmaskarray(data)
+        self.n_reads += 1
+        for row, col in missing:
+            y = row * self.block_height - window.row_off
+            x = col * self.block_width - window.col_off
+            block = (slice(y, y + self.block_height), slice(x, x + self.block_width))
+            self.blocks[(row, col)] = (data.data[block], mask[block])
+
+    def read(self, window):
+        """Read a window as a masked array, like src.read(band, masked=True)."""
+        row0 = window.row_off // self.block_height
+        row1 = (window.row_off + window.height - 1) // self.block_height
+        col0 = window.col_off // self.block_width
+        col1 = (window.col_off + window.width - 1) // self.block_width
+        keys = [
+            (row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)
+        ]
+        self._load(keys)
+
+        dtype = self.src.dtypes[self.band - 1]
+        data = np.empty((window.height, window.width), dtype=dtype)
+        mask = np.ones((window.height, window.width), dtype=bool)
+        for row, col in keys:
+            block_data, block_mask = self.blocks[(row, col)]
+            self.blocks.move_to_end((row, col))
+            # overlap of the block and the window, in window coordinates
+            y0 = max(row * self.block_height, window.row_off)
+            x0 = max(col * self.block_width, window.col_off)
+            y1 = min(
+                row * self.block_height + block_data.shape[0],
+                window.row_off + window.height,
+            )
+            x1 = min(
+                col * self.block_width + block_data.shape[1],
+                window.col_off + window.width,
+            )
+            out = (
+                slice(y0 - window.row_off, y1 - window.row_off),
+                slice(x0 - window.col_off, x1 - window.col_off),
+            )
+            part = (
+                slice(y0 - row * self.block_height, y1 - row * self.block_height),
+                slice(x0 - col * self.block_width, x1 - col * self.block_width),
+            )
+            data[out] = block_data[part]
+            mask[out] = block_mask[part]
+
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return np.ma.masked_array(data, mask=mask)
+
+
+def _morton(rows, cols):
+    """Z-order key of block rows/cols, nearby blocks get nearby keys."""
+    key = np.zeros(len(rows), dtype=np.int64)
+    rows, cols = rows.astype(np.int64), cols.astype(np.int64)
+    for bit in range(24):
+        key |= ((cols >> bit) & 1) << (2 * bit)
+        key |= ((rows >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def plan_reads(raster_path, geometries, band=1):
+    """
+    Order zones so that zones touching the same raster blocks are processed
+    together: zones are sorted on the Z-order of the block holding the center
+    of their bounds.
+
+    Args:
+        raster_path (str): Path to the raster.
+        geometries (gpd.GeoSeries): Zones in the CRS of the raster.
+        band (int, optional): Raster band. Defaults to 1.
+
+    Returns:
+        np.ndarray: positions of the zones in read order.
+    """
+    with rasterio.open(raster_path) as src:
+        block_height, block_width = src.block_shapes[band - 1]
+        inv = ~src.transform
+    bounds = np.nan_to_num(shapely.bounds(np.asarray(geometries.values)))
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    cols, rows = inv * (x, y)
+    cols = np.clip(np.floor(np.asarray(cols) / block_width), 0, None)
+    rows = np.clip(np.floor(np.asarray(rows) / block_height), 0, None)
+    return np.argsort(_morton(rows, cols), kind="stable")
+
+
+def _stream_zone(src, geom, window, stats, band, all_touched, hist, max_pixels):
+    """Statistics of one zone, reading its window in strips of max_pixels."""
+    acc = _StreamStats(*hist)
+    strip_rows = max(1, max_pixels // window.width)
+    for row_off in range(window.row_off, window.row_off + window.height, strip_rows):
+        strip = Window(
+            window.col_off,
+            row_off,
+            window.width,
+            min(strip_rows, window.row_off + window.height - row_off),
+        )
+        data = src.read(band, window=strip, masked=True)
+        inside = geometry_mask(
+            [geom],
+            out_shape=data.shape,
+            transform=src.window_transform(strip),
+            invert=True,
+            all_touched=all_touched,
+        )
+        acc.add(data.data[inside & ~np.ma.getmaskarray(data)])
+    return acc.result(stats)
+
+
+def _quantile_mode(raster_path, band, quantiles, bins):
+    """Histogram bins for quantiles="approx", None for "exact"."""
+    if quantiles == "exact":
+        return None
+    if quantiles == "approx":
+        return histogram_edges(raster_path, band, bins)
+    raise ValueError(f"Unknown quantiles {quantiles!r}, use 'exact' or 'approx'.")
+
+
+def _zonal_chunk(
+    raster_path,
+    geoms_wkb,
+    stats,
+    band=1,
+    all_touched=False,
+    hist=None,
+    max_pixels=4_000_000,
+    cache_blocks=256,
+):
+    """Zonal statistics for a chunk of WKB polygons. Runs in a worker process.
+    With hist (edges, discrete) the zones are streamed (approximate quantiles)."""
+    results = []
+    with rasterio.open(raster_path) as src:
+        cache = BlockCache(src, band, cache_blocks) if cache_blocks else None
+        for wkb in geoms_wkb:
+            geom = shapely.from_wkb(wkb)
+            window = None
+            if geom is not None and not geom.is_empty:
+                window = _window(src.transform, geom.bounds, src.height, src.width)
+            if window is None:
+                results.append(_compute_stats(np.empty(0), stats))
+                continue
+            if hist is not None:
+                results.append(
+                    _stream_zone(
+                        src, geom, window, stats, band, all_touched, hist, max_pixels
+                    )
+                )
+                continue
+
+            if cache is not None:
+                data = cache.read(window)
+            else:
+                data = src.read(band, window=window, masked=True)
+            inside = geometry_mask(
+                [geom],
+                out_shape=data.shape,
+                transform=src.window_transform(window),
+                invert=True,
+                all_touched=all_touched,
+            )
+            valid = inside & ~np.ma.getmaskarray(data)
+            results.append(_compute_stats(data.data[valid], stats))
+    return results
+
+
+def zonal_stats_windowed(
+    raster_path,
+    geometries,
+    stats=DEFAULT_STATS,
+    band=1,
+    all_touched=False,
+    workers=None,
+    chunk_size=500,
+    quantiles="exact",
+    bins=1000,
+    max_pixels=4_000_000,
+    cache_blocks=256,
+) -> pd.DataFrame:
+    """
+    Zonal statistics that read only the raster window of each polygon.
+
+    Args:
+        raster_path (str): Path to the raster.
+        geometries (gpd.GeoSeries): Polygons in the CRS of the raster.
+        stats (list, optional): Statistics, any of count, min, max, mean, sum,
+            std, median, range and percentile_<q>. Defaults to DEFAULT_STATS.
+        band (int, optional): Raster band. Defaults to 1.
+        all_touched (bool, optional): Include all pixels touched by a polygon
+            instead of the pixels with their center inside. Defaults to False.
+        workers (int, optional): Number of worker processes. Defaults to the
+            number of CPUs, use 1 to run in the current process.
+        chunk_size (int, optional): Polygons per task. Defaults to 500.
+        quantiles (str, optional): "exact" reads the window of a polygon at once
+            and computes median/percentiles from all its pixels, "approx" streams
+            the window in reads of max_pixels and uses histograms. Defaults to
+            "exact".
+        bins (int, optional): Histogram bins for quantiles="approx", see
+            histogram_edges. Defaults to 1000.
+        max_pixels (int, optional): Pixels per read for quantiles="approx".
+            Defaults to 4000000.
+        cache_blocks (int, optional): Decoded raster blocks kept per worker
+            (see BlockCache), 0 reads every window directly. Defaults to 256.
+
+    Returns:
+        pd.DataFrame: one row per geometry (same index) and one column per stat.
+    """
+    stats = list(stats)
+    _check_stats(stats)
+    hist = _quantile_mode(raster_path, band, quantiles, bins)
+    order = plan_reads(raster_path, geometries, band)
+    geoms_wkb = list(shapely.to_wkb(np.asarray(geometries.values)[order]))
+    chunks = [
+        geoms_wkb[i : i + chunk_size] for i in range(0, len(geoms_wkb), chunk_size)
+    ]
+
+    results = []
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            results.extend(
+                _zonal_chunk(
+                    raster_path,
+                    chunk,
+                    stats,
+                    band,
+                    all_touched,
+                    hist,
+                    max_pixels,
+                    cache_blocks,
+                )
+            )
     else:
-        gdf = vector_gdf.copy()
-        
-    # calc: min, max, mean, std, median
-    stats = zonal_stats(
-        gdf, 
-        raster_path, 
-        stats=['min', 'max', 'mean', 'std', 'median']
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _zonal_chunk,
+                    raster_path,
+                    chunk,
+                    stats,
+                    band,
+                    all_touched,
+                    hist,
+                    max_pixels,
+                    cache_blocks,
+                )
+                for chunk in chunks
+            ]
+            for n, future in enumerate(futures, start=1):
+                results.extend(future.result())
+                print(f"Zonal stats chunk {n}/{len(chunks)} done")
+
+    # back from read order to the order of the geometries
+    result = pd.DataFrame(results, columns=stats)
+    result.index = order
+    result = result.sort_index()
+    result.index = geometries.index
+    return result
+
+
+def _overlapping_zones(geoms):
+    """Positions of the zones whose interior overlaps a zone earlier in the list."""
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate="intersects")
+    later = left < right
+    left, right = left[later], right[later]
+    overlap = ~shapely.touches(geoms[left], geoms[right])
+    return np.unique(right[overlap])
+
+
+def _label_key(geoms_wkb, src, all_touched, excluded):
+    """Cache key of a label raster: zone geometries, raster grid and options."""
+    digest = hashlib.sha256()
+    for wkb in geoms_wkb:
+        digest.update(wkb)
+    grid = [list(src.transform)[:6], src.width, src.height, str(src.crs)]
+    digest.update(json.dumps([grid, all_touched, excluded.tolist()]).encode())
+    return digest.hexdigest()[:16]
+
+
+def rasterize_labels(
+    raster_path,
+    geometries,
+    label_path,
+    all_touched=False,
+    exclude=None,
+    strip_rows=1024,
+):
+    """
+    Rasterize zones to an integer label raster aligned to a value raster.
+
+    The label of a zone is its position in geometries + 1, 0 is no zone. The
+    raster is written in strips of strip_rows rows, so it never has to fit in
+    memory.
+
+    Args:
+        raster_path (str): Path to the value raster, defines the grid.
+        geometries (gpd.GeoSeries): Zones in the CRS of the raster.
+        label_path (str): Path to the label GeoTIFF.
+        all_touched (bool, optional): Label all pixels touched by a zone.
+            Defaults to False.
+        exclude (array, optional): Positions of zones to leave out. Defaults to None.
+        strip_rows (int, optional): Rows per strip. Defaults to 1024.
+    """
+    geoms = np.asarray(geometries.values)
+    labels = np.arange(1, len(geoms) + 1, dtype="int32")
+    include = np.ones(len(geoms), dtype=bool)
+    if exclude is not None:
+        include[exclude] = False
+    include &= ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    tree = shapely.STRtree(geoms)
+
+    with rasterio.open(raster_path) as src:
+        profile = dict(
+            driver="GTiff",
+            width=src.width,
+            height=src.height,
+            count=1,
+            dtype="int32",
+            nodata=0,
+            crs=src.crs,
+            transform=src.transform,
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            compress="deflate",
+            BIGTIFF="IF_SAFER",
         )
-    gdf['infra_min'] = [stat['min'] for stat in stats]
-    gdf['infra_max'] = [stat['max'] for stat in stats]
-    gdf['infra_mean'] = [stat['mean'] for stat in stats]
-    gdf['infra_std'] = [stat['std'] for stat in stats]   
-    gdf['infra_median'] = [stat['median'] for stat in stats]
-    
+
+    tmp_path = f"{label_path}.tmp.tif"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+        for row_off in range(0, profile["height"], strip_rows):
+            window = Window(
+                0, row_off, profile["width"], min(strip_rows, profile["height"] - row_off)
+            )
+            idx = tree.query(shapely.box(*window_bounds(window, profile["transform"])))
+            idx = idx[include[idx]]
+            strip = np.zeros((window.height, window.width), dtype="int32")
+            if idx.size:
+                strip = rasterize(
+                    zip(geoms[idx], labels[idx].tolist()),
+                    out_shape=strip.shape,
+                    transform=rasterio.windows.transform(window, profile["transform"]),
+                    fill=0,
+                    all_touched=all_touched,
+                    dtype="int32",
+                )
+            dst.write(strip, 1, window=window)
+    os.replace(tmp_path, label_path)
+
+
+def _group_starts(zones):
+    """Start positions of the runs of equal values in a sorted array."""
+    return np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+
+
+def _last_rows(geoms, transform, height):
+    """Last raster row each zone can reach, from its bounds. Index 0 (no zone)
+    and empty zones get -1."""
+    bounds = shapely.bounds(geoms)
+    inverse = ~transform
+    rows = [
+        inverse.d * bounds[:, x] + inverse.e * bounds[:, y] + inverse.f
+        for x, y in ((0, 1), (0, 3), (2, 1), (2, 3))
+    ]
+    with np.errstate(invalid="ignore"):
+        last = np.floor(np.max(rows, axis=0)) + 1
+    last = np.clip(np.nan_to_num(last, nan=-1), -1, height - 1).astype(np.int64)
+    return np.r_[-1, last]
+
+
+def _reduce_finished(pending, last_rows, row_end, quantiles):
+    """Percentiles of the pending zones that have no pixels from row_end on.
+
+    Args:
+        pending (list): (zones, values, lowest last row) per strip.
+        last_rows (np.ndarray): Last row per label, see _last_rows.
+        row_end (int): First row that was not read yet.
+        quantiles (dict): Percentile column per stat, filled in place.
+
+    Returns:
+        list: pending pixels of the zones that continue below row_end.
+    """
+    done_z, done_v, keep = [], [], []
+    for z, v, lowest in pending:
+        if lowest >= row_end:
+            keep.append((z, v, lowest))
+            continue
+        done = last_rows[z] < row_end
+        done_z.append(z[done])
+        done_v.append(v[done])
+        if not done.all():
+            z, v = z[~done], v[~done]
+            keep.append((z, v, last_rows[z].min()))
+    if done_z:
+        z, v = np.concatenate(done_z), np.concatenate(done_v)
+        order = np.lexsort((v, z))
+        z, v = z[order], v[order]
+        starts = _group_starts(z)
+        count = np.diff(np.r_[starts, z.size])
+        for stat, column in quantiles.items():
+            column[z[starts]] = _sorted_percentile(v, starts, count, _quantile(stat))
+    return keep
+
+
+def _label_pass(
+    raster_path,
+    label_path,
+    n_zones,
+    stats,
+    band,
+    strip_rows,
+    hist=None,
+    last_rows=None,
+):
+    """One pass over value and label strips, reducing the pixels per label.
+    With hist (edges, discrete) the quantiles come from per-label histograms.
+    Exact quantiles of a zone are computed after the strip with its last row
+    (last_rows), so only the pixels of the zones in the current strip are kept.
+    """
+    size = n_zones + 1
+    count = np.zeros(size, dtype=np.int64)
+    total = np.zeros(size)
+    total_sq = np.zeros(size)
+    vmin = np.full(size, np.inf)
+    vmax = np.full(size, -np.inf)
+    need_values = any(_quantile(stat) is not None for stat in stats)
+    quantiles = {
+        stat: np.full(size, np.nan) for stat in stats if _quantile(stat) is not None
+    }
+    pending = []
+    if need_values and hist is not None:
+        edges, discrete = hist
+        n_bins = len(edges) - 1
+        zone_hist = np.zeros(size * n_bins, dtype=np.int64)
+
+    with rasterio.open(raster_path) as src, rasterio.open(label_path) as lbl:
+        if last_rows is None:
+            # without the extent of the zones, reduce after the last strip
+            last_rows = np.full(size, src.height - 1, dtype=np.int64)
+        for row_off in range(0, src.height, strip_rows):
+            window = Window(0, row_off, src.width, min(strip_rows, src.height - row_off))
+            zones = lbl.read(1, window=window)
+            inside = zones > 0
+            if not inside.any():
+                continue
+            data = src.read(band, window=window, masked=True)
+            valid = inside & ~np.ma.getmaskarray(data)
+            z = zones[valid]
+            v = data.data[valid].astype(np.float64)
+            if z.size == 0:
+                continue
+
+            count += np.bincount(z, minlength=size)
+            total += np.bincount(z, weights=v, minlength=size)
+            total_sq += np.bincount(z, weights=v * v, minlength=size)
+
+            order = np.argsort(z, kind="stable")
+            z, v = z[order], v[order]
+            starts = _group_starts(z)
+            groups = z[starts]
+            vmin[groups] = np.minimum(vmin[groups], np.minimum.reduceat(v, starts))
+            vmax[groups] = np.maximum(vmax[groups], np.maximum.reduceat(v, starts))
+            if need_values and hist is not None:
+                bins = np.clip(np.searchsorted(edges, v, side="right") - 1, 0, n_bins - 1)
+                zone_hist += np.bincount(z * n_bins + bins, minlength=size * n_bins)
+            elif need_values:
+                pending.append((z, v, last_rows[z].min()))
+                pending = _reduce_finished(
+                    pending, last_rows, row_off + window.height, quantiles
+                )
+        if need_values and hist is None:
+            _reduce_finished(pending, last_rows, src.height, quantiles)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0))
+    columns = {
+        "count": count,
+        "min": vmin,
+        "max": vmax,
+        "mean": mean,
+        "sum": total,
+        "std": std,
+        "range": vmax - vmin,
+    }
+
+    if need_values and hist is not None:
+        zone_hist = zone_hist.reshape(size, n_bins)
+        for stat in stats:
+            q = _quantile(stat)
+            if q is not None:
+                columns[stat] = _histogram_percentiles(zone_hist, edges, discrete, q)
+    elif need_values:
+        columns.update(quantiles)
+
+    result = pd.DataFrame({stat: columns[stat][1:] for stat in stats})
+    empty = count[1:] == 0
+    for stat in stats:
+        if stat != "count":
+            # float columns with NaN for empty zones, as zonal_stats_windowed
+            result[stat] = result[stat].astype(np.float64).where(~empty)
+    return result
+
+
+def _sorted_percentile(values, starts, count, q):
+    """Percentile (linear interpolation, as np.percentile) of each group of a
+    value array sorted per group."""
+    result = np.full(len(count), np.nan)
+    has = count > 0
+    pos = starts[has] + q / 100 * (count[has] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    result[has] = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+    return result
+
+
+def zonal_stats_labels(
+    raster_path,
+    geometries,
+    stats=DEFAULT_STATS,
+    band=1,
+    all_touched=False,
+    cache_dir=None,
+    strip_rows=1024,
+    workers=None,
+    quantiles="exact",
+    bins=1000,
+) -> pd.DataFrame:
+    """
+    Zonal statistics on a label raster: rasterize the zones once, then reduce
+    all pixels per label in one pass.
+
+    The label raster is cached in cache_dir under a key of the zone geometries,
+    the raster grid and all_touched, and reused by every raster on the same grid.
+    Zones that overlap an earlier zone cannot share the label raster: they are
+    computed with zonal_stats_windowed.
+
+    Args:
+        raster_path (str): Path to the raster.
+        geometries (gpd.GeoSeries): Zones in the CRS of the raster.
+        stats (list, optional): Statistics, see zonal_stats_windowed.
+            Defaults to DEFAULT_STATS.
+        band (int, optional): Raster band. Defaults to 1.
+        all_touched (bool, optional): Include all pixels touched by a zone.
+            Defaults to False.
+        cache_dir (str, optional): Folder for the label rasters. Defaults to None,
+            a temporary label raster that is removed afterwards.
+        strip_rows (int, optional): Rows per strip. Defaults to 1024.
+        workers (int, optional): Number of worker processes for the overlapping
+            zones. Defaults to the number of CPUs.
+        quantiles (str, optional): "exact" keeps the pixel values of the zones
+            in the current strip for median/percentiles, "approx" uses a
+            histogram per zone (n_zones x bins counts). Defaults to "exact".
+        bins (int, optional): Histogram bins for quantiles="approx", see
+            histogram_edges. Defaults to 1000.
+
+    Returns:
+        pd.DataFrame: one row per geometry (same index) and one column per stat.
+    """
+    stats = list(stats)
+    _check_stats(stats)
+    geoms = np.asarray(geometries.values)
+    geoms_wkb = list(shapely.to_wkb(geoms))
+    overlapping = _overlapping_zones(geoms)
+    hist = _quantile_mode(raster_path, band, quantiles, bins)
+
+    tmp_dir = None
+    if cache_dir is None:
+        cache_dir = tmp_dir = tempfile.mkdtemp()
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        with rasterio.open(raster_path) as src:
+            key = _label_key(geoms_wkb, src, all_touched, overlapping)
+            last_rows = _last_rows(geoms, src.transform, src.height)
+        label_path = os.path.join(cache_dir, f"labels-{key}.tif")
+        if os.path.exists(label_path):
+            print(f"Using cached label raster {label_path}")
+        else:
+            rasterize_labels(
+                raster_path, geometries, label_path, all_touched, overlapping, strip_rows
+            )
+            print(f"Rasterized {len(geoms)} zones to {label_path}")
+
+        result = _label_pass(
+            raster_path,
+            label_path,
+            len(geoms),
+            stats,
+            band,
+            strip_rows,
+            hist,
+            last_rows,
+        )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    result.index = geometries.index
+
+    if overlapping.size:
+        print(f"{overlapping.size} overlapping zones, computing them windowed.")
+        fallback = zonal_stats_windowed(
+            raster_path,
+            geometries.iloc[overlapping],
+            stats=stats,
+            band=band,
+            all_touched=all_touched,
+            workers=workers,
+            quantiles=quantiles,
+            bins=bins,
+        )
+        for stat in stats:
+            column = result.columns.get_loc(stat)
+            values = fallback[stat].to_numpy(result[stat].dtype)
+            result.iloc[overlapping, column] = values
+    return result
+
+
+def overlay_stats(
+    raster_path,
+    vector_gdf,
+    buffer_distance,
+    stats=DEFAULT_STATS,
+    prefix="infra",
+    band=1,
+    all_touched=False,
+    workers=None,
+    chunk_size=500,
+    mode="windowed",
+    cache_dir=None,
+    quantiles="exact",
+    bins=1000,
+    cache_blocks=256,
+) -> gpd.GeoDataFrame:
+    """
+    Calculate raster statistics for the (buffered) polygons of a GeoDataFrame.
+
+    Args:
+        raster_path (str): Path to the raster.
+        vector_gdf (gpd.GeoDataFrame): Polygons, reprojected to the raster CRS
+            if needed.
+        buffer_distance (float): Buffer around the polygons, 0 for no buffer.
+        stats (list, optional): Statistics, see zonal_stats_windowed.
+            Defaults to ["min", "max", "mean", "std", "median"].
+        prefix (str, optional): Prefix of the result columns ({prefix}_{stat}).
+            Defaults to "infra".
+        band (int, optional): Raster band. Defaults to 1.
+        all_touched (bool, optional): Include all pixels touched by a polygon.
+            Defaults to False.
+        workers (int, optional): Number of worker processes. Defaults to the
+            number of CPUs.
+        chunk_size (int, optional): Polygons per task. Defaults to 500.
+        mode (str, optional): "windowed" reads the window of each polygon,
+            "labels" rasterizes the polygons once to a cached label raster
+            (see zonal_stats_labels). Defaults to "windowed".
+        cache_dir (str, optional): Folder for the label rasters of mode
+            "labels". Defaults to None.
+        quantiles (str, optional): "exact" or "approx" (histogram based, memory
+            bounded) median/percentiles. Defaults to "exact".
+        bins (int, optional): Histogram bins for quantiles="approx". Defaults
+            to 1000.
+        cache_blocks (int, optional): Decoded raster blocks kept per worker in
+            mode "windowed". Defaults to 256.
+
+    Returns:
+        gpd.GeoDataFrame: vector_gdf with the {prefix}_{stat} columns.
+    """
+    # buffer the geometries only, not a copy of the whole GeoDataFrame
+    geometries = vector_gdf.geometry
+    if buffer_distance > 0:
+        geometries = geometries.buffer(buffer_distance)
+
+    with rasterio.open(raster_path) as src:
+        raster_crs = src.crs
+    if (
+        geometries.crs is not None
+        and raster_crs is not None
+        and geometries.crs != raster_crs
+    ):
+        geometries = geometries.to_crs(raster_crs)
+
+    if mode == "windowed":
+        result = zonal_stats_windowed(
+            raster_path,
+            geometries,
+            stats=stats,
+            band=band,
+            all_touched=all_touched,
+            workers=workers,
+            chunk_size=chunk_size,
+            quantiles=quantiles,
+            bins=bins,
+            cache_blocks=cache_blocks,
+        )
+    elif mode == "labels":
+        result = zonal_stats_labels(
+            raster_path,
+            geometries,
+            stats=stats,
+            band=band,
+            all_touched=all_touched,
+            cache_dir=cache_dir,
+            workers=workers,
+            quantiles=quantiles,
+            bins=bins,
+        )
+    else:
+        raise ValueError(f"Unknown mode {mode!r}, use 'windowed' or 'labels'.")
+    result.columns = [f"{prefix}_{stat}" for stat in result.columns]
+
     # join the results back to the original geodataframe
-    vector_gdf = vector_gdf.join(gdf[['infra_min', 'infra_max', 'infra_mean', 'infra_std', 'infra_median']])
-    
-    return vector_gdf  
\ No newline at end of file
+    return vector_gdf.join(result)
@@ -1,49 +1,214 @@
-"""Import gpkg layer into gdf and create a label-column with classification of the data."""
+"""Import gpkg layer into gdf and create a label-column with classification of the data.
 
-# import gpkg into gdf
-def create_labels(gdf, col_value, col_label, ls_labels):
-    import pandas as pd
-    
-    # create label column
-    gdf[col_label] = None
-    gdf['bins'] = None
+For layers that do not fit in memory, classify_dissolve_chunked reads the layer
+in Arrow batches, labels each batch with np.digitize and keeps a few partial
+unions per label, so peak memory is bounded by the batch size.
+"""
 
+def label_strings(ls_labels):
+    """String labels ("a-b%") of the bins between consecutive ls_labels."""
     # generate string labels
     ls_labels_str = []
     for i in range(len(ls_labels)-1):
         ls_labels_str.append(f"{ls_labels[i]}-{ls_labels[i+1]}%")
-        
+
     # change first label to start from 0 instead of -0.01
     if ls_labels[0] == -0.01:
         ls_labels_str[0] = f"0-{ls_labels[1]}%"
-    
+
     # change last label to start with ">" sign
     # ls_labels_str[-1] = f">{ls_labels[-2]}%"
+    return ls_labels_str
 
-    # classify data
-    gdf['bins'] = pd.cut(gdf[col_value], bins=ls_labels)
 
-    # create dict
-    bin_intervals = gdf['bins'].cat.categories
-    label_dict = dict(zip(bin_intervals, ls_labels_str))
+def digitize_labels(values, ls_labels, ls_labels_str=None):
+    """
+    Classify values in the bins (a, b] of ls_labels, as pd.cut does.
+
+    Values outside the bins (or missing) get no label (None).
+
+    Args:
+        values (array-like): values to classify
+        ls_labels (list): bin edges
+        ls_labels_str (list, optional): labels of the bins, defaults to
+            label_strings(ls_labels)
+
+    Returns:
+        np.ndarray: string label per value
+    """
+    import numpy as np
+
+    if ls_labels_str is None:
+        ls_labels_str = label_strings(ls_labels)
+    values = np.asarray(values, dtype=float)
+
+    # bins[i-1] < x <= bins[i] -> i, labels 1..n are inside the bins
+    idx = np.digitize(values, ls_labels, right=True)
+    inside = (idx >= 1) & (idx < len(ls_labels)) & ~np.isnan(values)
+    lookup = np.array([None, *ls_labels_str], dtype=object)
+    return lookup[np.where(inside, idx, 0)]
+
+
+# import gpkg into gdf
+def create_labels(gdf, col_value, col_label, ls_labels):
+    import pandas as pd
+
+    # classify data
+    labels = pd.Series(digitize_labels(gdf[col_value], ls_labels), index=gdf.index)
 
-    gdf[col_label] = gdf['bins'].map(label_dict)
-    
     # set label col to string
-    gdf[col_label] = gdf[col_label].astype(str)
-    
-    # remove bin column     
-    gdf = gdf.drop(columns=['bins'])
+    gdf[col_label] = labels.astype("category").astype(str)
 
     return gdf
 
 # group/merge features based on label
 
-def aggr_byLabel(gdf, col_label):
+def grid_index(geoms, tol=1e-6):
+    """
+    Row/col index of regular grid cells (axis-aligned squares or rectangles of
+    one size on a common lattice, e.g. norge_ruter_10km).
+
+    Args:
+        geoms (array-like): polygons, or single-part multipolygons
+        tol (float, optional): tolerance relative to the cell size, defaults
+            to 1e-6
+
+    Returns:
+        dict: rows, cols, transform of the grid (rasterio Affine), or None if
+            the geometries are not a regular grid
+    """
+    import numpy as np
+    import shapely
+    from rasterio.transform import from_origin
+
+    geoms = np.asarray(geoms)
+    if len(geoms) == 0:
+        return None
+    # single-part MultiPolygons (usual in GeoPackage exports) as Polygons
+    single_multi = (shapely.get_type_id(geoms) == 6) & (
+        shapely.get_num_geometries(geoms) == 1
+    )
+    if single_multi.any():
+        geoms = np.where(single_multi, shapely.get_geometry(geoms, 0), geoms)
+    if not (shapely.get_type_id(geoms) == 3).all():  # Polygon
+        return None
+    if not (shapely.get_num_coordinates(geoms) == 5).all():
+        return None
+
+    bounds = shapely.bounds(geoms)
+    width = bounds[:, 2] - bounds[:, 0]
+    height = bounds[:, 3] - bounds[:, 1]
+    cell_w, cell_h = width[0], height[0]
+    if cell_w <= 0 or cell_h <= 0:
+        return None
+    if not (
+        np.allclose(width, cell_w, rtol=tol, atol=0)
+        and np.allclose(height, cell_h, rtol=tol, atol=0)
+        and np.allclose(shapely.area(geoms), width * height, rtol=tol, atol=0)
+    ):
+        return None
+
+    x0, y0 = bounds[:, 0].min(), bounds[:, 3].max()
+    cols = (bounds[:, 0] - x0) / cell_w
+    rows = (y0 - bounds[:, 3]) / cell_h
+    off_grid = max(
+        np.abs(cols - np.round(cols)).max(), np.abs(rows - np.round(rows)).max()
+    )
+    if off_grid > tol:
+        return None
+    rows, cols = np.round(rows).astype(np.int64), np.round(cols).astype(np.int64)
+
+    # every cell once
+    flat = rows * (cols.max() + 1) + cols
+    if len(np.unique(flat)) != len(flat):
+        return None
+    return {"rows": rows, "cols": cols, "transform": from_origin(x0, y0, cell_w, cell_h)}
+
+
+def dissolve_grid(gdf, col_label, grid):
+    """
+    Dissolve regular grid cells per label by region labelling on the grid:
+    the labels are written to an array of the grid and the boundaries of the
+    equal-label regions are polygonized, without polygon unions.
+
+    Args:
+        gdf (gpd.GeoDataFrame): grid cells
+        col_label (str): label column
+        grid (dict): output of grid_index
+
+    Returns:
+        gpd.GeoDataFrame: dissolved geometry per label (index col_label)
+    """
+    import geopandas as gpd
+    import numpy as np
+    import pandas as pd
+    import shapely
+    from rasterio.features import shapes
+
+    # label codes 1..n, 0 is no cell or no label (dropped, as dissolve does)
+    codes, labels = pd.factorize(gdf[col_label], sort=True)
+    array = np.zeros((grid["rows"].max() + 1, grid["cols"].max() + 1), dtype=np.int32)
+    array[grid["rows"], grid["cols"]] = codes + 1
+
+    parts = {}
+    for geom, code in shapes(
+        array, mask=array > 0, connectivity=4, transform=grid["transform"]
+    ):
+        parts.setdefault(int(code), []).append(shapely.geometry.shape(geom))
+
+    geometries = []
+    for code in range(1, len(labels) + 1):
+        polygons = parts[code]
+        geometries.append(
+            polygons[0] if len(polygons) == 1 else shapely.MultiPolygon(polygons)
+        )
+    return gpd.GeoDataFrame(
+        {"geometry": geometries},
+        index=pd.Index(labels, name=col_label),
+        geometry="geometry",
+        crs=gdf.crs,
+    )
+
+
+def aggr_byLabel(gdf, col_label, grid="auto", union="dissolve", workers=None):
+    """
+    Dissolve the features of a GeoDataFrame per label.
+
+    Regular grid layers (see grid_index) are dissolved by region labelling on
+    the grid (dissolve_grid), other layers with GeoDataFrame.dissolve or a
+    cascaded union (see vector.union).
+
+    Args:
+        gdf (gpd.GeoDataFrame): features with a label column
+        col_label (str): label column
+        grid (str or bool, optional): "auto" uses the grid path when the
+            features are regular grid cells, True requires it, False always
+            uses dissolve. Defaults to "auto".
+        union (str, optional): "dissolve" or "cascaded", the latter for labels
+            with many features. Defaults to "dissolve".
+        workers (int, optional): threads of the cascaded union
+
+    Returns:
+        gpd.GeoDataFrame: dissolved geometry per label (index col_label)
+    """
     import pandas as pd
     import geopandas as gpd
-    import shapely.wkt as wkt
-    
+
+    if grid:
+        index = grid_index(gdf.geometry.values)
+        if index is not None:
+            return dissolve_grid(gdf, col_label, index)
+        if grid is True:
+            raise ValueError("The features are not cells of a regular grid.")
+
+    if union == "cascaded":
+        try:
+            from .union import cascaded_union_by
+        except ImportError:  # run as script
+            from union import cascaded_union_by
+
+        return cascaded_union_by(gdf, col_label, workers=workers)
+
     # Remove or fix invalid geometries
     # gdf = gdf[gdf['geometry'].is_valid]
 
@@ -60,6 +225,95 @@ def aggr_byLabel(gdf, col_label):
     
     return gdf_grouped
 
+def _reduce_partials(partials, fan_in):
+    """Union the partial geometries of a label once there are fan_in of them."""
+    import shapely
+
+    if len(partials) >= fan_in:
+        return [shapely.union_all(partials)]
+    return partials
+
+
+def classify_dissolve_chunked(
+    gpkg_path,
+    layer_name,
+    col_value,
+    col_label,
+    ls_labels,
+    chunk_size=100000,
+    fan_in=8,
+):
+    """
+    Label and dissolve a layer without loading it into memory.
+
+    The layer is read in Arrow batches of chunk_size features. Every batch is
+    labelled with np.digitize (same labels as create_labels) and unioned per
+    label. The partial unions of a label are unioned again once there are
+    fan_in of them (a tree reduction), so memory is bounded by the batch size
+    and fan_in partial geometries per label.
+
+    Args:
+        gpkg_path (str): path to the GeoPackage
+        layer_name (str): name of the layer
+        col_value (str): field with the values to classify
+        col_label (str): name of the label column in the result
+        ls_labels (list): bin edges
+        chunk_size (int, optional): features per batch, defaults to 100000
+        fan_in (int, optional): partial unions per label before they are
+            reduced, defaults to 8
+
+    Returns:
+        gpd.GeoDataFrame: dissolved geometry per label (index col_label), as
+            aggr_byLabel
+    """
+    import geopandas as gpd
+    import numpy as np
+    import pandas as pd
+    import shapely
+    from pyogrio import read_info
+    from pyogrio.raw import open_arrow
+
+    ls_labels_str = label_strings(ls_labels)
+    partials = {}
+    n_features = 0
+
+    with open_arrow(
+        gpkg_path,
+        layer=layer_name,
+        columns=[col_value],
+        batch_size=chunk_size,
+        use_pyarrow=True,
+    ) as (meta, reader):
+        geom_col = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            values = batch.column(col_value).to_pandas().to_numpy(
+                dtype=float, na_value=np.nan
+            )
+            geoms = shapely.from_wkb(
+                batch.column(geom_col).to_numpy(zero_copy_only=False)
+            )
+            labels = digitize_labels(values, ls_labels, ls_labels_str)
+
+            # features without a label are dropped, as dissolve does
+            for label in set(labels) - {None}:
+                union = shapely.union_all(geoms[labels == label])
+                partials[label] = _reduce_partials(
+                    partials.get(label, []) + [union], fan_in
+                )
+            n_features += len(batch)
+            print(f"Labelled {n_features} features")
+
+    crs = read_info(gpkg_path, layer=layer_name)["crs"]
+    labels = sorted(partials)
+    gdf_grouped = gpd.GeoDataFrame(
+        {"geometry": [shapely.union_all(partials[label]) for label in labels]},
+        index=pd.Index(labels, name=col_label),
+        geometry="geometry",
+        crs=crs,
+    )
+    return gdf_grouped
+
+
 if __name__ == "__main__":
     import os 
     import geopandas as gpd
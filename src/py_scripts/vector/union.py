@@ -0,0 +1,119 @@
+"""Cascaded union of many geometries.
+
+A single union_all (or ST_Union_Agg) of tens of thousands of polygons grows
+one large result geometry. Here the geometries are first sorted along a space
+filling curve (Hilbert) or in STR slices, so neighbouring geometries end up in
+the same batch. The batches are unioned by a pool of threads (shapely releases
+the GIL in GEOS), and the partial unions are unioned again in batches, level
+by level, until one geometry is left.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def spatial_order(geoms, sort="hilbert"):
+    """Order of the geometries along a Hilbert curve or in STR slices.
+
+    Args:
+        geoms (np.ndarray): shapely geometries
+        sort (str, optional): "hilbert" or "str", defaults to "hilbert"
+
+    Returns:
+        np.ndarray: indices of the geometries in spatial order
+    """
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+
+    if sort == "hilbert":
+        distances = gpd.GeoSeries(geoms).hilbert_distance().to_numpy()
+        return np.argsort(distances, kind="stable")
+    if sort == "str":
+        # vertical slices by x of the bbox centers, sorted by y within a slice
+        bounds = shapely.bounds(geoms)
+        x = (bounds[:, 0] + bounds[:, 2]) / 2
+        y = (bounds[:, 1] + bounds[:, 3]) / 2
+        n_slices = max(int(np.ceil(np.sqrt(len(geoms) / 64))), 1)
+        by_x = np.argsort(x, kind="stable")
+        slices = np.empty(len(geoms), dtype=np.int64)
+        slices[by_x] = np.arange(len(geoms)) * n_slices // max(len(geoms), 1)
+        return np.lexsort((y, slices))
+    raise ValueError(f"Unknown sort {sort!r}, use 'hilbert' or 'str'.")
+
+
+def _union_batches(geoms, batch_size, executor):
+    import shapely
+
+    batches = [geoms[i : i + batch_size] for i in range(0, len(geoms), batch_size)]
+    if executor is None or len(batches) == 1:
+        return [shapely.union_all(batch) for batch in batches]
+    return list(executor.map(shapely.union_all, batches))
+
+
+def cascaded_union(geoms, batch_size=1024, workers=None, sort="hilbert", executor=None):
+    """Union geometries in a tree of spatially sorted batches.
+
+    Args:
+        geoms (array_like): shapely geometries, missing geometries are ignored
+        batch_size (int, optional): geometries per union, defaults to 1024
+        workers (int, optional): threads, defaults to the number of CPUs
+        sort (str, optional): "hilbert", "str" or None (keep the order),
+            defaults to "hilbert"
+        executor (ThreadPoolExecutor, optional): shared pool, instead of a
+            new pool of workers threads
+
+    Returns:
+        shapely.Geometry: union of the geometries
+    """
+    import numpy as np
+    import shapely
+
+    geoms = np.asarray(geoms, dtype=object)
+    geoms = geoms[~shapely.is_missing(geoms)]
+    if len(geoms) <= batch_size:
+        return shapely.union_all(geoms)
+
+    if sort is not None:
+        geoms = geoms[spatial_order(geoms, sort)]
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return cascaded_union(geoms, batch_size, sort=None, executor=executor)
+
+    # partial unions keep the spatial order, so every level stays local
+    while len(geoms) > 1:
+        geoms = np.asarray(_union_batches(geoms, batch_size, executor), dtype=object)
+    return geoms[0]
+
+
+def cascaded_union_by(gdf, by, batch_size=1024, workers=None, sort="hilbert"):
+    """Cascaded union of the geometries of a GeoDataFrame per group.
+
+    Args:
+        gdf (gpd.GeoDataFrame): features with a group column
+        by (str): group column, e.g. a label
+        batch_size (int, optional): geometries per union, defaults to 1024
+        workers (int, optional): threads, defaults to the number of CPUs
+        sort (str, optional): "hilbert", "str" or None, defaults to "hilbert"
+
+    Returns:
+        gpd.GeoDataFrame: union per group (index by), as GeoDataFrame.dissolve
+    """
+    import geopandas as gpd
+    import pandas as pd
+
+    # groups without a value are dropped, as dissolve does
+    groups = gdf.geometry.groupby(gdf[by], sort=True)
+    labels, geometries = [], []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for label, geoms in groups:
+            labels.append(label)
+            geometries.append(
+                cascaded_union(geoms.values, batch_size, sort=sort, executor=executor)
+            )
+    return gpd.GeoDataFrame(
+        {"geometry": geometries},
+        index=pd.Index(labels, name=by),
+        geometry="geometry",
+        crs=gdf.crs,
+    )